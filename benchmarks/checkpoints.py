@@ -0,0 +1,124 @@
+"""
+Size and cost of the checkpoints kept for a conversation, per format.
+
+Runs conversations of every ``--turns`` length through the agent graph with
+``FakeChatModel`` and an in-memory saver, once per ``CHECKPOINT_FORMAT``. It
+reports the bytes held for the thread at the end, the bytes serialized per
+step (what a MongoDB saver writes) and the time spent saving and loading
+checkpoints per turn.
+
+Run it from the repository root::
+
+    python -m benchmarks.checkpoints --turns 5,20,50
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+import warnings
+from typing import List, Optional
+
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.pop("MONGO_URI", None)
+warnings.filterwarnings("ignore")
+
+from langchain_core.messages import HumanMessage  # noqa: E402
+
+from benchmarks.fakes import FakeChatModel, MemoryStorage  # noqa: E402
+from benchmarks.webhook import TEXTS  # noqa: E402
+from gabriela.agent.agent import Agent  # noqa: E402
+from gabriela.agent.checkpoint_serde import CompactSerializer  # noqa: E402
+from gabriela.agent.checkpointer import BoundedMemorySaver  # noqa: E402
+from gabriela.agent.pampa_tools import tools_list  # noqa: E402
+from gabriela.agent.prompt import AGENT_PROMPT  # noqa: E402
+
+
+class MeasuredSaver(BoundedMemorySaver):
+    """Memory saver that counts the time and bytes of every checkpoint."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.seconds = 0.0
+        self.written = 0
+
+    def get_tuple(self, config):
+        start = time.perf_counter()
+        try:
+            return super().get_tuple(config)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        start = time.perf_counter()
+        try:
+            return super().put(config, checkpoint, metadata, new_versions)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+    def _save(self, thread_id, checkpoint_ns, stored):
+        new_items = (stored.items or [])[stored.stored_items :]
+        self.written += len(stored.checkpoint[1]) + len(stored.metadata[1])
+        self.written += sum(len(value) for _, value in new_items)
+        super()._save(thread_id, checkpoint_ns, stored)
+
+    def held(self, thread_id: str) -> int:
+        stored = self._load(thread_id, "")
+        return (
+            len(stored.checkpoint[1])
+            + len(stored.metadata[1])
+            + sum(len(value) for _, value in stored.items or [])
+        )
+
+
+def saver(format: str) -> MeasuredSaver:
+    if format == "compact":
+        return MeasuredSaver(
+            serde=CompactSerializer(static_texts=[AGENT_PROMPT]),
+            append_channel="messages",
+        )
+    return MeasuredSaver()
+
+
+def run(format: str, turns: int) -> dict:
+    checkpointer = saver(format)
+    agent = Agent(checkpointer=checkpointer)
+    model = FakeChatModel()
+    agent._models = {"vision": model, "text": model}
+    agent._context_policy.summarizer = None
+    config = {"configurable": {"thread_id": "benchmark"}}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for turn in range(turns):
+            text = TEXTS[turn % len(TEXTS)].format(n=(turn + 1) * 100)
+            agent._graph.invoke({"messages": [HumanMessage(text)]}, config)
+    return {
+        "format": format,
+        "turns": turns,
+        "held": checkpointer.held("benchmark"),
+        "written": checkpointer.written,
+        "ms_per_turn": round(checkpointer.seconds / turns * 1000, 2),
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--turns", default="5,20,50", help="Comma separated")
+    parser.add_argument("--formats", default="default,compact")
+    args = parser.parse_args(argv)
+    for tool in tools_list:
+        tool.storage = MemoryStorage()
+    print("format   turns  held bytes  written bytes  ms/turn")
+    for turns in map(int, args.turns.split(",")):
+        for format in args.formats.split(","):
+            r = run(format, turns)
+            print(
+                f"{r['format']:<8} {r['turns']:>5} {r['held']:>11} "
+                f"{r['written']:>14} {r['ms_per_turn']:>8}"
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,254 @@
+"""
+Offline stand-ins for the OpenAI models and the MongoDB storage.
+"""
+
+import asyncio
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass
+from datetime import date
+from io import BytesIO
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from PIL import Image
+from pydantic import PrivateAttr
+
+from gabriela.agent.context import approximate_token_count, message_text
+from gabriela.agent.expenses_storage import (
+    ExpenseQuery,
+    MealQuery,
+    OutOfOfficeQuery,
+    StorageStrategy,
+    expense_record,
+)
+from gabriela.agent.models import CannotGoToOfficeIRL, ExpenseRecord, MealPlan
+
+
+@dataclass
+class ScriptStep:
+    """Tool call the fake model makes when the user message matches ``pattern``."""
+
+    pattern: str
+    tool: str
+    args: Callable[[re.Match], dict]
+
+
+def _today() -> str:
+    return date.today().isoformat()
+
+
+# Tool calls for the messages generated by the benchmark
+DEFAULT_SCRIPT = [
+    ScriptStep(
+        r"gast[eé] (?P<amount>\d+) en (?P<type>\w+)",
+        "expense_tracker",
+        lambda m: {
+            "person": "Fran",
+            "expense_type": m["type"],
+            "date": _today(),
+            "total_value": float(m["amount"]),
+        },
+    ),
+    ScriptStep(
+        r"cu[aá]nto gast",
+        "get_expense_totals",
+        lambda m: {"group_by": ["person"]},
+    ),
+    ScriptStep(
+        r"gastos de (?P<person>\w+)",
+        "get_expenses",
+        lambda m: {"person": m["person"].capitalize()},
+    ),
+    ScriptStep(
+        r"comemos (?P<meal>\w+)",
+        "set_meal",
+        lambda m: {"meal": m["meal"], "date": _today(), "team_member": "Petra"},
+    ),
+    ScriptStep(
+        r"no voy",
+        "set_cannot_go_to_office_irl",
+        lambda m: {"team_member": "Lauta", "date": _today()},
+    ),
+    ScriptStep(
+        r"ticket",
+        "expense_tracker",
+        lambda m: {
+            "person": "Fran",
+            "expense_type": "comida",
+            "date": _today(),
+            "total_value": 12500.0,
+        },
+    ),
+]
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Deterministic chat model that answers after a configurable latency.
+
+    The first step of a turn calls the tool of the first ``script`` step whose
+    pattern is found in the user message, the step after a tool result (or a
+    message matching nothing) answers with text. Latency is ``latency`` plus a
+    uniform ``jitter`` drawn from a generator seeded with ``seed``.
+    """
+
+    latency: float = 0.0
+    jitter: float = 0.0
+    seed: int = 0
+    script: List[ScriptStep] = DEFAULT_SCRIPT
+    _random: random.Random = PrivateAttr()
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _calls: int = PrivateAttr(default=0)
+
+    def model_post_init(self, __context: Any) -> None:
+        self._random = random.Random(self.seed)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    @property
+    def calls(self) -> int:
+        return self._calls
+
+    def bind_tools(self, tools, **kwargs) -> "FakeChatModel":
+        return self
+
+    def _delay(self) -> float:
+        with self._lock:
+            self._calls += 1
+            jitter = self._random.uniform(-self.jitter, self.jitter)
+        return max(0.0, self.latency + jitter)
+
+    def _respond(self, messages: List[BaseMessage]) -> AIMessage:
+        usage = {
+            "input_tokens": approximate_token_count(messages),
+            "output_tokens": 12,
+            "total_tokens": approximate_token_count(messages) + 12,
+        }
+        last = messages[-1]
+        if isinstance(last, HumanMessage):
+            text = message_text(last).lower()
+            for i, step in enumerate(self.script):
+                if match := re.search(step.pattern, text):
+                    call = {
+                        "name": step.tool,
+                        "args": step.args(match),
+                        "id": f"call_{self._calls}_{i}",
+                        "type": "tool_call",
+                    }
+                    return AIMessage(
+                        content="", tool_calls=[call], usage_metadata=usage
+                    )
+        if isinstance(last, ToolMessage):
+            return AIMessage(
+                content=f"Listo: {last.content[:60]}", usage_metadata=usage
+            )
+        return AIMessage(content="Entendido.", usage_metadata=usage)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self._delay())
+        return ChatResult(generations=[ChatGeneration(message=self._respond(messages))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self._delay())
+        return ChatResult(generations=[ChatGeneration(message=self._respond(messages))])
+
+
+def _matches(document: dict, query: dict) -> bool:
+    """Whether a document matches the subset of Mongo filters the queries use."""
+    for key, condition in query.items():
+        value = document.get(key)
+        if isinstance(condition, dict):
+            if "$gte" in condition and not (value and value >= condition["$gte"]):
+                return False
+            if "$lte" in condition and not (value and value <= condition["$lte"]):
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+class MemoryStorage(StorageStrategy):
+    """
+    In-memory storage with the same query semantics as ``MongoDBStorage``.
+
+    Every operation sleeps ``latency`` seconds to stand in for the database
+    round trip. Aggregations use the ``StorageStrategy`` defaults.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.collections: Dict[str, List[dict]] = {
+            "expenses": [],
+            "meals": [],
+            "out_of_office": [],
+        }
+        self._lock = threading.Lock()
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _add(self, collection: str, document: dict):
+        self._wait()
+        with self._lock:
+            self.collections[collection].append(dict(document))
+
+    def _find(self, collection: str, query) -> List[dict]:
+        self._wait()
+        with self._lock:
+            # Copies, so callers can't change the stored documents
+            documents = [
+                dict(d)
+                for d in self.collections[collection]
+                if _matches(d, query.to_mongo())
+            ]
+        documents.sort(key=lambda d: d.get("date", ""), reverse=True)
+        return documents[: query.limit] if query.limit else documents
+
+    def add_expense(self, expense: dict):
+        self._add("expenses", expense)
+
+    def get_expenses(
+        self, query: Optional[ExpenseQuery] = None
+    ) -> Iterator[ExpenseRecord]:
+        for document in self._find("expenses", query or ExpenseQuery()):
+            yield expense_record(document)
+
+    def add_meal(self, meal: dict):
+        self._add("meals", meal)
+
+    def get_meals(self, query: Optional[MealQuery] = None) -> Iterator[MealPlan]:
+        for document in self._find("meals", query or MealQuery()):
+            yield MealPlan(**document)
+
+    def add_out_of_office(self, out_of_office: dict):
+        self._add("out_of_office", out_of_office)
+
+    def get_out_of_office(
+        self, query: Optional[OutOfOfficeQuery] = None
+    ) -> Iterator[CannotGoToOfficeIRL]:
+        for document in self._find("out_of_office", query or OutOfOfficeQuery()):
+            yield CannotGoToOfficeIRL(**document)
+
+    def cancel_pending_expenses(self):
+        self._wait()
+        with self._lock:
+            for expense in self.collections["expenses"]:
+                expense["state"] = "finished"
+
+
+def receipt_image(width: int = 1600, height: int = 2000) -> bytes:
+    """A JPEG the size of a phone photo, to exercise the image pipeline."""
+    image = Image.new("RGB", (width, height), "white")
+    for y in range(0, height, 40):
+        image.paste((30, 30, 30), (80, y, width - 80, y + 8))
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
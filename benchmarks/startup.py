@@ -0,0 +1,175 @@
+"""
+Cold start benchmark: time from launching the server to its first answer.
+
+Starts ``main.app`` under uvicorn in a fresh process for every run, waits for
+``/ready`` to answer (the port is bound) and then for the first ``/whatsapp``
+message to be answered by the agent. The OpenAI models and the MongoDB storage
+are replaced by the offline fakes once the agent is built, so the numbers only
+reflect imports, graph construction and the server itself. Every
+``--modes`` value is a ``STARTUP_MODE`` to compare.
+
+Run it from the repository root::
+
+    python -m benchmarks.startup --modes eager,lazy,background --runs 5
+
+Besides the medians it prints the ``/startup`` breakdown of the last run of
+each mode. ``--json`` saves the results.
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from dataclasses import asdict, dataclass, field
+from typing import List, Optional
+
+import httpx
+
+# Offline settings for the server processes
+OFFLINE_ENV = {
+    "OPENAI_API_KEY": "benchmark",
+    "WHATSAPP_REPLY_MODE": "sync",
+    "CHECKPOINTER": "memory",
+    "MONGO_URI": "",
+    "TWILIO_ACCOUNT_SID": "",
+}
+
+MESSAGE = {
+    "From": "whatsapp:+5491100000000",
+    "To": "whatsapp:+14155238886",
+    "Body": "Gasté 1500 en uber",
+    "MessageSid": "SMstartup",
+}
+
+
+@dataclass
+class Run:
+    mode: str
+    listening: float
+    first_response: float
+    startup: dict = field(default_factory=dict)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve(port: int, model_latency: float):
+    """Runs the app in this process, with the fakes plugged into the agent."""
+    for name, value in OFFLINE_ENV.items():
+        os.environ.setdefault(name, value)
+    import uvicorn
+
+    import main
+
+    build = main.agent_loader.factory
+
+    def build_offline():
+        wa = build()
+        from benchmarks.fakes import FakeChatModel, MemoryStorage
+        from gabriela.agent.pampa_tools import tools_list
+
+        model = FakeChatModel(latency=model_latency)
+        wa.agent._models = {"vision": model, "text": model}
+        if wa.agent._context_policy.summarizer is not None:
+            wa.agent._context_policy.summarizer = model
+        storage = MemoryStorage()
+        for tool in tools_list:
+            tool.storage = storage
+        return wa
+
+    main.agent_loader.factory = build_offline
+    uvicorn.run(main.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def measure(mode: str, model_latency: float, timeout: float, verbose: bool) -> Run:
+    port = free_port()
+    env = {**os.environ, **OFFLINE_ENV, "STARTUP_MODE": mode}
+    command = [
+        sys.executable,
+        "-m",
+        "benchmarks.startup",
+        "--serve",
+        str(port),
+        "--model-latency-ms",
+        str(model_latency * 1000),
+    ]
+    output = None if verbose else subprocess.DEVNULL
+    start = time.monotonic()
+    server = subprocess.Popen(command, env=env, stdout=output, stderr=output)
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=timeout) as c:
+            while True:
+                if time.monotonic() - start > timeout:
+                    raise TimeoutError(f"The {mode} server didn't start")
+                if server.poll() is not None:
+                    raise RuntimeError(f"The {mode} server exited")
+                try:
+                    c.get("/ready").raise_for_status()
+                    break
+                except httpx.TransportError:
+                    time.sleep(0.005)
+            listening = time.monotonic() - start
+            response = c.post("/whatsapp", data=MESSAGE)
+            response.raise_for_status()
+            if "<Message>" not in response.text:
+                raise RuntimeError(f"Unexpected answer: {response.text}")
+            first_response = time.monotonic() - start
+            startup = c.get("/startup").json()
+    finally:
+        server.terminate()
+        server.wait()
+    return Run(mode, round(listening, 3), round(first_response, 3), startup)
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--modes", default="eager,lazy,background")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--model-latency-ms", type=float, default=0)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--json", help="Where to save the results")
+    parser.add_argument("--verbose", action="store_true", help="Show the app logs")
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    model_latency = args.model_latency_ms / 1000
+    if args.serve:
+        serve(args.serve, model_latency)
+        return 0
+    runs: List[Run] = []
+    print("mode        listening s  first response s")
+    for mode in args.modes.split(","):
+        mode_runs = [
+            measure(mode, model_latency, args.timeout, args.verbose)
+            for _ in range(args.runs)
+        ]
+        runs.extend(mode_runs)
+        listening = statistics.median(r.listening for r in mode_runs)
+        first_response = statistics.median(r.first_response for r in mode_runs)
+        print(f"{mode:<11} {listening:>11.3f} {first_response:>17.3f}")
+    print()
+    for mode in args.modes.split(","):
+        last = [r for r in runs if r.mode == mode][-1]
+        print(f"{mode}: {json.dumps(last.startup)}")
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(
+                {"args": vars(args), "runs": [asdict(r) for r in runs]},
+                file,
+                indent=2,
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
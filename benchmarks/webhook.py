@@ -0,0 +1,329 @@
+"""
+Load test of the ``/whatsapp`` webhook that runs fully offline.
+
+Drives ``main.app`` in process through ``httpx.ASGITransport`` with synthetic
+(or recorded) Twilio form payloads. The OpenAI models are replaced by
+``FakeChatModel``, the MongoDB storage by ``MemoryStorage`` and Twilio media
+downloads by a mock transport serving a receipt photo. For every combination of
+``--concurrency`` (senders talking at the same time) and ``--turns`` (messages
+per conversation) it reports throughput and p50/p95/p99 webhook latency.
+
+Run it from the repository root::
+
+    python -m benchmarks.webhook --concurrency 1,8,32 --turns 1,10
+
+App settings are read from the environment as usual, e.g. ``FAST_PATH=off``
+or ``ANSWER_CACHE_MAX_ENTRIES=0``. ``--json`` saves the results and
+``--baseline`` compares them against a saved run, exiting with 1 when
+throughput or p95 latency regress more than ``--tolerance``. Failed requests
+and tool calls answering with an error also make it exit with 1.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import warnings
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+
+# Offline settings, before the app reads them
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("WHATSAPP_REPLY_MODE", "sync")
+os.environ.setdefault("CHECKPOINTER", "memory")
+os.environ.pop("MONGO_URI", None)
+os.environ.pop("TWILIO_ACCOUNT_SID", None)
+warnings.filterwarnings("ignore")
+
+import httpx  # noqa: E402
+
+from benchmarks.fakes import FakeChatModel, MemoryStorage, receipt_image  # noqa: E402
+from gabriela.agent.metrics import metrics  # noqa: E402
+
+MEDIA_URL = "https://api.twilio.com/benchmark/Media/{}"
+
+# Messages of the synthetic conversations, cycled through by every sender
+TEXTS = [
+    "Gasté {n} en uber",
+    "¿Cuánto gastó cada uno este mes?",
+    "Hoy comemos pizza",
+    "Quién no viene mañana",
+    "Mañana no voy a la oficina",
+    "Mostrame los gastos de fran",
+    "Gracias!",
+]
+
+
+@dataclass
+class Result:
+    concurrency: int
+    turns: int
+    requests: int
+    errors: int
+    # Tool calls that answered "Error ..." to the model or the fast path
+    tool_errors: int
+    seconds: float
+    throughput: float
+    p50: float
+    p95: float
+    p99: float
+    model_calls: int
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+def synthetic_conversations(
+    run: str, senders: int, turns: int, image_ratio: float, seed: int
+) -> Dict[str, List[dict]]:
+    """Twilio form payloads per sender, with some messages carrying a photo."""
+    rng = random.Random(seed)
+    conversations = {}
+    for i in range(senders):
+        sender = f"whatsapp:+549{run}{i:05d}"
+        payloads = []
+        for turn in range(turns):
+            payload = {
+                "From": sender,
+                "To": "whatsapp:+14155238886",
+                "MessageSid": f"SM{run}{i:05d}{turn:04d}",
+            }
+            if rng.random() < image_ratio:
+                payload["Body"] = "Registrá este ticket"
+                payload["MediaUrl0"] = MEDIA_URL.format(payload["MessageSid"])
+            else:
+                text = TEXTS[(i + turn) % len(TEXTS)]
+                payload["Body"] = text.format(n=rng.randint(1, 50) * 100)
+            payloads.append(payload)
+        conversations[sender] = payloads
+    return conversations
+
+
+def recorded_conversations(path: str) -> Dict[str, List[dict]]:
+    """Payloads from a JSON lines file of Twilio forms, in order per sender."""
+    conversations: Dict[str, List[dict]] = {}
+    with open(path) as file:
+        for line in file:
+            if line.strip():
+                payload = json.loads(line)
+                conversations.setdefault(payload["From"], []).append(payload)
+    return conversations
+
+
+class Harness:
+    """The app wired to the fakes, reset between runs."""
+
+    def __init__(self, args):
+        import main
+        from gabriela.agent.pampa_tools import tools_list
+
+        self.main = main
+        self.tools = tools_list
+        self.args = args
+        self.model = FakeChatModel(
+            latency=args.model_latency_ms / 1000,
+            jitter=args.model_jitter_ms / 1000,
+            seed=args.seed,
+        )
+        agent = main.agent_loader.get().agent
+        agent._models = {"vision": self.model, "text": self.model}
+        if agent._context_policy.summarizer is not None:
+            agent._context_policy.summarizer = self.model
+        image = receipt_image()
+        main.http_client = httpx.AsyncClient(
+            transport=httpx.MockTransport(
+                lambda request: httpx.Response(
+                    200, content=image, headers={"Content-Type": "image/jpeg"}
+                )
+            )
+        )
+        self.client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=main.app), base_url="http://benchmark"
+        )
+
+    def reset(self):
+        storage = MemoryStorage(latency=self.args.storage_latency_ms / 1000)
+        for tool in self.tools:
+            tool.storage = storage
+
+    async def post(self, payload: dict) -> float:
+        start = time.perf_counter()
+        response = await self.client.post("/whatsapp", data=payload)
+        response.raise_for_status()
+        return time.perf_counter() - start
+
+    async def run(
+        self, conversations: Dict[str, List[dict]], concurrency: int, turns: int
+    ) -> Result:
+        self.reset()
+        latencies: List[float] = []
+        errors = 0
+        calls = self.model.calls
+        tool_errors = metrics.value("gabriela_errors_total", stage="tool")
+        senders = iter(conversations.values())
+        lock = asyncio.Lock()
+
+        async def talk():
+            nonlocal errors
+            while True:
+                async with lock:
+                    payloads = next(senders, None)
+                if payloads is None:
+                    return
+                for payload in payloads:
+                    try:
+                        latencies.append(await self.post(payload))
+                    except Exception as e:
+                        errors += 1
+                        print(f"Request failed: {e}", file=sys.stderr)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(talk() for _ in range(concurrency)))
+        seconds = time.perf_counter() - start
+        requests = len(latencies) + errors
+        tool_errors = int(
+            metrics.value("gabriela_errors_total", stage="tool") - tool_errors
+        )
+        return Result(
+            concurrency=concurrency,
+            turns=turns,
+            requests=requests,
+            errors=errors,
+            tool_errors=tool_errors,
+            seconds=round(seconds, 3),
+            throughput=round(requests / seconds, 2) if seconds else 0.0,
+            p50=round(percentile(latencies, 50) * 1000, 1),
+            p95=round(percentile(latencies, 95) * 1000, 1),
+            p99=round(percentile(latencies, 99) * 1000, 1),
+            model_calls=self.model.calls - calls,
+        )
+
+
+def compare(results: List[Result], baseline_path: str, tolerance: float) -> bool:
+    """Prints the changes against a baseline, returning False on regressions."""
+    with open(baseline_path) as file:
+        baseline = {
+            (r["concurrency"], r["turns"]): r for r in json.load(file)["results"]
+        }
+    ok = True
+    for result in results:
+        before = baseline.get((result.concurrency, result.turns))
+        if not before:
+            continue
+        throughput = result.throughput / before["throughput"] - 1
+        p95 = result.p95 / before["p95"] - 1 if before["p95"] else 0.0
+        regressed = throughput < -tolerance or p95 > tolerance
+        ok = ok and not regressed
+        print(
+            f"c={result.concurrency} turns={result.turns}: "
+            f"throughput {throughput:+.0%}, p95 {p95:+.0%}"
+            f"{'  REGRESSION' if regressed else ''}"
+        )
+    return ok
+
+
+def print_table(results: List[Result]):
+    print(
+        "concurrency turns requests errors tool errors   req/s  p50 ms  p95 ms  "
+        "p99 ms calls"
+    )
+    for r in results:
+        print(
+            f"{r.concurrency:>11} {r.turns:>5} {r.requests:>8} {r.errors:>6} "
+            f"{r.tool_errors:>11} {r.throughput:>7} {r.p50:>7} {r.p95:>7} "
+            f"{r.p99:>7} {r.model_calls:>5}"
+        )
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma separated")
+    parser.add_argument("--turns", default="1,5", help="Comma separated")
+    parser.add_argument(
+        "--senders", type=int, default=0, help="Conversations per run (default 2x)"
+    )
+    parser.add_argument("--image-ratio", type=float, default=0.1)
+    parser.add_argument("--model-latency-ms", type=float, default=300)
+    parser.add_argument("--model-jitter-ms", type=float, default=100)
+    parser.add_argument("--storage-latency-ms", type=float, default=5)
+    parser.add_argument("--payloads", help="JSON lines file of recorded forms")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Where to save the results")
+    parser.add_argument("--baseline", help="Results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--verbose", action="store_true", help="Show the app logs")
+    return parser.parse_args(argv)
+
+
+async def benchmark(args) -> List[Result]:
+    harness = Harness(args)
+    # Warm up the graph and the connection pools
+    await harness.post(
+        {"From": "whatsapp:+0", "Body": "Hola", "MessageSid": "SMwarmup"}
+    )
+    results = []
+    runs = itertools.count()
+    for concurrency in map(int, args.concurrency.split(",")):
+        for turns in map(int, args.turns.split(",")):
+            run = f"{next(runs):03d}"
+            if args.payloads:
+                conversations = recorded_conversations(args.payloads)
+                # Fresh ids so the webhook doesn't take them for retries
+                for payloads in conversations.values():
+                    for payload in payloads:
+                        payload["MessageSid"] = f"{payload['MessageSid']}-{run}"
+                turns = max(len(p) for p in conversations.values())
+            else:
+                conversations = synthetic_conversations(
+                    run,
+                    args.senders or 2 * concurrency,
+                    turns,
+                    args.image_ratio,
+                    args.seed,
+                )
+            results.append(await harness.run(conversations, concurrency, turns))
+    await harness.client.aclose()
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    # The app logs with print, keep them out of the report
+    logs = (
+        contextlib.nullcontext()
+        if args.verbose
+        else contextlib.redirect_stdout(io.StringIO())
+    )
+    with logs:
+        results = asyncio.run(benchmark(args))
+    print_table(results)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(
+                {"args": vars(args), "results": [asdict(r) for r in results]},
+                file,
+                indent=2,
+            )
+    if any(r.errors or r.tool_errors for r in results):
+        # The webhook answers 200 even when the turn failed, don't time that
+        print("Some requests or tool calls failed, run with --verbose to see why")
+        return 1
+    if args.baseline and not compare(results, args.baseline, args.tolerance):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
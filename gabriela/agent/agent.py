@@ -1,43 +1,363 @@
-from typing import Any, Dict, List, Literal, Optional
+import os
+import time
+from functools import cache
+from typing import Any, Dict, List, Literal, Optional, Sequence, Tuple, Union
 
+import openai
 from dotenv import load_dotenv
 from jinja2 import Template
-from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.messages import (
+    AIMessage,
+    BaseMessage,
+    HumanMessage,
+    SystemMessage,
+)
+from langchain_core.runnables import RunnableConfig, RunnableLambda
 from langchain_core.tools import Tool
 from langchain_openai import ChatOpenAI
-from langgraph.checkpoint.memory import MemorySaver
+from langgraph.checkpoint.base import BaseCheckpointSaver
 from langgraph.graph import END, StateGraph
 from langgraph.prebuilt import ToolNode
 
+from .answer_cache import AnswerCache, build_answer_cache, turn_messages
+from .checkpointer import build_checkpointer
+from .context import ContextPolicy, approximate_token_count
+from .governor import (
+    BUSY_REPLY,
+    MODEL_ERROR_REPLY,
+    CircuitOpenError,
+    ModelGovernor,
+    build_governor,
+)
+from .images import PROCESSED_IMAGE_TEXT, ImageStore, image_part_url, image_store
+from .metrics import SIZE_BUCKETS, log_event, metrics
 from .pampa_tools import tools_list
-from .prompt import AGENT_PROMPT
+from .prompt import AGENT_PROMPT, context_message
+from .router import FastPathRouter
 from .state import AgentState
 
 load_dotenv()
 
 
+@cache
+def _http_clients() -> Tuple[openai.DefaultHttpxClient, openai.DefaultAsyncHttpxClient]:
+    """
+    HTTP clients shared by every model: building one loads the certificates,
+    which is a good part of the startup, and sharing them shares the pools.
+    """
+    return openai.DefaultHttpxClient(), openai.DefaultAsyncHttpxClient()
+
+
+def chat_model(model_name: str) -> ChatOpenAI:
+    """
+    Chat model that gives up after ``MODEL_TIMEOUT_SECONDS``. It doesn't retry
+    on its own, retries are up to the ``ModelGovernor``.
+    """
+    http_client, http_async_client = _http_clients()
+    return ChatOpenAI(
+        model_name=model_name,
+        timeout=float(os.getenv("MODEL_TIMEOUT_SECONDS", "30")),
+        max_retries=0,
+        http_client=http_client,
+        http_async_client=http_async_client,
+    )
+
+
+def build_context_policy() -> ContextPolicy:
+    """
+    Builds the context policy configured through environment variables.
+
+    ``CONTEXT_MAX_TOKENS`` is the history budget sent to the model and
+    ``CONTEXT_SUMMARY_MODEL`` the model used for the rolling summary (empty
+    disables summaries, older turns are then just left out).
+    """
+    summary_model = os.getenv("CONTEXT_SUMMARY_MODEL", "gpt-4o-mini")
+    return ContextPolicy(
+        max_tokens=int(os.getenv("CONTEXT_MAX_TOKENS", "3000")),
+        summarizer=chat_model(summary_model) if summary_model else None,
+    )
+
+
 class Agent:
     def __init__(
         self,
         prompt: Template = AGENT_PROMPT,
         model_name: str = "gpt-4o",
+        text_model_name: Optional[str] = None,
         tools: List[Tool] = tools_list,
+        checkpointer: Optional[BaseCheckpointSaver] = None,
+        context_policy: Optional[ContextPolicy] = None,
+        images: ImageStore = image_store,
+        router: Optional[FastPathRouter] = None,
+        answers: Optional[AnswerCache] = None,
+        governor: Optional[ModelGovernor] = None,
     ):
         self._prompt = prompt
-        self._model = ChatOpenAI(model_name=model_name).bind_tools(tools)
+        # model_name reads the pictures, steps without images use the cheaper
+        # AGENT_TEXT_MODEL (empty to use model_name for everything)
+        if text_model_name is None:
+            text_model_name = os.getenv("AGENT_TEXT_MODEL", "gpt-4o-mini")
+        self.model_names = {"vision": model_name, "text": text_model_name or model_name}
+        self._models = {"vision": chat_model(model_name).bind_tools(tools)}
+        self._models["text"] = (
+            self._models["vision"]
+            if self.model_names["text"] == model_name
+            else chat_model(self.model_names["text"]).bind_tools(tools)
+        )
+        self.governor = governor if governor is not None else build_governor()
         self._tools = tools
+        self._checkpointer = (
+            checkpointer if checkpointer is not None else build_checkpointer()
+        )
+        self._context_policy = (
+            context_policy if context_policy is not None else build_context_policy()
+        )
+        self._images = images
+        # Common commands are answered without the model unless FAST_PATH=off
+        if router is None and os.getenv("FAST_PATH", "on") != "off":
+            router = FastPathRouter(tools)
+        self.router = router
+        self.answers = answers if answers is not None else build_answer_cache()
+        self.usage = {
+            tier: {
+                "model": name,
+                "calls": 0,
+                "prompt_tokens": 0,
+                "cached_tokens": 0,
+                "completion_tokens": 0,
+                "latency_seconds": 0.0,
+                "cached_ratio": 0.0,
+            }
+            for tier, name in self.model_names.items()
+        }
         self._build_graph()
 
-    def _call_model(self, state: AgentState) -> dict:
-        if not state["messages"] or not isinstance(state["messages"][0], SystemMessage):
-            state["messages"].insert(0, SystemMessage(content=self._prompt))
+    def _history(self, state: AgentState) -> List[BaseMessage]:
+        # Older checkpoints have the system prompt stored in the history
+        history = [m for m in state["messages"] if not isinstance(m, SystemMessage)]
+        return self._render_images(history)
+
+    def _render_images(self, history: List[BaseMessage]) -> List[BaseMessage]:
+        """
+        Resolves the images of the current turn and hides the ones of past turns.
+
+        The history only holds image references; the image is sent to the model
+        during the turn that received it and replaced by a short text afterwards.
+        """
+        current_turn = max(
+            (i for i, m in enumerate(history) if isinstance(m, HumanMessage)),
+            default=-1,
+        )
+        rendered = []
+        for i, message in enumerate(history):
+            if isinstance(message, HumanMessage) and not isinstance(
+                message.content, str
+            ):
+                content = []
+                for part in message.content:
+                    url = image_part_url(part)
+                    if url is None:
+                        content.append(part)
+                        continue
+                    data_url = (
+                        self._images.to_data_url(url) if i == current_turn else None
+                    )
+                    if data_url:
+                        content.append({"type": "image_url", "image_url": data_url})
+                    else:
+                        content.append({"type": "text", "text": PROCESSED_IMAGE_TEXT})
+                message = message.model_copy(update={"content": content})
+            rendered.append(message)
+        return rendered
+
+    def _to_fold(self, state: AgentState, history: List[BaseMessage]) -> int:
+        """Index up to which the history should be folded into the summary."""
+        if not self._context_policy.summarizer:
+            return state.get("summarized", 0)
+        return self._context_policy.plan(history, state.get("summarized", 0))
+
+    def _model_input(
+        self,
+        history: List[BaseMessage],
+        summary: str,
+        summarized: int,
+        sender: Optional[str] = None,
+    ) -> List[BaseMessage]:
+        # Static prompt first so the provider can reuse its cached prefix, then
+        # the summary, which only changes every few turns, and last the per-call
+        # context, which is never stored in the state
+        messages: List[BaseMessage] = [SystemMessage(content=self._prompt)]
+        if summary:
+            messages.append(ContextPolicy.summary_message(summary))
+        messages.append(SystemMessage(content=context_message(sender)))
+        messages.extend(self._context_policy.window(history, summarized))
+        return messages
+
+    @staticmethod
+    def _select_model(messages: List[BaseMessage]) -> str:
+        """Vision model while the current turn has an image, text model otherwise."""
+        for message in reversed(messages):
+            if isinstance(message, HumanMessage):
+                if isinstance(message.content, str):
+                    return "text"
+                has_image = any(image_part_url(part) for part in message.content)
+                return "vision" if has_image else "text"
+        return "text"
+
+    def _record_usage(
+        self, tier: str, messages: List[BaseMessage], response, latency: float
+    ) -> None:
+        usage = getattr(response, "usage_metadata", None) or {}
+        stats = self.usage[tier]
+        stats["calls"] += 1
+        cached = (usage.get("input_token_details") or {}).get("cache_read") or 0
+        stats["prompt_tokens"] += usage.get("input_tokens", 0)
+        stats["cached_tokens"] += cached
+        stats["completion_tokens"] += usage.get("output_tokens", 0)
+        stats["latency_seconds"] += latency
+        stats["cached_ratio"] = (
+            stats["cached_tokens"] / stats["prompt_tokens"]
+            if stats["prompt_tokens"]
+            else 0.0
+        )
+        for kind, tokens in (
+            ("prompt", usage.get("input_tokens", 0)),
+            ("cached", cached),
+            ("completion", usage.get("output_tokens", 0)),
+        ):
+            metrics.inc(
+                "gabriela_model_tokens_total", tokens, model=stats["model"], kind=kind
+            )
+        log_event(
+            "model_call",
+            model=stats["model"],
+            messages=len(messages),
+            prompt_tokens=usage.get("input_tokens"),
+            cached_tokens=cached,
+            completion_tokens=usage.get("output_tokens"),
+            estimated_tokens=approximate_token_count(messages),
+            seconds=round(latency, 3),
+        )
+
+    @staticmethod
+    def _failure_reply(error: Exception) -> AIMessage:
+        """
+        Answer of a turn whose model call failed. It's an AI message, so the
+        user gets a friendly reply and the history stays a valid conversation.
+        """
+        if isinstance(error, CircuitOpenError):
+            return AIMessage(content=BUSY_REPLY)
+        print(f"Error invoking model: {str(error)}")
+        return AIMessage(content=MODEL_ERROR_REPLY)
+
+    def _summary_request(
+        self, state: AgentState, history: List[BaseMessage]
+    ) -> Optional[Tuple[int, str, List[BaseMessage]]]:
+        """Where the fold ends, the summary so far and the messages to fold into it."""
+        summarized = state.get("summarized", 0)
+        if (fold := self._to_fold(state, history)) > summarized:
+            return fold, state.get("summary", ""), history[summarized:fold]
+        return None
+
+    @staticmethod
+    def _summary_update(fold: int, summary: Union[str, Exception]) -> dict:
+        if isinstance(summary, Exception):
+            # The window alone still keeps the request within budget
+            print(f"Error summarizing conversation: {str(summary)}")
+            return {}
+        return {"summary": summary, "summarized": fold}
+
+    def _model_request(
+        self,
+        state: AgentState,
+        history: List[BaseMessage],
+        update: dict,
+        sender: Optional[str],
+    ) -> Tuple[str, List[BaseMessage]]:
+        """The model tier to call and the messages to send it."""
+        messages = self._model_input(
+            history,
+            update.get("summary", state.get("summary", "")),
+            update.get("summarized", state.get("summarized", 0)),
+            sender,
+        )
+        metrics.observe("gabriela_history_messages", len(history), SIZE_BUCKETS)
+        return self._select_model(messages), messages
+
+    def _model_update(
+        self,
+        tier: str,
+        messages: List[BaseMessage],
+        response: Union[BaseMessage, Exception],
+        latency: float,
+        update: dict,
+    ) -> dict:
+        if isinstance(response, Exception):
+            return {"messages": [self._failure_reply(response)], **update}
+        self._record_usage(tier, messages, response, latency)
+        return {"messages": [response], **update}
+
+    def _call_model(self, state: AgentState, config: RunnableConfig) -> dict:
+        sender = config.get("configurable", {}).get("thread_id")
+        history = self._history(state)
+        update = {}
+        if request := self._summary_request(state, history):
+            fold, summary, folded = request
+            try:
+                summary = self.governor.call(
+                    sender, lambda: self._context_policy.summarize(summary, folded)
+                )
+            except Exception as e:
+                summary = e
+            update = self._summary_update(fold, summary)
+        tier, messages = self._model_request(state, history, update, sender)
+        start = time.perf_counter()
         try:
-            response = self._model.invoke(state["messages"])
-            return {"messages": [response]}
+            with metrics.span("model", model=self.model_names[tier]):
+                response = self.governor.call(
+                    sender, lambda: self._models[tier].invoke(messages)
+                )
         except Exception as e:
-            # Log the error and return an error message
-            print(f"Error invoking model: {str(e)}")
-            return {"messages": [HumanMessage(content=f"Error: {str(e)}")]}
+            response = e
+        latency = time.perf_counter() - start
+        return self._model_update(tier, messages, response, latency, update)
+
+    async def _acall_model(self, state: AgentState, config: RunnableConfig) -> dict:
+        sender = config.get("configurable", {}).get("thread_id")
+        history = self._history(state)
+        update = {}
+        if request := self._summary_request(state, history):
+            fold, summary, folded = request
+            try:
+                summary = await self.governor.acall(
+                    sender, lambda: self._context_policy.asummarize(summary, folded)
+                )
+            except Exception as e:
+                summary = e
+            update = self._summary_update(fold, summary)
+        tier, messages = self._model_request(state, history, update, sender)
+        start = time.perf_counter()
+        try:
+            with metrics.span("model", model=self.model_names[tier]):
+                response = await self.governor.acall(
+                    sender, lambda: self._models[tier].ainvoke(messages)
+                )
+        except Exception as e:
+            response = e
+        latency = time.perf_counter() - start
+        return self._model_update(tier, messages, response, latency, update)
+
+    def _route(self, state: AgentState, config: RunnableConfig) -> dict:
+        return {"messages": self.router.route(state["messages"], config)}
+
+    async def _aroute(self, state: AgentState, config: RunnableConfig) -> dict:
+        return {"messages": await self.router.aroute(state["messages"], config)}
+
+    def _after_route(self, state: AgentState) -> Literal["agent", END]:
+        # The router either answered the turn or left it untouched for the model
+        if isinstance(state["messages"][-1], AIMessage):
+            return END
+        return "agent"
 
     def _should_continue(self, state: AgentState) -> Literal["tools", END]:
         messages = state["messages"]
@@ -49,6 +369,20 @@ class Agent:
         # Otherwise, we stop (reply to the user)
         return END
 
+    @staticmethod
+    def _timed_node(name: str, func, afunc) -> RunnableLambda:
+        """Node running ``func`` or ``afunc`` and timing it."""
+
+        def run(state: AgentState, config: RunnableConfig):
+            with metrics.span("node", node=name):
+                return func(state, config)
+
+        async def arun(state: AgentState, config: RunnableConfig):
+            with metrics.span("node", node=name):
+                return await afunc(state, config)
+
+        return RunnableLambda(run, afunc=arun, name=name)
+
     def _build_graph(self):
 
         tool_node = ToolNode(self._tools)
@@ -57,8 +391,13 @@ class Agent:
         workflow = StateGraph(AgentState)
 
         # Add nodes
-        workflow.add_node("agent", self._call_model)
-        workflow.add_node("tools", tool_node)
+        # Register both implementations so the graph can run under invoke and ainvoke
+        workflow.add_node(
+            "agent", self._timed_node("agent", self._call_model, self._acall_model)
+        )
+        workflow.add_node(
+            "tools", self._timed_node("tools", tool_node.invoke, tool_node.ainvoke)
+        )
         workflow.add_conditional_edges(
             # First, we define the start node. We use `agent`.
             # This means these are the edges taken after the `agent` node is called.
@@ -71,19 +410,82 @@ class Agent:
         workflow.add_edge("tools", "agent")
 
         # Set the entry point
-        workflow.set_entry_point("agent")
-
-        # Initialize memory to persist state between graph runs
-        checkpointer = MemorySaver()
+        if self.router:
+            workflow.add_node(
+                "router", self._timed_node("router", self._route, self._aroute)
+            )
+            workflow.add_conditional_edges("router", self._after_route)
+            workflow.set_entry_point("router")
+        else:
+            workflow.set_entry_point("agent")
 
-        # Compile the graph
-        self._graph = workflow.compile(checkpointer=checkpointer)
+        # Compile the graph, the checkpointer persists state between graph runs
+        self._graph = workflow.compile(checkpointer=self._checkpointer)
 
-    def invoke(self, id, message: str, image_url: Optional[str] = None):
+    @staticmethod
+    def _build_input(message: str, image_urls: Sequence[Optional[str]] = ()) -> dict:
         content: List[Dict[str, Any]] = [{"type": "text", "text": message}]
-        if image_url:
-            content.append({"type": "image_url", "image_url": image_url})
-        return self._graph.invoke(
-            input={"messages": [HumanMessage(content=content)]},
-            config={"configurable": {"thread_id": id}},
+        for image_url in image_urls:
+            if image_url:
+                content.append({"type": "image_url", "image_url": image_url})
+        return {"messages": [HumanMessage(content=content)]}
+
+    def _cacheable(self, image_urls: Sequence[Optional[str]]) -> bool:
+        return self.answers is not None and not any(image_urls)
+
+    @staticmethod
+    def _cached_turn(message: str, reply: str) -> dict:
+        return {
+            "messages": [
+                HumanMessage(content=[{"type": "text", "text": message}]),
+                AIMessage(content=reply),
+            ]
+        }
+
+    def invoke(
+        self,
+        id,
+        message: str,
+        image_url: Optional[str] = None,
+        image_urls: Sequence[str] = (),
+    ):
+        config = {"configurable": {"thread_id": id}}
+        image_urls = [image_url, *image_urls]
+        key = self.answers.key(message, id) if self._cacheable(image_urls) else None
+        if key is not None and (reply := self.answers.get(key)) is not None:
+            # Keep the conversation complete without running the graph
+            self._graph.update_state(
+                config, self._cached_turn(message, reply), as_node="agent"
+            )
+            return self._graph.get_state(config).values
+        versions = self.answers.versions() if self.answers else {}
+        result = self._graph.invoke(
+            input=self._build_input(message, image_urls), config=config
+        )
+        if self.answers:
+            self.answers.record(key, versions, turn_messages(result["messages"]))
+        return result
+
+    async def ainvoke(
+        self,
+        id,
+        message: str,
+        image_url: Optional[str] = None,
+        image_urls: Sequence[str] = (),
+    ):
+        config = {"configurable": {"thread_id": id}}
+        image_urls = [image_url, *image_urls]
+        key = self.answers.key(message, id) if self._cacheable(image_urls) else None
+        if key is not None and (reply := self.answers.get(key)) is not None:
+            # Keep the conversation complete without running the graph
+            await self._graph.aupdate_state(
+                config, self._cached_turn(message, reply), as_node="agent"
+            )
+            return (await self._graph.aget_state(config)).values
+        versions = self.answers.versions() if self.answers else {}
+        result = await self._graph.ainvoke(
+            input=self._build_input(message, image_urls), config=config
         )
+        if self.answers:
+            self.answers.record(key, versions, turn_messages(result["messages"]))
+        return result
@@ -0,0 +1,216 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import date
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
+
+from .governor import BUSY_REPLY, MODEL_ERROR_REPLY
+from .mongo import multi_worker
+from .prompt import TEAM_MEMBERS
+from .router import normalize
+
+# Collections read and written by each tool
+READ_TOOLS = {
+    "get_expenses": "expenses",
+    "get_meals": "meals",
+    "get_cannot_go_to_office_irl": "out_of_office",
+    "get_expense_totals": "expenses",
+    "count_out_of_office_days": "out_of_office",
+    "get_meal_frequency": "meals",
+}
+WRITE_TOOLS = {
+    "expense_tracker": "expenses",
+    "cancel_pending_expenses": "expenses",
+    "set_meal": "meals",
+    "set_cannot_go_to_office_irl": "out_of_office",
+}
+
+
+def turn_messages(messages: Sequence[BaseMessage]) -> List[BaseMessage]:
+    """The messages added after the last user message of a history."""
+    for i in range(len(messages) - 1, -1, -1):
+        if isinstance(messages[i], HumanMessage):
+            return list(messages[i + 1 :])
+    return list(messages)
+
+
+# Words that make a question depend on who asks it ("mis gastos")
+PERSONAL_WORDS = set(
+    "yo me mi mis mio mia mios mias conmigo gaste pague debo tengo voy vengo comi".split()
+)
+# Words that point back to an earlier message ("¿y esos de cuándo son?")
+FOLLOW_UP_WORDS = set(
+    "eso esos esa esas ese ahi mismo misma tambien anterior otro otra otros otras "
+    "entonces".split()
+)
+
+
+def follow_up(text: str) -> bool:
+    """
+    Whether a normalized message only makes sense after the previous ones,
+    like "¿y ayer?", "sí" or "¿cuánto suman esos?".
+    """
+    words = text.split()
+    return (
+        len(words) < 2
+        or words[0] in ("y", "e", "si", "no", "ok", "dale")
+        or any(word in FOLLOW_UP_WORDS for word in words)
+    )
+
+
+def _failed(message: BaseMessage) -> bool:
+    """Whether a message is the result of a tool call that failed."""
+    return isinstance(message, ToolMessage) and (
+        message.status == "error"
+        or (isinstance(message.content, str) and message.content.startswith("Error"))
+    )
+
+
+@dataclass
+class _Answer:
+    reply: str
+    versions: Dict[str, int]
+    expires_at: float
+
+
+class AnswerCache:
+    """
+    Replies to questions that were already answered from the same data.
+
+    A turn is cached when it only used read tools and none of them failed. Its
+    key is the normalized message and the current date, plus the team member
+    asking when the question is about themselves ("¿cuánto gasté?"), so the
+    same question from anyone in the team is answered once. Follow-ups that
+    need the earlier messages to make sense are neither looked up nor cached.
+    The entry keeps the version of every collection it read. Each collection's
+    version is bumped when a turn runs one of its write tools, which makes the
+    answers built from it miss. The TTL bounds how stale answers can get when
+    the data is changed from outside the app.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 256,
+        ttl: float = 600.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._clock = clock
+        self._answers: OrderedDict[Tuple, _Answer] = OrderedDict()
+        self._versions = {collection: 0 for collection in READ_TOOLS.values()}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stored": 0, "invalidations": 0}
+
+    @staticmethod
+    def key(message: str, sender: Optional[str]) -> Optional[Tuple]:
+        """
+        :return: The cache key of a message, None if it can't be cached
+        """
+        text = normalize(message)
+        if not text or follow_up(text):
+            return None
+        who = None
+        if any(word in PERSONAL_WORDS for word in text.split()):
+            who = TEAM_MEMBERS.get(sender, sender)
+            if not who:
+                return None
+        return text, date.today().isoformat(), who
+
+    def versions(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._versions)
+
+    def get(self, key: Tuple) -> Optional[str]:
+        with self._lock:
+            answer = self._answers.get(key)
+            if answer and (
+                answer.expires_at <= self._clock()
+                or any(self._versions[c] != v for c, v in answer.versions.items())
+            ):
+                del self._answers[key]
+                answer = None
+            if not answer:
+                self._stats["misses"] += 1
+                return None
+            self._answers.move_to_end(key)
+            self._stats["hits"] += 1
+            return answer.reply
+
+    def record(
+        self,
+        key: Optional[Tuple],
+        versions: Dict[str, int],
+        messages: Sequence[BaseMessage],
+    ):
+        """
+        Learns from a finished turn.
+
+        :param key: Key of the turn, None if it can't be cached
+        :param versions: Collection versions from before the turn started
+        :param messages: Messages the turn added after the user message
+        """
+        calls = [
+            call
+            for message in messages
+            if isinstance(message, AIMessage)
+            for call in message.tool_calls
+        ]
+        written = {WRITE_TOOLS[c["name"]] for c in calls if c["name"] in WRITE_TOOLS}
+        with self._lock:
+            for collection in written:
+                self._versions[collection] += 1
+                self._stats["invalidations"] += 1
+            reply = messages[-1] if messages else None
+            if (
+                key is None
+                or not calls
+                or any(call["name"] not in READ_TOOLS for call in calls)
+                or any(_failed(message) for message in messages)
+                or not isinstance(reply, AIMessage)
+                or not isinstance(reply.content, str)
+                or not reply.content
+                or reply.content in (BUSY_REPLY, MODEL_ERROR_REPLY)
+            ):
+                return
+            read = {READ_TOOLS[call["name"]] for call in calls}
+            self._answers[key] = _Answer(
+                reply=reply.content,
+                versions={collection: versions[collection] for collection in read},
+                expires_at=self._clock() + self.ttl,
+            )
+            self._answers.move_to_end(key)
+            self._stats["stored"] += 1
+            while len(self._answers) > self.max_entries:
+                self._answers.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            **self._stats,
+            "entries": len(self._answers),
+            "hit_ratio": self._stats["hits"] / lookups if lookups else None,
+        }
+
+
+def build_answer_cache() -> Optional[AnswerCache]:
+    """
+    Builds the answer cache configured through environment variables.
+
+    ``ANSWER_CACHE_MAX_ENTRIES`` bounds the cached answers (0 disables the
+    cache, the default with ``WORKER_MODE=multi``) and
+    ``ANSWER_CACHE_TTL_SECONDS`` sets how long they are kept.
+    """
+    max_entries = int(
+        os.getenv("ANSWER_CACHE_MAX_ENTRIES", "0" if multi_worker() else "256")
+    )
+    if max_entries <= 0:
+        return None
+    return AnswerCache(
+        max_entries=max_entries,
+        ttl=float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "600")),
+    )
@@ -0,0 +1,141 @@
+import hashlib
+import zlib
+from typing import Any, Dict, Iterable, Optional, Tuple, Type
+
+import msgpack
+from langchain_core.messages import (
+    AIMessage,
+    BaseMessage,
+    ChatMessage,
+    FunctionMessage,
+    HumanMessage,
+    SystemMessage,
+    ToolMessage,
+)
+from langgraph.checkpoint.base import SerializerProtocol
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+
+# msgpack extension codes
+_MESSAGE = 1
+_OTHER = 2
+
+MESSAGE_TYPES: Dict[str, Type[BaseMessage]] = {
+    cls.model_fields["type"].default: cls
+    for cls in (
+        AIMessage,
+        ChatMessage,
+        FunctionMessage,
+        HumanMessage,
+        SystemMessage,
+        ToolMessage,
+    )
+}
+
+
+def text_id(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+
+def _compact(values: Dict[str, Any]) -> Dict[str, Any]:
+    """Drops the unset fields, which are most of the ones of a message."""
+    return {
+        k: v
+        for k, v in values.items()
+        if v is not None
+        and v is not False
+        and not (isinstance(v, (str, dict, list)) and not v)
+    }
+
+
+class CompactSerializer(SerializerProtocol):
+    """
+    Serializer that keeps checkpoints small.
+
+    Messages are packed with msgpack as their non-empty fields only, instead of
+    the class path and every field LangGraph's default serializer stores. The
+    copy of the tool calls OpenAI leaves in ``additional_kwargs`` is dropped,
+    since ``tool_calls`` has the same data and is what goes back to the model.
+    A system message with one of the ``static_texts`` (the agent prompt) is
+    stored as a reference to it. Values bigger than ``compress_over`` bytes are
+    compressed with zlib, and anything that isn't a message is handed to
+    ``fallback``, which also reads the checkpoints written before this one was
+    enabled.
+
+    References to a text that is no longer in ``static_texts`` are read back
+    as empty system messages, which the agent leaves out of the history.
+    """
+
+    def __init__(
+        self,
+        static_texts: Iterable[str] = (),
+        compress_over: int = 512,
+        level: int = 6,
+        fallback: Optional[SerializerProtocol] = None,
+    ):
+        self.static_texts = {text_id(text): text for text in static_texts}
+        self._static_ids = {text: id for id, text in self.static_texts.items()}
+        self.compress_over = compress_over
+        self.level = level
+        self.fallback = fallback or JsonPlusSerializer()
+
+    def _message_fields(self, message: BaseMessage) -> Dict[str, Any]:
+        fields = _compact(message.model_dump(exclude={"type", "content"}))
+        if isinstance(message, AIMessage) and message.tool_calls:
+            fields.get("additional_kwargs", {}).pop("tool_calls", None)
+        for key in ("additional_kwargs", "response_metadata"):
+            if key in fields:
+                fields[key] = _compact(fields[key])
+        fields = _compact(fields)
+        fields["type"] = message.type
+        if (
+            isinstance(message, SystemMessage)
+            and isinstance(message.content, str)
+            and message.content in self._static_ids
+        ):
+            fields["static"] = self._static_ids[message.content]
+        else:
+            fields["content"] = message.content
+        return fields
+
+    def _default(self, obj: Any) -> msgpack.ExtType:
+        if isinstance(obj, BaseMessage):
+            return msgpack.ExtType(_MESSAGE, self._pack(self._message_fields(obj)))
+        return msgpack.ExtType(_OTHER, self._pack(list(self.fallback.dumps_typed(obj))))
+
+    def _ext_hook(self, code: int, data: bytes) -> Any:
+        if code == _MESSAGE:
+            fields = self._unpack(data)
+            if (id := fields.pop("static", None)) is not None:
+                fields["content"] = self.static_texts.get(id, "")
+            return MESSAGE_TYPES[fields.pop("type")](**fields)
+        if code == _OTHER:
+            return self.fallback.loads_typed(tuple(self._unpack(data)))
+        return msgpack.ExtType(code, data)
+
+    def _pack(self, obj: Any) -> bytes:
+        return msgpack.packb(obj, default=self._default, use_bin_type=True)
+
+    def _unpack(self, data: bytes) -> Any:
+        return msgpack.unpackb(
+            data, ext_hook=self._ext_hook, raw=False, strict_map_key=False
+        )
+
+    def dumps(self, obj: Any) -> bytes:
+        return self._pack(obj)
+
+    def loads(self, data: bytes) -> Any:
+        return self._unpack(data)
+
+    def dumps_typed(self, obj: Any) -> Tuple[str, bytes]:
+        data = self._pack(obj)
+        if len(data) > self.compress_over:
+            return "compact+zlib", zlib.compress(data, self.level)
+        return "compact", data
+
+    def loads_typed(self, data: Tuple[str, bytes]) -> Any:
+        type_, payload = data
+        if type_ == "compact+zlib":
+            return self._unpack(zlib.decompress(payload))
+        if type_ == "compact":
+            return self._unpack(payload)
+        return self.fallback.loads_typed(data)
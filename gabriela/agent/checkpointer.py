@@ -0,0 +1,639 @@
+import asyncio
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from dotenv import load_dotenv
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    SerializerProtocol,
+    get_checkpoint_id,
+)
+from langgraph.checkpoint.serde.types import TASKS
+
+from .checkpoint_serde import CompactSerializer
+from .prompt import AGENT_PROMPT
+
+load_dotenv()
+
+# (type, payload) pairs as produced by SerializerProtocol.dumps_typed
+Typed = Tuple[str, bytes]
+
+
+@dataclass
+class StoredCheckpoint:
+    """Serialized latest checkpoint of a thread/namespace and its pending writes."""
+
+    checkpoint_id: str
+    checkpoint: Typed
+    metadata: Typed
+    parent_checkpoint_id: Optional[str] = None
+    # Sends written against the parent checkpoint, kept so the parent can be dropped
+    pending_sends: list = field(default_factory=list)
+    # (task_id, idx) -> (task_id, channel, value)
+    writes: Dict[Tuple[str, int], Tuple[str, str, Typed]] = field(default_factory=dict)
+    # Values of the append only channel, one per item, when stored apart
+    items: Optional[List[Typed]] = None
+    # How many of them were already stored with the parent checkpoint
+    stored_items: int = 0
+
+
+class LatestCheckpointSaver(BaseCheckpointSaver, ABC):
+    """
+    Base for savers that only keep the latest checkpoint of every thread.
+
+    The agent never travels back in time, so older checkpoints are dropped as
+    soon as a new one is written. That keeps storage proportional to the number
+    of conversations instead of the number of steps they've taken. Subclasses
+    implement ``_load``, ``_save``, ``_save_writes`` and ``_thread_ids``.
+
+    When ``append_channel`` is given, the values of that channel (the messages,
+    which only grow through an ``add`` reducer) are serialized one by one and
+    kept apart from the rest of the checkpoint. A step then only serializes and
+    stores the values added since its parent checkpoint.
+    """
+
+    def __init__(
+        self,
+        *,
+        serde: Optional[SerializerProtocol] = None,
+        append_channel: Optional[str] = None,
+    ):
+        super().__init__(serde=serde)
+        self.append_channel = append_channel
+
+    @abstractmethod
+    def _load(self, thread_id: str, checkpoint_ns: str) -> Optional[StoredCheckpoint]:
+        pass
+
+    @abstractmethod
+    def _save(self, thread_id: str, checkpoint_ns: str, stored: StoredCheckpoint):
+        pass
+
+    @abstractmethod
+    def _save_writes(
+        self,
+        thread_id: str,
+        checkpoint_ns: str,
+        checkpoint_id: str,
+        writes: Dict[Tuple[str, int], Tuple[str, str, Typed]],
+    ):
+        pass
+
+    @abstractmethod
+    def _thread_ids(self) -> Iterator[Tuple[str, str]]:
+        pass
+
+    def _to_tuple(
+        self, thread_id: str, checkpoint_ns: str, stored: StoredCheckpoint
+    ) -> CheckpointTuple:
+        checkpoint = self.serde.loads_typed(stored.checkpoint)
+        if stored.items is not None:
+            checkpoint["channel_values"][self.append_channel] = [
+                self.serde.loads_typed(item) for item in stored.items
+            ]
+        return CheckpointTuple(
+            config={
+                "configurable": {
+                    "thread_id": thread_id,
+                    "checkpoint_ns": checkpoint_ns,
+                    "checkpoint_id": stored.checkpoint_id,
+                }
+            },
+            checkpoint={
+                **checkpoint,
+                "pending_sends": [
+                    self.serde.loads_typed(s) for s in stored.pending_sends
+                ],
+            },
+            metadata=self.serde.loads_typed(stored.metadata),
+            pending_writes=[
+                (task_id, channel, self.serde.loads_typed(value))
+                for task_id, channel, value in stored.writes.values()
+            ],
+            parent_config=(
+                {
+                    "configurable": {
+                        "thread_id": thread_id,
+                        "checkpoint_ns": checkpoint_ns,
+                        "checkpoint_id": stored.parent_checkpoint_id,
+                    }
+                }
+                if stored.parent_checkpoint_id
+                else None
+            ),
+        )
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        stored = self._load(thread_id, checkpoint_ns)
+        if not stored:
+            return None
+        checkpoint_id = get_checkpoint_id(config)
+        if checkpoint_id and checkpoint_id != stored.checkpoint_id:
+            # Only the latest checkpoint is kept
+            return None
+        return self._to_tuple(thread_id, checkpoint_ns, stored)
+
+    def list(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[CheckpointTuple]:
+        if config:
+            checkpoint_ns = config["configurable"].get("checkpoint_ns")
+            keys = [(config["configurable"]["thread_id"], checkpoint_ns or "")]
+        else:
+            keys = list(self._thread_ids())
+        before_id = get_checkpoint_id(before) if before else None
+        for thread_id, checkpoint_ns in keys:
+            if limit is not None and limit <= 0:
+                break
+            tuple_ = self.get_tuple(
+                {
+                    "configurable": {
+                        "thread_id": thread_id,
+                        "checkpoint_ns": checkpoint_ns,
+                    }
+                }
+            )
+            if not tuple_:
+                continue
+            if (
+                before_id
+                and tuple_.config["configurable"]["checkpoint_id"] >= before_id
+            ):
+                continue
+            if filter and not all(
+                tuple_.metadata.get(key) == value for key, value in filter.items()
+            ):
+                continue
+            if limit is not None:
+                limit -= 1
+            yield tuple_
+
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        c = checkpoint.copy()
+        c.pop("pending_sends", None)  # type: ignore[misc]
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        parent_checkpoint_id = config["configurable"].get("checkpoint_id")
+        pending_sends = []
+        parent = None
+        if parent_checkpoint_id:
+            parent = self._load(thread_id, checkpoint_ns)
+            if parent and parent.checkpoint_id == parent_checkpoint_id:
+                pending_sends = [
+                    value
+                    for _, channel, value in parent.writes.values()
+                    if channel == TASKS
+                ]
+            else:
+                parent = None
+        items, stored_items = None, 0
+        if self.append_channel in c.get("channel_values", {}):
+            c["channel_values"] = dict(c["channel_values"])
+            values = c["channel_values"].pop(self.append_channel)
+            items, stored_items = self._items(values, parent)
+        self._save(
+            thread_id,
+            checkpoint_ns,
+            StoredCheckpoint(
+                checkpoint_id=checkpoint["id"],
+                checkpoint=self.serde.dumps_typed(c),
+                metadata=self.serde.dumps_typed(metadata),
+                parent_checkpoint_id=parent_checkpoint_id,
+                pending_sends=pending_sends,
+                items=items,
+                stored_items=stored_items,
+            ),
+        )
+        return {
+            "configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint["id"],
+            }
+        }
+
+    def _items(
+        self, values: list, parent: Optional[StoredCheckpoint]
+    ) -> Tuple[List[Typed], int]:
+        """
+        Serialized values of the append only channel, reusing the ones of the
+        parent checkpoint when the new values start with them.
+
+        :return: The values and how many of them come from the parent
+        """
+        previous = parent.items if parent and parent.items is not None else []
+        count = len(previous)
+        # The reducer only appends, checking the last shared value is enough to
+        # tell the history wasn't replaced
+        if (
+            count
+            and count <= len(values)
+            and self.serde.dumps_typed(values[count - 1]) == tuple(previous[-1])
+        ):
+            return previous + [self.serde.dumps_typed(v) for v in values[count:]], count
+        return [self.serde.dumps_typed(v) for v in values], 0
+
+    def put_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[Tuple[str, Any]],
+        task_id: str,
+    ) -> None:
+        self._save_writes(
+            config["configurable"]["thread_id"],
+            config["configurable"]["checkpoint_ns"],
+            config["configurable"]["checkpoint_id"],
+            {
+                (task_id, WRITES_IDX_MAP.get(channel, idx)): (
+                    task_id,
+                    channel,
+                    self.serde.dumps_typed(value),
+                )
+                for idx, (channel, value) in enumerate(writes)
+            },
+        )
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        tuples = await asyncio.to_thread(
+            lambda: [*self.list(config, filter=filter, before=before, limit=limit)]
+        )
+        for tuple_ in tuples:
+            yield tuple_
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        return await asyncio.to_thread(
+            self.put, config, checkpoint, metadata, new_versions
+        )
+
+    async def aput_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[Tuple[str, Any]],
+        task_id: str,
+    ) -> None:
+        return await asyncio.to_thread(self.put_writes, config, writes, task_id)
+
+
+class BoundedMemorySaver(LatestCheckpointSaver):
+    """
+    In-memory saver with a cap on the number of threads and idle eviction.
+
+    Threads are kept in least-recently-used order: once ``max_threads`` is
+    reached the least recently used one is dropped, and threads idle for more
+    than ``ttl`` seconds are dropped on the next access.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_threads: int = 500,
+        ttl: Optional[float] = None,
+        serde: Optional[SerializerProtocol] = None,
+        append_channel: Optional[str] = None,
+    ):
+        super().__init__(serde=serde, append_channel=append_channel)
+        self.max_threads = max_threads
+        self.ttl = ttl
+        # thread_id -> (last access, checkpoint NS -> stored checkpoint)
+        self._threads: OrderedDict[str, Tuple[float, Dict[str, StoredCheckpoint]]] = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def _evict(self, now: float):
+        if self.ttl is not None:
+            while self._threads:
+                thread_id, (last_access, _) = next(iter(self._threads.items()))
+                if now - last_access <= self.ttl:
+                    break
+                del self._threads[thread_id]
+                self.evictions += 1
+        while len(self._threads) > self.max_threads:
+            self._threads.popitem(last=False)
+            self.evictions += 1
+
+    def _touch(self, thread_id: str) -> Optional[Dict[str, StoredCheckpoint]]:
+        now = time.monotonic()
+        self._evict(now)
+        if thread_id not in self._threads:
+            return None
+        _, namespaces = self._threads.pop(thread_id)
+        self._threads[thread_id] = (now, namespaces)
+        return namespaces
+
+    def _load(self, thread_id: str, checkpoint_ns: str) -> Optional[StoredCheckpoint]:
+        with self._lock:
+            namespaces = self._touch(thread_id)
+            return namespaces.get(checkpoint_ns) if namespaces else None
+
+    def _save(self, thread_id: str, checkpoint_ns: str, stored: StoredCheckpoint):
+        with self._lock:
+            namespaces = self._touch(thread_id)
+            if namespaces is None:
+                namespaces = {}
+                self._threads[thread_id] = (time.monotonic(), namespaces)
+                self._evict(time.monotonic())
+            namespaces[checkpoint_ns] = stored
+
+    def _save_writes(self, thread_id, checkpoint_ns, checkpoint_id, writes):
+        with self._lock:
+            namespaces = self._touch(thread_id)
+            stored = namespaces.get(checkpoint_ns) if namespaces else None
+            if stored and stored.checkpoint_id == checkpoint_id:
+                stored.writes.update(writes)
+
+    def _thread_ids(self) -> Iterator[Tuple[str, str]]:
+        with self._lock:
+            keys = [
+                (thread_id, checkpoint_ns)
+                for thread_id, (_, namespaces) in self._threads.items()
+                for checkpoint_ns in namespaces
+            ]
+        return iter(keys)
+
+    def forget(self, thread_id: str):
+        """Drops a thread from memory."""
+        with self._lock:
+            self._threads.pop(thread_id, None)
+
+    @property
+    def thread_count(self) -> int:
+        # Not __len__: an empty saver must stay truthy for LangGraph
+        return len(self._threads)
+
+    # Everything happens in memory, no need to go through a worker thread
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return self.get_tuple(config)
+
+    async def aput(self, config, checkpoint, metadata, new_versions) -> RunnableConfig:
+        return self.put(config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id) -> None:
+        return self.put_writes(config, writes, task_id)
+
+
+class MongoDBSaver(LatestCheckpointSaver):
+    """
+    Persists the latest checkpoint of every thread in MongoDB.
+
+    Each thread/namespace is a single document in the ``checkpoints`` collection
+    of the ``gabriela`` database, replaced on every step and expired by a TTL
+    index after ``ttl`` seconds without activity. With an ``append_channel``
+    its values live in the ``items`` array of the document, and a step only
+    pushes the ones it added. A ``BoundedMemorySaver`` is
+    used as a write-through cache in front of the collection so active threads
+    are served from memory.
+
+    Uses the shared ``MongoRegistry`` client unless a database is given. Any
+    pymongo compatible ``Database`` can be passed in, which allows using a local
+    stand-in such as mongomock instead of a real server.
+    """
+
+    def __init__(
+        self,
+        db=None,
+        *,
+        collection: str = "checkpoints",
+        ttl: Optional[int] = None,
+        cache: Optional[BoundedMemorySaver] = None,
+        serde: Optional[SerializerProtocol] = None,
+        append_channel: Optional[str] = None,
+    ):
+        super().__init__(serde=serde, append_channel=append_channel)
+        self.db = db
+        self.collection_name = collection
+        self.ttl = ttl
+        self.cache = cache
+        self._ready = False
+
+    @property
+    def collection(self):
+        if self.db is None:
+            from .mongo import mongo
+
+            self.db = mongo.database()
+        collection = self.db[self.collection_name]
+        if not self._ready:
+            self._setup(collection)
+        return collection
+
+    def _setup(self, collection):
+        """Creates the lookup and TTL indexes. Safe to call more than once."""
+        from pymongo.errors import OperationFailure
+
+        collection.create_index(
+            [("thread_id", 1), ("checkpoint_ns", 1)], unique=True, name="thread"
+        )
+        if self.ttl:
+            try:
+                collection.create_index(
+                    "updated_at", expireAfterSeconds=self.ttl, name="idle_ttl"
+                )
+            except OperationFailure:
+                # The index exists with a different TTL, update it in place
+                self.db.command(
+                    "collMod",
+                    self.collection_name,
+                    index={"name": "idle_ttl", "expireAfterSeconds": self.ttl},
+                )
+        self._ready = True
+
+    @staticmethod
+    def _key(thread_id: str, checkpoint_ns: str) -> dict:
+        return {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns}
+
+    @staticmethod
+    def _write_key(task_id: str, idx: int) -> str:
+        return f"{task_id}:{idx}"
+
+    def _from_document(self, doc: dict) -> StoredCheckpoint:
+        return StoredCheckpoint(
+            checkpoint_id=doc["checkpoint_id"],
+            checkpoint=(doc["type"], doc["checkpoint"]),
+            metadata=(doc["metadata_type"], doc["metadata"]),
+            parent_checkpoint_id=doc.get("parent_checkpoint_id"),
+            pending_sends=[
+                (s["type"], s["value"]) for s in doc.get("pending_sends", [])
+            ],
+            writes={
+                (w["task_id"], w["idx"]): (
+                    w["task_id"],
+                    w["channel"],
+                    (w["type"], w["value"]),
+                )
+                for w in doc.get("writes", {}).values()
+            },
+            items=(
+                [(i["type"], i["value"]) for i in doc["items"]]
+                if "items" in doc
+                else None
+            ),
+        )
+
+    def _load(self, thread_id: str, checkpoint_ns: str) -> Optional[StoredCheckpoint]:
+        if self.cache is not None and (
+            stored := self.cache._load(thread_id, checkpoint_ns)
+        ):
+            return stored
+        doc = self.collection.find_one(self._key(thread_id, checkpoint_ns))
+        if not doc:
+            return None
+        stored = self._from_document(doc)
+        if self.cache is not None:
+            self.cache._save(thread_id, checkpoint_ns, stored)
+        return stored
+
+    def _save(self, thread_id: str, checkpoint_ns: str, stored: StoredCheckpoint):
+        fields = {
+            "checkpoint_id": stored.checkpoint_id,
+            "parent_checkpoint_id": stored.parent_checkpoint_id,
+            "type": stored.checkpoint[0],
+            "checkpoint": stored.checkpoint[1],
+            "metadata_type": stored.metadata[0],
+            "metadata": stored.metadata[1],
+            "pending_sends": [
+                {"type": type_, "value": value} for type_, value in stored.pending_sends
+            ],
+            "writes": {},
+            "updated_at": datetime.now(timezone.utc),
+        }
+        items = [{"type": type_, "value": value} for type_, value in stored.items or []]
+        appended = None
+        if stored.stored_items:
+            # Only push the new items onto the parent's document, as long as
+            # nobody replaced it in the meantime
+            appended = self.collection.update_one(
+                {
+                    **self._key(thread_id, checkpoint_ns),
+                    "checkpoint_id": stored.parent_checkpoint_id,
+                    f"items.{stored.stored_items - 1}": {"$exists": True},
+                    f"items.{stored.stored_items}": {"$exists": False},
+                },
+                {
+                    "$set": fields,
+                    "$push": {"items": {"$each": items[stored.stored_items :]}},
+                },
+            )
+        if appended is None or not appended.matched_count:
+            self.collection.replace_one(
+                self._key(thread_id, checkpoint_ns),
+                {
+                    **self._key(thread_id, checkpoint_ns),
+                    **fields,
+                    **({"items": items} if stored.items is not None else {}),
+                },
+                upsert=True,
+            )
+        if self.cache is not None:
+            self.cache._save(thread_id, checkpoint_ns, stored)
+
+    def _save_writes(self, thread_id, checkpoint_ns, checkpoint_id, writes):
+        self.collection.update_one(
+            {**self._key(thread_id, checkpoint_ns), "checkpoint_id": checkpoint_id},
+            {
+                "$set": {
+                    **{
+                        f"writes.{self._write_key(task_id, idx)}": {
+                            "task_id": task_id,
+                            "idx": idx,
+                            "channel": channel,
+                            "type": value[0],
+                            "value": value[1],
+                        }
+                        for (task_id, idx), (_, channel, value) in writes.items()
+                    },
+                    "updated_at": datetime.now(timezone.utc),
+                }
+            },
+        )
+        if self.cache is not None:
+            self.cache._save_writes(thread_id, checkpoint_ns, checkpoint_id, writes)
+
+    def _thread_ids(self) -> Iterator[Tuple[str, str]]:
+        for doc in self.collection.find({}, {"thread_id": 1, "checkpoint_ns": 1}):
+            yield doc["thread_id"], doc["checkpoint_ns"]
+
+
+def build_checkpointer() -> BaseCheckpointSaver:
+    """
+    Builds the checkpointer configured through environment variables.
+
+    ``CHECKPOINTER`` selects ``memory`` or ``mongo`` (the default with
+    ``WORKER_MODE=multi``), ``CHECKPOINT_MAX_THREADS`` caps the threads kept in
+    memory and ``CHECKPOINT_TTL_SECONDS`` sets how long an idle thread is kept.
+    With several workers MongoDB is read on every turn, since the thread may
+    have moved forward on another worker since this one cached it.
+
+    ``CHECKPOINT_FORMAT=compact`` stores checkpoints with the
+    ``CompactSerializer`` and only writes the messages added by every step.
+    Checkpoints written in the default format can still be read.
+    """
+    from .mongo import multi_worker
+
+    max_threads = int(os.getenv("CHECKPOINT_MAX_THREADS", "500"))
+    ttl = int(os.getenv("CHECKPOINT_TTL_SECONDS", str(7 * 24 * 60 * 60)))
+    options: Dict[str, Any] = {}
+    if os.getenv("CHECKPOINT_FORMAT", "default") == "compact":
+        options = {
+            "serde": CompactSerializer(static_texts=[AGENT_PROMPT]),
+            "append_channel": "messages",
+        }
+    memory = BoundedMemorySaver(max_threads=max_threads, ttl=ttl, **options)
+    default = "mongo" if multi_worker() else "memory"
+    if os.getenv("CHECKPOINTER", default) == "mongo":
+        return MongoDBSaver(
+            ttl=ttl, cache=None if multi_worker() else memory, **options
+        )
+    return memory
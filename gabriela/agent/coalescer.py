@@ -0,0 +1,87 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+
+@dataclass
+class _Burst:
+    texts: List[str] = field(default_factory=list)
+    image_urls: List[str] = field(default_factory=list)
+    started_at: float = field(default_factory=time.monotonic)
+    last_at: float = field(default_factory=time.monotonic)
+    last_position: int = 0
+    result: Optional[asyncio.Future] = None
+
+
+class MessageCoalescer:
+    """
+    Merges the messages a sender sends in quick succession into a single turn.
+
+    A turn starts once the sender has been quiet for ``window`` seconds, or
+    ``max_wait`` seconds after the first message of the burst, and receives the
+    texts of all the messages joined by new lines along with all their images.
+    Only the caller that submitted the last message of a burst gets the result;
+    the others get None, since their messages are answered by it.
+    """
+
+    def __init__(
+        self,
+        turn: Callable[[str, str, List[str]], Awaitable[Any]],
+        window: float = 1.5,
+        max_wait: float = 5.0,
+    ):
+        self.turn = turn
+        self.window = window
+        self.max_wait = max_wait
+        self._bursts: Dict[str, _Burst] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._stats = {"messages": 0, "turns": 0}
+
+    async def submit(
+        self, sender: str, text: str, image_url: Optional[str] = None
+    ) -> Optional[Any]:
+        burst = self._bursts.get(sender)
+        if burst is None:
+            burst = self._bursts[sender] = _Burst(
+                result=asyncio.get_running_loop().create_future()
+            )
+            task = asyncio.create_task(self._run(sender, burst))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        if text:
+            burst.texts.append(text)
+        if image_url:
+            burst.image_urls.append(image_url)
+        burst.last_at = time.monotonic()
+        self._stats["messages"] += 1
+        position = self._stats["messages"]
+        burst.last_position = position
+
+        # Shielded so a caller going away doesn't cancel the turn of the others
+        result = await asyncio.shield(burst.result)
+        return result if burst.last_position == position else None
+
+    async def _run(self, sender: str, burst: _Burst):
+        while True:
+            deadline = min(
+                burst.last_at + self.window, burst.started_at + self.max_wait
+            )
+            if (delay := deadline - time.monotonic()) <= 0:
+                break
+            await asyncio.sleep(delay)
+        # Messages arriving from now on start a new burst
+        del self._bursts[sender]
+        self._stats["turns"] += 1
+        try:
+            burst.result.set_result(
+                await self.turn(sender, "\n".join(burst.texts), burst.image_urls)
+            )
+        except asyncio.CancelledError:
+            burst.result.cancel()
+            raise
+        except Exception as e:
+            burst.result.set_exception(e)
+
+    def stats(self) -> dict:
+        return {**self._stats, "waiting": len(self._bursts)}
@@ -0,0 +1,162 @@
+import json
+from typing import Callable, List, Optional, Sequence
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import (
+    AIMessage,
+    BaseMessage,
+    HumanMessage,
+    SystemMessage,
+    ToolMessage,
+)
+
+SUMMARY_PROMPT = """Resumí la siguiente conversación entre Gabriela (asistente del equipo de Pampa Labs) y un miembro del equipo.
+Conservá los datos que puedan hacer falta más adelante: nombres, fechas, montos, gastos, comidas y ausencias registradas o consultadas, y pedidos pendientes.
+Respondé solo con el resumen, en pocas líneas.
+
+Resumen previo:
+{summary}
+
+Conversación nueva:
+{transcript}"""
+
+# Rough cost of an image in a vision request (a high detail receipt photo)
+IMAGE_TOKENS = 800
+
+
+def approximate_token_count(messages: Sequence[BaseMessage]) -> int:
+    """Cheap token estimate (~4 characters per token) that needs no tokenizer."""
+    total = 0
+    for message in messages:
+        total += 4  # role and message framing
+        content = message.content
+        if isinstance(content, str):
+            total += len(content) // 4
+        else:
+            for part in content:
+                if isinstance(part, str):
+                    total += len(part) // 4
+                elif part.get("type") == "image_url":
+                    total += IMAGE_TOKENS
+                else:
+                    total += len(part.get("text", "")) // 4
+        if isinstance(message, AIMessage) and message.tool_calls:
+            total += len(json.dumps([c["args"] for c in message.tool_calls])) // 4
+    return total
+
+
+def message_text(message: BaseMessage) -> str:
+    """Text of a message, with images replaced by a placeholder."""
+    if isinstance(message.content, str):
+        return message.content
+    texts = []
+    for part in message.content:
+        if isinstance(part, str):
+            texts.append(part)
+        elif part.get("type") == "image_url":
+            texts.append("[imagen]")
+        else:
+            texts.append(part.get("text", ""))
+    return " ".join(texts)
+
+
+def _transcript(messages: Sequence[BaseMessage]) -> str:
+    lines = []
+    for message in messages:
+        if isinstance(message, HumanMessage):
+            lines.append(f"Usuario: {message_text(message)}")
+        elif isinstance(message, ToolMessage):
+            lines.append(f"Herramienta {message.name}: {message_text(message)}")
+        elif isinstance(message, AIMessage):
+            for call in message.tool_calls:
+                lines.append(
+                    f"Gabriela llama a {call['name']}({json.dumps(call['args'])})"
+                )
+            if text := message_text(message):
+                lines.append(f"Gabriela: {text}")
+    return "\n".join(lines)
+
+
+class ContextPolicy:
+    """
+    Decides which part of the conversation history is sent to the model.
+
+    The system prompt is always sent, followed by the most recent turns that fit
+    in ``max_tokens``. Turns are kept or dropped whole, so the window always
+    starts at a user message, and the latest one is always kept. When a
+    ``summarizer`` model is given, turns that fall out of the window are folded
+    into a rolling summary kept in the graph state. Folding shrinks the window to
+    ``fold_ratio`` of the budget, so the summary is only recomputed every few
+    turns and only over the messages that were folded since the last time.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = 3000,
+        summarizer: Optional[BaseChatModel] = None,
+        token_counter: Callable[[Sequence[BaseMessage]], int] = approximate_token_count,
+        fold_ratio: float = 0.5,
+    ):
+        self.max_tokens = max_tokens
+        self.summarizer = summarizer
+        self.token_counter = token_counter
+        self.fold_ratio = fold_ratio
+
+    def _window_start(self, history: List[BaseMessage], start: int, budget: int) -> int:
+        """Earliest index >= start whose suffix fits in the budget, on a turn boundary."""
+        last_human = max(
+            (i for i, m in enumerate(history) if isinstance(m, HumanMessage)),
+            default=start,
+        )
+        end = max(last_human, start)
+        sizes = [self.token_counter([message]) for message in history[start:]]
+        remaining = sum(sizes)
+        for i in range(start, end):
+            # Only cut where a turn starts, so the window never opens with the
+            # answer or tool results of a question it left out
+            if remaining <= budget and isinstance(history[i], HumanMessage):
+                return i
+            remaining -= sizes[i - start]
+        return end
+
+    def plan(self, history: List[BaseMessage], summarized: int) -> int:
+        """
+        Returns how many messages of the history should be folded into the summary.
+
+        :param history: Conversation messages, without system messages
+        :param summarized: How many of them are already part of the summary
+        """
+        if (
+            sum(self.token_counter([m]) for m in history[summarized:])
+            <= self.max_tokens
+        ):
+            return summarized
+        return self._window_start(
+            history, summarized, int(self.max_tokens * self.fold_ratio)
+        )
+
+    def window(self, history: List[BaseMessage], summarized: int) -> List[BaseMessage]:
+        """The messages that fit in the budget, starting after the summarized ones."""
+        return history[self._window_start(history, summarized, self.max_tokens) :]
+
+    def _summary_request(self, summary: str, messages: Sequence[BaseMessage]):
+        return [
+            HumanMessage(
+                content=SUMMARY_PROMPT.format(
+                    summary=summary or "(vacío)", transcript=_transcript(messages)
+                )
+            )
+        ]
+
+    def summarize(self, summary: str, messages: Sequence[BaseMessage]) -> str:
+        return self.summarizer.invoke(self._summary_request(summary, messages)).content
+
+    async def asummarize(self, summary: str, messages: Sequence[BaseMessage]) -> str:
+        response = await self.summarizer.ainvoke(
+            self._summary_request(summary, messages)
+        )
+        return response.content
+
+    @staticmethod
+    def summary_message(summary: str) -> SystemMessage:
+        return SystemMessage(content=f"Resumen de la conversación anterior:\n{summary}")
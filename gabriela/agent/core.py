@@ -1,11 +1,46 @@
-from typing import Any, Dict
+import os
+from typing import Any, Dict, List
 
 from .agent import Agent
+from .coalescer import MessageCoalescer
+from .leases import build_sender_leases
+from .scheduler import SenderScheduler
 
 
 class WhatsAppAgent:
-    def __init__(self):
+    def __init__(
+        self, max_workers: int | None = None, coalesce_window: float | None = None
+    ):
         self.agent = Agent()
+        self.scheduler = SenderScheduler(
+            max_workers or int(os.getenv("AGENT_MAX_CONCURRENCY", "4")),
+            leases=build_sender_leases(),
+        )
+        # Opt-in: merge the messages a sender sends in a row into a single turn
+        if coalesce_window is None:
+            coalesce_window = float(os.getenv("AGENT_COALESCE_WINDOW_MS", "0")) / 1000
+        self.coalescer = (
+            MessageCoalescer(
+                self._run_turn,
+                window=coalesce_window,
+                max_wait=float(os.getenv("AGENT_COALESCE_MAX_WAIT_MS", "5000")) / 1000,
+            )
+            if coalesce_window > 0
+            else None
+        )
+        # Turns allowed to wait for a worker before new messages are turned away
+        self.max_queued = int(os.getenv("AGENT_MAX_QUEUED_TURNS", "100"))
+
+    def overloaded(self) -> bool:
+        """
+        Whether new messages should be turned away instead of queued: too many
+        turns are already waiting, or the model is failing fast anyway.
+        """
+        if self.agent.governor.breaker.state == "open":
+            return True
+        return bool(self.max_queued) and (
+            self.scheduler.stats()["queued"] >= self.max_queued
+        )
 
     def handle_message(self, message: Dict[str, Any]) -> Dict[str, Any]:
         """
@@ -36,3 +71,48 @@ class WhatsAppAgent:
         :return: Response to be sent back to the user
         """
         return self.agent.invoke(id=sender, message=content, image_url=image_url)
+
+    async def ahandle_message(self, message: Dict[str, Any]) -> Dict[str, Any] | None:
+        """
+        Async entrypoint for handling incoming WhatsApp messages.
+
+        :param message: A dictionary containing message details
+        :return: Response to be sent back to the user, None when the message is
+            answered along with a later one
+        """
+        sender = message.get("from")
+        content = message.get("text", "")
+        image_url = message.get("image_url")
+
+        return await self.aprocess_message(sender, content, image_url)
+
+    async def aprocess_message(
+        self, sender: str, content: str, image_url: str | None
+    ) -> Dict[str, Any] | None:
+        """
+        Process the incoming message without blocking the event loop.
+
+        Turns are scheduled so that messages from the same sender are answered
+        one at a time, in order, while other senders are served in parallel.
+        When coalescing is enabled, messages sent in a row are answered with a
+        single turn and only the call with the last of them gets the response.
+
+        :param sender: The sender's identifier
+        :param content: The content of the message
+        :param image_url: The URL of the image, if any
+        :return: Response to be sent back to the user, None when the message is
+            answered along with a later one
+        """
+        if self.coalescer:
+            return await self.coalescer.submit(sender, content, image_url)
+        return await self._run_turn(sender, content, [image_url] if image_url else [])
+
+    async def _run_turn(
+        self, sender: str, content: str, image_urls: List[str]
+    ) -> Dict[str, Any]:
+        return await self.scheduler.run(
+            sender,
+            lambda: self.agent.ainvoke(
+                id=sender, message=content, image_urls=image_urls
+            ),
+        )
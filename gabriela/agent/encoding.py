@@ -0,0 +1,46 @@
+import csv
+import io
+from typing import Iterable, Optional, Sequence
+
+from pydantic import BaseModel
+
+NO_RESULTS = "No results."
+# Last line of a table cut at its limit
+TRUNCATED = "… more rows not listed. Narrow the query to see the rest."
+
+
+def _cell(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, (list, tuple)):
+        return "|".join(_cell(item) for item in value)
+    return str(value)
+
+
+def encode_table(
+    records: Iterable[BaseModel], fields: Sequence[str], limit: Optional[int] = None
+) -> str:
+    """
+    Encodes records as a CSV table with a header row, for tool outputs.
+
+    Only ``fields`` are written, so the model reads each field name once instead
+    of once per record as it would with JSON. List values are joined with ``|``.
+    At most ``limit`` records are written; when there are more (read one over
+    the limit to tell) the table ends with ``TRUNCATED``, so a partial listing
+    isn't taken as complete.
+    """
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator="\n")
+    writer.writerow(fields)
+    rows = 0
+    for record in records:
+        if limit is not None and rows == limit:
+            output.write(TRUNCATED)
+            break
+        writer.writerow([_cell(getattr(record, field)) for field in fields])
+        rows += 1
+    if not rows:
+        return NO_RESULTS
+    return output.getvalue().rstrip("\n")
@@ -1,22 +1,277 @@
-import json
+import asyncio
+import concurrent.futures
 import os
+import threading
+import time
 from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict, defaultdict
+from typing import Callable, Dict, Iterator, List, Literal, Optional, Tuple, Union
 
-from bson import json_util
 from dotenv import load_dotenv
-from pymongo import MongoClient
-from pymongo.server_api import ServerApi
+from pydantic import BaseModel, Field
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+from .models import (
+    CannotGoToOfficeIRL,
+    ExpenseRecord,
+    ExpenseTotal,
+    MealCount,
+    MealPlan,
+    OutOfOfficeCount,
+)
+from .metrics import metrics
+from .mongo import MongoRegistry, mongo, multi_worker
 
 load_dotenv()
 
 
+def date_range(date_from: Optional[str], date_to: Optional[str]) -> dict:
+    """Mongo filter for an inclusive range of YYYY-MM-DD dates."""
+    bounds = {}
+    if date_from:
+        bounds["$gte"] = date_from
+    if date_to:
+        bounds["$lte"] = date_to
+    return {"date": bounds} if bounds else {}
+
+
+class ExpenseQuery(BaseModel):
+    """
+    Filters for retrieving expenses.
+    """
+
+    person: Optional[str] = Field(
+        default=None, description="Team member who paid the expenses."
+    )
+    state: Optional[Literal["pending", "finished"]] = Field(
+        default="pending",
+        description="State of the expenses, pending by default. Null for any state.",
+    )
+    date_from: Optional[str] = Field(
+        default=None, description="Earliest date, inclusive (format: YYYY-MM-DD)."
+    )
+    date_to: Optional[str] = Field(
+        default=None, description="Latest date, inclusive (format: YYYY-MM-DD)."
+    )
+    limit: Optional[int] = Field(
+        default=50, description="Maximum number of expenses to return."
+    )
+
+    def to_mongo(self) -> dict:
+        query = date_range(self.date_from, self.date_to)
+        if self.person:
+            query["id"] = self.person
+        if self.state:
+            query["state"] = self.state
+        return query
+
+
+class MealQuery(BaseModel):
+    """
+    Filters for retrieving meal plans.
+    """
+
+    date: Optional[str] = Field(
+        default=None, description="Exact date of the meal plan (format: YYYY-MM-DD)."
+    )
+    date_from: Optional[str] = Field(
+        default=None, description="Earliest date, inclusive (format: YYYY-MM-DD)."
+    )
+    date_to: Optional[str] = Field(
+        default=None, description="Latest date, inclusive (format: YYYY-MM-DD)."
+    )
+    team_member: Optional[str] = Field(
+        default=None, description="Team member who set the meal plan."
+    )
+    limit: Optional[int] = Field(
+        default=50, description="Maximum number of meal plans to return."
+    )
+
+    def to_mongo(self) -> dict:
+        query = date_range(self.date_from, self.date_to)
+        if self.date:
+            query["date"] = self.date
+        if self.team_member:
+            query["team_member"] = self.team_member
+        return query
+
+
+class OutOfOfficeQuery(BaseModel):
+    """
+    Filters for retrieving the dates team members cannot go to the office IRL.
+    """
+
+    team_member: Optional[str] = Field(
+        default=None, description="Team member who cannot go to the office IRL."
+    )
+    date: Optional[str] = Field(
+        default=None, description="Exact date (format: YYYY-MM-DD)."
+    )
+    date_from: Optional[str] = Field(
+        default=None, description="Earliest date, inclusive (format: YYYY-MM-DD)."
+    )
+    date_to: Optional[str] = Field(
+        default=None, description="Latest date, inclusive (format: YYYY-MM-DD)."
+    )
+    limit: Optional[int] = Field(
+        default=50, description="Maximum number of entries to return."
+    )
+
+    def to_mongo(self) -> dict:
+        query = date_range(self.date_from, self.date_to)
+        if self.date:
+            query["date"] = self.date
+        if self.team_member:
+            query["team_member"] = self.team_member
+        return query
+
+
+class ExpenseTotalsQuery(BaseModel):
+    """
+    Filters and grouping for summing expenses.
+    """
+
+    group_by: List[Literal["person", "expense_type", "month"]] = Field(
+        default=["person"],
+        description="Fields to group the totals by, empty for a single total.",
+    )
+    person: Optional[str] = Field(
+        default=None, description="Only expenses paid by this team member."
+    )
+    state: Optional[Literal["pending", "finished"]] = Field(
+        default=None, description="Only expenses in this state, null for any state."
+    )
+    date_from: Optional[str] = Field(
+        default=None, description="Earliest date, inclusive (format: YYYY-MM-DD)."
+    )
+    date_to: Optional[str] = Field(
+        default=None, description="Latest date, inclusive (format: YYYY-MM-DD)."
+    )
+
+    def filters(self) -> ExpenseQuery:
+        return ExpenseQuery(
+            person=self.person,
+            state=self.state,
+            date_from=self.date_from,
+            date_to=self.date_to,
+            limit=None,
+        )
+
+
+class OutOfOfficeCountQuery(BaseModel):
+    """
+    Filters for counting the days team members cannot go to the office IRL.
+    """
+
+    team_member: Optional[str] = Field(
+        default=None, description="Only count the days of this team member."
+    )
+    date_from: Optional[str] = Field(
+        default=None, description="Earliest date, inclusive (format: YYYY-MM-DD)."
+    )
+    date_to: Optional[str] = Field(
+        default=None, description="Latest date, inclusive (format: YYYY-MM-DD)."
+    )
+
+    def filters(self) -> OutOfOfficeQuery:
+        return OutOfOfficeQuery(
+            team_member=self.team_member,
+            date_from=self.date_from,
+            date_to=self.date_to,
+            limit=None,
+        )
+
+
+class MealFrequencyQuery(BaseModel):
+    """
+    Filters for counting how often each meal was planned.
+    """
+
+    team_member: Optional[str] = Field(
+        default=None, description="Only meals set by this team member."
+    )
+    date_from: Optional[str] = Field(
+        default=None, description="Earliest date, inclusive (format: YYYY-MM-DD)."
+    )
+    date_to: Optional[str] = Field(
+        default=None, description="Latest date, inclusive (format: YYYY-MM-DD)."
+    )
+    limit: Optional[int] = Field(
+        default=10,
+        description="Maximum number of meals to return, most frequent first.",
+    )
+
+    def filters(self) -> MealQuery:
+        return MealQuery(
+            team_member=self.team_member,
+            date_from=self.date_from,
+            date_to=self.date_to,
+            limit=None,
+        )
+
+
+# Indexes backing the queries above, most recent dates first
+INDEXES = {
+    "expenses": [
+        IndexModel([("state", ASCENDING), ("date", DESCENDING)]),
+        IndexModel([("id", ASCENDING), ("state", ASCENDING), ("date", DESCENDING)]),
+    ],
+    "meals": [
+        IndexModel([("date", DESCENDING)]),
+        IndexModel([("team_member", ASCENDING), ("date", DESCENDING)]),
+    ],
+    "out_of_office": [
+        IndexModel([("date", DESCENDING)]),
+        IndexModel([("team_member", ASCENDING), ("date", DESCENDING)]),
+    ],
+}
+
+
+# Fields read back for each record type; "id" is the person an expense belongs to
+PROJECTIONS = {
+    "expenses": {
+        "_id": 0,
+        "id": 1,
+        "expense_type": 1,
+        "date": 1,
+        "total_value": 1,
+        "state": 1,
+    },
+    "meals": {"_id": 0, "meal": 1, "date": 1, "toppings": 1, "team_member": 1},
+    "out_of_office": {"_id": 0, "team_member": 1, "date": 1, "reason": 1},
+}
+
+
+# How expenses are grouped by each ExpenseTotalsQuery.group_by field
+GROUP_FIELDS = {
+    "person": "$id",
+    "expense_type": "$expense_type",
+    "month": {"$substrBytes": ["$date", 0, 7]},
+}
+
+
+def expense_record(document: dict) -> ExpenseRecord:
+    # Leaves the document untouched, callers may keep and read it again
+    fields = {k: v for k, v in document.items() if k != "id"}
+    return ExpenseRecord(person=document["id"], **fields)
+
+
 class StorageStrategy(ABC):
+    """
+    Storage of the team data.
+
+    Reads return typed records: the sync methods stream them from the backend
+    and the async ones return them as a list.
+    """
+
     @abstractmethod
     def add_expense(self, expense: dict):
         pass
 
     @abstractmethod
-    def get_expenses(self, query):
+    def get_expenses(
+        self, query: Optional[ExpenseQuery] = None
+    ) -> Iterator[ExpenseRecord]:
         pass
 
     @abstractmethod
@@ -24,7 +279,7 @@ class StorageStrategy(ABC):
         pass
 
     @abstractmethod
-    def get_meals(self, query):
+    def get_meals(self, query: Optional[MealQuery] = None) -> Iterator[MealPlan]:
         pass
 
     @abstractmethod
@@ -32,43 +287,316 @@ class StorageStrategy(ABC):
         pass
 
     @abstractmethod
-    def get_out_of_office(self, team_member, date):
+    def get_out_of_office(
+        self, query: Optional[OutOfOfficeQuery] = None
+    ) -> Iterator[CannotGoToOfficeIRL]:
         pass
 
     @abstractmethod
     def cancel_pending_expenses(self):
         pass
 
+    def ensure_indexes(self):
+        """Creates the indexes the queries rely on. Safe to call more than once."""
+        pass
+
+    def insert_many(self, collection: str, documents: List[dict]):
+        """
+        Stores several documents of a collection at once.
+
+        Falls back to one write per document; storages supporting bulk writes
+        should override it.
+        """
+        add = {
+            "expenses": self.add_expense,
+            "meals": self.add_meal,
+            "out_of_office": self.add_out_of_office,
+        }[collection]
+        for document in documents:
+            add(document)
+
+    def flush(self):
+        """Writes any buffered data. Storages that don't buffer have nothing to do."""
+        pass
+
+    # Aggregations return small lists. The defaults compute them from the
+    # records; storages that can aggregate server side should override them.
+
+    def get_expense_totals(
+        self, query: Optional[ExpenseTotalsQuery] = None
+    ) -> List[ExpenseTotal]:
+        query = query or ExpenseTotalsQuery()
+        totals = defaultdict(lambda: [0.0, 0])
+        for expense in self.get_expenses(query.filters()):
+            group = {"month": expense.date[:7], **expense.model_dump()}
+            total = totals[tuple(group[field] for field in query.group_by)]
+            total[0] += expense.total_value
+            total[1] += 1
+        return sorted(
+            (
+                ExpenseTotal(
+                    **dict(zip(query.group_by, key)), total_value=value, count=count
+                )
+                for key, (value, count) in totals.items()
+            ),
+            key=lambda total: -total.total_value,
+        )
+
+    def count_out_of_office(
+        self, query: Optional[OutOfOfficeCountQuery] = None
+    ) -> List[OutOfOfficeCount]:
+        query = query or OutOfOfficeCountQuery()
+        days = Counter(
+            entry.team_member for entry in self.get_out_of_office(query.filters())
+        )
+        return [
+            OutOfOfficeCount(team_member=member, days=count)
+            for member, count in days.most_common()
+        ]
+
+    def get_meal_frequency(
+        self, query: Optional[MealFrequencyQuery] = None
+    ) -> List[MealCount]:
+        query = query or MealFrequencyQuery()
+        counts, last_dates = Counter(), {}
+        for meal in self.get_meals(query.filters()):
+            counts[meal.meal] += 1
+            last_dates[meal.meal] = max(meal.date, last_dates.get(meal.meal, ""))
+        return [
+            MealCount(meal=meal, count=count, last_date=last_dates[meal])
+            for meal, count in counts.most_common(query.limit)
+        ]
+
+    # Async variants. By default they run the sync implementation in a worker
+    # thread so every strategy can be awaited; subclasses with a native async
+    # driver should override them.
+
+    async def aadd_expense(self, expense: dict):
+        return await asyncio.to_thread(self.add_expense, expense)
+
+    async def aget_expenses(
+        self, query: Optional[ExpenseQuery] = None
+    ) -> List[ExpenseRecord]:
+        return await asyncio.to_thread(lambda: list(self.get_expenses(query)))
+
+    async def aadd_meal(self, meal: dict):
+        return await asyncio.to_thread(self.add_meal, meal)
+
+    async def aget_meals(self, query: Optional[MealQuery] = None) -> List[MealPlan]:
+        return await asyncio.to_thread(lambda: list(self.get_meals(query)))
+
+    async def aadd_out_of_office(self, out_of_office: dict):
+        return await asyncio.to_thread(self.add_out_of_office, out_of_office)
+
+    async def aget_out_of_office(
+        self, query: Optional[OutOfOfficeQuery] = None
+    ) -> List[CannotGoToOfficeIRL]:
+        return await asyncio.to_thread(lambda: list(self.get_out_of_office(query)))
+
+    async def acancel_pending_expenses(self):
+        return await asyncio.to_thread(self.cancel_pending_expenses)
+
+    async def aensure_indexes(self):
+        return await asyncio.to_thread(self.ensure_indexes)
+
+    async def ainsert_many(self, collection: str, documents: List[dict]):
+        return await asyncio.to_thread(self.insert_many, collection, documents)
+
+    async def aflush(self):
+        pass
+
+    async def aget_expense_totals(
+        self, query: Optional[ExpenseTotalsQuery] = None
+    ) -> List[ExpenseTotal]:
+        return await asyncio.to_thread(self.get_expense_totals, query)
+
+    async def acount_out_of_office(
+        self, query: Optional[OutOfOfficeCountQuery] = None
+    ) -> List[OutOfOfficeCount]:
+        return await asyncio.to_thread(self.count_out_of_office, query)
+
+    async def aget_meal_frequency(
+        self, query: Optional[MealFrequencyQuery] = None
+    ) -> List[MealCount]:
+        return await asyncio.to_thread(self.get_meal_frequency, query)
+
 
 class MongoDBStorage(StorageStrategy):
-    def __init__(self):
-        self.client = None
+    """
+    Stores the team data in the ``gabriela`` database.
+
+    Connections come from the shared ``MongoRegistry``, so every storage
+    instance uses the same pooled clients.
+    """
+
+    def __init__(self, registry: MongoRegistry = mongo):
+        self.registry = registry
         self.db = None
+        self.async_db = None
 
     def _connect(self):
-        if not self.client:
-            mongo_uri = os.getenv("MONGO_URI")
-            if not mongo_uri:
-                raise ValueError("MONGO_URI environment variable is not set")
-            self.client = MongoClient(mongo_uri, server_api=ServerApi("1"))
-            try:
-                self.client.admin.command("ping")
-                print("Successfully connected to MongoDB!")
-            except Exception as e:
-                print(f"Error connecting to MongoDB: {e}")
-                raise
-            self.db = self.client["gabriela"]
+        if self.db is None:
+            self.db = self.registry.database()
+
+    async def _aconnect(self):
+        if self.async_db is None:
+            self.async_db = self.registry.async_database()
+
+    @staticmethod
+    def _find(collection, query):
+        """Cursor over the documents matching the query, most recent first."""
+        cursor = collection.find(query.to_mongo(), PROJECTIONS[collection.name]).sort(
+            "date", DESCENDING
+        )
+        if query.limit:
+            cursor = cursor.limit(query.limit)
+        return cursor
+
+    def ensure_indexes(self):
+        self._connect()
+        for collection, indexes in INDEXES.items():
+            self.db[collection].create_indexes(indexes)
+
+    async def aensure_indexes(self):
+        await self._aconnect()
+        for collection, indexes in INDEXES.items():
+            await self.async_db[collection].create_indexes(indexes)
+
+    @staticmethod
+    def _expense_totals_pipeline(query: ExpenseTotalsQuery) -> List[dict]:
+        return [
+            {"$match": query.filters().to_mongo()},
+            {
+                "$group": {
+                    # A single group for all of them when there are no fields
+                    "_id": {field: GROUP_FIELDS[field] for field in query.group_by}
+                    or None,
+                    "total_value": {"$sum": "$total_value"},
+                    "count": {"$sum": 1},
+                }
+            },
+            {"$sort": {"total_value": DESCENDING}},
+        ]
+
+    @staticmethod
+    def _out_of_office_count_pipeline(query: OutOfOfficeCountQuery) -> List[dict]:
+        return [
+            {"$match": query.filters().to_mongo()},
+            {"$group": {"_id": "$team_member", "days": {"$sum": 1}}},
+            {"$sort": {"days": DESCENDING, "_id": ASCENDING}},
+        ]
+
+    @staticmethod
+    def _meal_frequency_pipeline(query: MealFrequencyQuery) -> List[dict]:
+        pipeline = [
+            {"$match": query.filters().to_mongo()},
+            {
+                "$group": {
+                    "_id": "$meal",
+                    "count": {"$sum": 1},
+                    "last_date": {"$max": "$date"},
+                }
+            },
+            {"$sort": {"count": DESCENDING, "last_date": DESCENDING}},
+        ]
+        if query.limit:
+            pipeline.append({"$limit": query.limit})
+        return pipeline
+
+    @staticmethod
+    def _expense_total(document: dict) -> ExpenseTotal:
+        return ExpenseTotal(
+            **(document["_id"] or {}),
+            total_value=document["total_value"],
+            count=document["count"],
+        )
+
+    @staticmethod
+    def _out_of_office_count(document: dict) -> OutOfOfficeCount:
+        return OutOfOfficeCount(team_member=document["_id"], days=document["days"])
+
+    @staticmethod
+    def _meal_count(document: dict) -> MealCount:
+        return MealCount(
+            meal=document["_id"],
+            count=document["count"],
+            last_date=document["last_date"],
+        )
+
+    def insert_many(self, collection: str, documents: List[dict]):
+        self._connect()
+        self.db[collection].insert_many(documents)
+
+    async def ainsert_many(self, collection: str, documents: List[dict]):
+        await self._aconnect()
+        await self.async_db[collection].insert_many(documents)
+
+    def get_expense_totals(
+        self, query: Optional[ExpenseTotalsQuery] = None
+    ) -> List[ExpenseTotal]:
+        self._connect()
+        pipeline = self._expense_totals_pipeline(query or ExpenseTotalsQuery())
+        return [
+            self._expense_total(document)
+            for document in self.db["expenses"].aggregate(pipeline)
+        ]
+
+    def count_out_of_office(
+        self, query: Optional[OutOfOfficeCountQuery] = None
+    ) -> List[OutOfOfficeCount]:
+        self._connect()
+        pipeline = self._out_of_office_count_pipeline(query or OutOfOfficeCountQuery())
+        return [
+            self._out_of_office_count(document)
+            for document in self.db["out_of_office"].aggregate(pipeline)
+        ]
+
+    def get_meal_frequency(
+        self, query: Optional[MealFrequencyQuery] = None
+    ) -> List[MealCount]:
+        self._connect()
+        pipeline = self._meal_frequency_pipeline(query or MealFrequencyQuery())
+        return [
+            self._meal_count(document)
+            for document in self.db["meals"].aggregate(pipeline)
+        ]
+
+    async def aget_expense_totals(
+        self, query: Optional[ExpenseTotalsQuery] = None
+    ) -> List[ExpenseTotal]:
+        await self._aconnect()
+        pipeline = self._expense_totals_pipeline(query or ExpenseTotalsQuery())
+        cursor = await self.async_db["expenses"].aggregate(pipeline)
+        return [self._expense_total(document) async for document in cursor]
+
+    async def acount_out_of_office(
+        self, query: Optional[OutOfOfficeCountQuery] = None
+    ) -> List[OutOfOfficeCount]:
+        await self._aconnect()
+        pipeline = self._out_of_office_count_pipeline(query or OutOfOfficeCountQuery())
+        cursor = await self.async_db["out_of_office"].aggregate(pipeline)
+        return [self._out_of_office_count(document) async for document in cursor]
+
+    async def aget_meal_frequency(
+        self, query: Optional[MealFrequencyQuery] = None
+    ) -> List[MealCount]:
+        await self._aconnect()
+        pipeline = self._meal_frequency_pipeline(query or MealFrequencyQuery())
+        cursor = await self.async_db["meals"].aggregate(pipeline)
+        return [self._meal_count(document) async for document in cursor]
 
     def add_expense(self, expense: dict):
         self._connect()
         expenses_collection = self.db["expenses"]
         expenses_collection.insert_one(expense)
 
-    def get_expenses(self, query=None):
+    def get_expenses(
+        self, query: Optional[ExpenseQuery] = None
+    ) -> Iterator[ExpenseRecord]:
         self._connect()
         expenses_collection = self.db["expenses"]
-        results = list(expenses_collection.find({"state": "pending"}))
-        return json.dumps(results, default=json_util.default)
+        cursor = self._find(expenses_collection, query or ExpenseQuery())
+        return (expense_record(document) for document in cursor)
 
     def cancel_pending_expenses(self):
         self._connect()
@@ -82,25 +610,625 @@ class MongoDBStorage(StorageStrategy):
         meals_collection = self.db["meals"]
         meals_collection.insert_one(meal)
 
-    def get_meals(self, query=None):
+    def get_meals(self, query: Optional[MealQuery] = None) -> Iterator[MealPlan]:
         self._connect()
         meals_collection = self.db["meals"]
-
-        results = list(meals_collection.find({}))
-        return json.dumps(results, default=json_util.default)
+        cursor = self._find(meals_collection, query or MealQuery())
+        return (MealPlan(**document) for document in cursor)
 
     def add_out_of_office(self, out_of_office: dict):
         self._connect()
         out_of_office_collection = self.db["out_of_office"]
         out_of_office_collection.insert_one(out_of_office)
 
-    def get_out_of_office(self, team_member=None, date=None):
+    def get_out_of_office(
+        self, query: Optional[OutOfOfficeQuery] = None
+    ) -> Iterator[CannotGoToOfficeIRL]:
         self._connect()
         out_of_office_collection = self.db["out_of_office"]
-        query = {}
-        if team_member:
-            query["team_member"] = team_member
-        if date:
-            query["date"] = date
-        results = list(out_of_office_collection.find(query))
-        return json.dumps(results, default=json_util.default)
+        cursor = self._find(out_of_office_collection, query or OutOfOfficeQuery())
+        return (CannotGoToOfficeIRL(**document) for document in cursor)
+
+    async def aadd_expense(self, expense: dict):
+        await self._aconnect()
+        await self.async_db["expenses"].insert_one(expense)
+
+    async def aget_expenses(
+        self, query: Optional[ExpenseQuery] = None
+    ) -> List[ExpenseRecord]:
+        await self._aconnect()
+        cursor = self._find(self.async_db["expenses"], query or ExpenseQuery())
+        return [expense_record(document) async for document in cursor]
+
+    async def acancel_pending_expenses(self):
+        await self._aconnect()
+        await self.async_db["expenses"].update_many(
+            {"state": "pending"}, {"$set": {"state": "finished"}}
+        )
+
+    async def aadd_meal(self, meal: dict):
+        await self._aconnect()
+        await self.async_db["meals"].insert_one(meal)
+
+    async def aget_meals(self, query: Optional[MealQuery] = None) -> List[MealPlan]:
+        await self._aconnect()
+        cursor = self._find(self.async_db["meals"], query or MealQuery())
+        return [MealPlan(**document) async for document in cursor]
+
+    async def aadd_out_of_office(self, out_of_office: dict):
+        await self._aconnect()
+        await self.async_db["out_of_office"].insert_one(out_of_office)
+
+    async def aget_out_of_office(
+        self, query: Optional[OutOfOfficeQuery] = None
+    ) -> List[CannotGoToOfficeIRL]:
+        await self._aconnect()
+        cursor = self._find(self.async_db["out_of_office"], query or OutOfOfficeQuery())
+        return [CannotGoToOfficeIRL(**document) async for document in cursor]
+
+
+class CachedStorage(StorageStrategy):
+    """
+    Read-through cache in front of another storage.
+
+    Results are cached per query for ``ttl`` seconds, keeping at most
+    ``max_entries`` of them (least recently used are evicted first). Every
+    collection has a version that the write methods bump, and cache keys include
+    it, so a read that raced with a write can never be served afterwards.
+
+    Only writes made through this instance invalidate the cache; the TTL bounds
+    how stale the data written by other processes can get.
+    """
+
+    def __init__(
+        self,
+        storage: StorageStrategy,
+        max_entries: int = 256,
+        ttl: float = 60.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.storage = storage
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._clock = clock
+        self._entries: OrderedDict[Tuple, Tuple[float, list]] = OrderedDict()
+        self._versions: Dict[str, int] = {collection: 0 for collection in PROJECTIONS}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _key(self, collection: str, query: BaseModel) -> Tuple:
+        return (
+            collection,
+            self._versions[collection],
+            type(query).__name__,
+            query.model_dump_json(),
+        )
+
+    def _lookup(self, key: Tuple) -> Optional[list]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] <= self._clock():
+                del self._entries[key]
+                entry = None
+            if entry:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        metrics.inc(
+            "gabriela_storage_cache_lookups_total", result="hit" if entry else "miss"
+        )
+        return entry[1] if entry else None
+
+    def _store(self, key: Tuple, records: list) -> list:
+        evicted = 0
+        with self._lock:
+            if key[1] != self._versions[key[0]]:
+                return records  # Written meanwhile, the result may be stale
+            self._entries[key] = (self._clock() + self.ttl, records)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                evicted += 1
+            self.evictions += evicted
+        if evicted:
+            metrics.inc("gabriela_storage_cache_evictions_total", evicted)
+        return records
+
+    def invalidate(self, collection: str):
+        """Drops the cached results of a collection."""
+        with self._lock:
+            self._versions[collection] += 1
+            for key in [key for key in self._entries if key[0] == collection]:
+                del self._entries[key]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else None,
+        }
+
+    def _get(self, collection: str, query: BaseModel, read) -> Iterator:
+        key = self._key(collection, query)
+        records = self._lookup(key)
+        if records is None:
+            records = self._store(key, list(read(query)))
+        return iter(records)
+
+    async def _aget(self, collection: str, query: BaseModel, read) -> list:
+        key = self._key(collection, query)
+        records = self._lookup(key)
+        if records is None:
+            records = self._store(key, list(await read(query)))
+        return list(records)
+
+    def ensure_indexes(self):
+        self.storage.ensure_indexes()
+
+    def flush(self):
+        self.storage.flush()
+
+    def add_expense(self, expense: dict):
+        self.storage.add_expense(expense)
+        self.invalidate("expenses")
+
+    def get_expenses(
+        self, query: Optional[ExpenseQuery] = None
+    ) -> Iterator[ExpenseRecord]:
+        return self._get("expenses", query or ExpenseQuery(), self.storage.get_expenses)
+
+    def cancel_pending_expenses(self):
+        self.storage.cancel_pending_expenses()
+        self.invalidate("expenses")
+
+    def add_meal(self, meal: dict):
+        self.storage.add_meal(meal)
+        self.invalidate("meals")
+
+    def get_meals(self, query: Optional[MealQuery] = None) -> Iterator[MealPlan]:
+        return self._get("meals", query or MealQuery(), self.storage.get_meals)
+
+    def add_out_of_office(self, out_of_office: dict):
+        self.storage.add_out_of_office(out_of_office)
+        self.invalidate("out_of_office")
+
+    def get_out_of_office(
+        self, query: Optional[OutOfOfficeQuery] = None
+    ) -> Iterator[CannotGoToOfficeIRL]:
+        return self._get(
+            "out_of_office",
+            query or OutOfOfficeQuery(),
+            self.storage.get_out_of_office,
+        )
+
+    def get_expense_totals(
+        self, query: Optional[ExpenseTotalsQuery] = None
+    ) -> List[ExpenseTotal]:
+        return list(
+            self._get(
+                "expenses",
+                query or ExpenseTotalsQuery(),
+                self.storage.get_expense_totals,
+            )
+        )
+
+    def count_out_of_office(
+        self, query: Optional[OutOfOfficeCountQuery] = None
+    ) -> List[OutOfOfficeCount]:
+        return list(
+            self._get(
+                "out_of_office",
+                query or OutOfOfficeCountQuery(),
+                self.storage.count_out_of_office,
+            )
+        )
+
+    def get_meal_frequency(
+        self, query: Optional[MealFrequencyQuery] = None
+    ) -> List[MealCount]:
+        return list(
+            self._get(
+                "meals", query or MealFrequencyQuery(), self.storage.get_meal_frequency
+            )
+        )
+
+    async def aensure_indexes(self):
+        await self.storage.aensure_indexes()
+
+    async def aflush(self):
+        await self.storage.aflush()
+
+    async def aget_expense_totals(
+        self, query: Optional[ExpenseTotalsQuery] = None
+    ) -> List[ExpenseTotal]:
+        return await self._aget(
+            "expenses", query or ExpenseTotalsQuery(), self.storage.aget_expense_totals
+        )
+
+    async def acount_out_of_office(
+        self, query: Optional[OutOfOfficeCountQuery] = None
+    ) -> List[OutOfOfficeCount]:
+        return await self._aget(
+            "out_of_office",
+            query or OutOfOfficeCountQuery(),
+            self.storage.acount_out_of_office,
+        )
+
+    async def aget_meal_frequency(
+        self, query: Optional[MealFrequencyQuery] = None
+    ) -> List[MealCount]:
+        return await self._aget(
+            "meals", query or MealFrequencyQuery(), self.storage.aget_meal_frequency
+        )
+
+    async def aadd_expense(self, expense: dict):
+        await self.storage.aadd_expense(expense)
+        self.invalidate("expenses")
+
+    async def aget_expenses(
+        self, query: Optional[ExpenseQuery] = None
+    ) -> List[ExpenseRecord]:
+        return await self._aget(
+            "expenses", query or ExpenseQuery(), self.storage.aget_expenses
+        )
+
+    async def acancel_pending_expenses(self):
+        await self.storage.acancel_pending_expenses()
+        self.invalidate("expenses")
+
+    async def aadd_meal(self, meal: dict):
+        await self.storage.aadd_meal(meal)
+        self.invalidate("meals")
+
+    async def aget_meals(self, query: Optional[MealQuery] = None) -> List[MealPlan]:
+        return await self._aget("meals", query or MealQuery(), self.storage.aget_meals)
+
+    async def aadd_out_of_office(self, out_of_office: dict):
+        await self.storage.aadd_out_of_office(out_of_office)
+        self.invalidate("out_of_office")
+
+    async def aget_out_of_office(
+        self, query: Optional[OutOfOfficeQuery] = None
+    ) -> List[CannotGoToOfficeIRL]:
+        return await self._aget(
+            "out_of_office",
+            query or OutOfOfficeQuery(),
+            self.storage.aget_out_of_office,
+        )
+
+
+# What the caller of a buffered insert waits on, None when it doesn't wait
+Waiter = Union[asyncio.Future, concurrent.futures.Future, None]
+
+
+def _settle(future: Waiter, error: Optional[Exception]):
+    if future is None or future.done():
+        return
+    if error:
+        future.set_exception(error)
+    else:
+        future.set_result(None)
+
+
+class WriteBehindStorage(StorageStrategy):
+    """
+    Buffers inserts and writes them per collection with ``insert_many``.
+
+    Async inserts are written together ``flush_interval`` seconds after the first
+    one arrives, or as soon as ``max_batch`` of them are waiting, so the tool
+    calls the model makes in a single step end up in one round trip. With
+    ``confirm`` callers wait until their batch is written and get its errors;
+    without it they return right away and failed batches are written again
+    ``retry_interval`` seconds later. Sync inserts are written right away, along
+    with anything buffered.
+
+    Reads and updates of a collection flush it first and wait for the batches
+    of it already being written, so they always see the inserts made before
+    them. Call ``aflush`` at shutdown.
+    """
+
+    def __init__(
+        self,
+        storage: StorageStrategy,
+        flush_interval: float = 0.02,
+        max_batch: int = 100,
+        confirm: bool = True,
+        retry_interval: float = 1.0,
+    ):
+        self.storage = storage
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.confirm = confirm
+        self.retry_interval = retry_interval
+        self._buffers: Dict[str, List[Tuple[dict, Waiter]]] = {
+            collection: [] for collection in PROJECTIONS
+        }
+        # Batches being written per collection, resolved once they are done
+        self._writing: Dict[str, List[concurrent.futures.Future]] = {
+            collection: [] for collection in PROJECTIONS
+        }
+        self._lock = threading.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.documents = 0
+
+    def _buffer(self, collection: str, document: dict, future: Waiter = None) -> int:
+        with self._lock:
+            self._buffers[collection].append((document, future))
+            return len(self._buffers[collection])
+
+    def _take(self, collection: str) -> Tuple[list, concurrent.futures.Future]:
+        written = concurrent.futures.Future()
+        with self._lock:
+            batch, self._buffers[collection] = self._buffers[collection], []
+            if batch:
+                self._writing[collection].append(written)
+        return batch, written
+
+    def _done(
+        self,
+        collection: str,
+        batch: list,
+        written: concurrent.futures.Future,
+        error: Optional[Exception],
+    ):
+        # Nobody is waiting for the unconfirmed ones, retry them later
+        retry = [entry for entry in batch if entry[1] is None] if error else []
+        with self._lock:
+            self._buffers[collection][:0] = retry
+            self._writing[collection].remove(written)
+        written.set_result(None)
+        if retry:
+            self._flush_soon(self.retry_interval)
+        if error:
+            print(f"Error writing {len(batch)} documents to {collection}: {error}")
+        else:
+            self.batches += 1
+            self.documents += len(batch)
+        for _, future in batch:
+            if isinstance(future, asyncio.Future):
+                future.get_loop().call_soon_threadsafe(_settle, future, error)
+            else:
+                _settle(future, error)
+
+    def _flush(self, collection: str):
+        batch, written = self._take(collection)
+        if batch:
+            error = None
+            try:
+                self.storage.insert_many(collection, [doc for doc, _ in batch])
+            except Exception as e:
+                error = e
+            self._done(collection, batch, written, error)
+            if error:
+                raise error
+
+    async def _aflush(self, collection: str):
+        batch, written = self._take(collection)
+        if batch:
+            error = None
+            try:
+                await self.storage.ainsert_many(collection, [doc for doc, _ in batch])
+            except Exception as e:
+                error = e
+            self._done(collection, batch, written, error)
+            if error:
+                raise error
+
+    def _in_flight(self, collection: str) -> List[concurrent.futures.Future]:
+        with self._lock:
+            return list(self._writing[collection])
+
+    def _drain(self, collection: str):
+        """Writes the buffered inserts of a collection and waits for the rest."""
+        self._flush(collection)
+        for written in self._in_flight(collection):
+            written.result()
+
+    async def _adrain(self, collection: str):
+        await self._aflush(collection)
+        for written in self._in_flight(collection):
+            await asyncio.wrap_future(written)
+
+    def flush(self):
+        for collection in self._buffers:
+            self._flush(collection)
+
+    async def aflush(self):
+        for collection in self._buffers:
+            await self._aflush(collection)
+
+    async def _flush_later(self, delay: float):
+        await asyncio.sleep(delay)
+        self._flush_task = None  # Inserts arriving from now on need another flush
+        try:
+            await self.aflush()
+        except Exception:
+            pass  # Already reported to the callers or scheduled again
+
+    def _flush_retry(self):
+        try:
+            self.flush()
+        except Exception:
+            pass  # Scheduled again
+
+    def _flush_soon(self, delay: float):
+        """Flushes every collection in ``delay`` seconds, unless already due."""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Sync inserts run outside the event loop
+            timer = threading.Timer(delay, self._flush_retry)
+            timer.daemon = True
+            timer.start()
+            return
+        if self._flush_task is None:
+            self._flush_task = loop.create_task(self._flush_later(delay))
+
+    def _add(self, collection: str, document: dict):
+        # Another thread may be writing it along with its own batch
+        written = concurrent.futures.Future()
+        self._buffer(collection, document, written)
+        try:
+            self._flush(collection)
+        except Exception:
+            pass  # Reported through the future
+        written.result()
+
+    async def _aadd(self, collection: str, document: dict):
+        future = asyncio.get_running_loop().create_future() if self.confirm else None
+        if self._buffer(collection, document, future) >= self.max_batch:
+            try:
+                await self._aflush(collection)
+            except Exception:
+                pass  # Reported through the future
+        else:
+            self._flush_soon(self.flush_interval)
+        if future is not None:
+            await future
+
+    def ensure_indexes(self):
+        self.storage.ensure_indexes()
+
+    def insert_many(self, collection: str, documents: List[dict]):
+        self.storage.insert_many(collection, documents)
+
+    def add_expense(self, expense: dict):
+        self._add("expenses", expense)
+
+    def get_expenses(
+        self, query: Optional[ExpenseQuery] = None
+    ) -> Iterator[ExpenseRecord]:
+        self._drain("expenses")
+        return self.storage.get_expenses(query)
+
+    def cancel_pending_expenses(self):
+        self._drain("expenses")
+        self.storage.cancel_pending_expenses()
+
+    def add_meal(self, meal: dict):
+        self._add("meals", meal)
+
+    def get_meals(self, query: Optional[MealQuery] = None) -> Iterator[MealPlan]:
+        self._drain("meals")
+        return self.storage.get_meals(query)
+
+    def add_out_of_office(self, out_of_office: dict):
+        self._add("out_of_office", out_of_office)
+
+    def get_out_of_office(
+        self, query: Optional[OutOfOfficeQuery] = None
+    ) -> Iterator[CannotGoToOfficeIRL]:
+        self._drain("out_of_office")
+        return self.storage.get_out_of_office(query)
+
+    def get_expense_totals(
+        self, query: Optional[ExpenseTotalsQuery] = None
+    ) -> List[ExpenseTotal]:
+        self._drain("expenses")
+        return self.storage.get_expense_totals(query)
+
+    def count_out_of_office(
+        self, query: Optional[OutOfOfficeCountQuery] = None
+    ) -> List[OutOfOfficeCount]:
+        self._drain("out_of_office")
+        return self.storage.count_out_of_office(query)
+
+    def get_meal_frequency(
+        self, query: Optional[MealFrequencyQuery] = None
+    ) -> List[MealCount]:
+        self._drain("meals")
+        return self.storage.get_meal_frequency(query)
+
+    async def aensure_indexes(self):
+        await self.storage.aensure_indexes()
+
+    async def ainsert_many(self, collection: str, documents: List[dict]):
+        await self.storage.ainsert_many(collection, documents)
+
+    async def aget_expense_totals(
+        self, query: Optional[ExpenseTotalsQuery] = None
+    ) -> List[ExpenseTotal]:
+        await self._adrain("expenses")
+        return await self.storage.aget_expense_totals(query)
+
+    async def acount_out_of_office(
+        self, query: Optional[OutOfOfficeCountQuery] = None
+    ) -> List[OutOfOfficeCount]:
+        await self._adrain("out_of_office")
+        return await self.storage.acount_out_of_office(query)
+
+    async def aget_meal_frequency(
+        self, query: Optional[MealFrequencyQuery] = None
+    ) -> List[MealCount]:
+        await self._adrain("meals")
+        return await self.storage.aget_meal_frequency(query)
+
+    async def aadd_expense(self, expense: dict):
+        await self._aadd("expenses", expense)
+
+    async def aget_expenses(
+        self, query: Optional[ExpenseQuery] = None
+    ) -> List[ExpenseRecord]:
+        await self._adrain("expenses")
+        return await self.storage.aget_expenses(query)
+
+    async def acancel_pending_expenses(self):
+        await self._adrain("expenses")
+        await self.storage.acancel_pending_expenses()
+
+    async def aadd_meal(self, meal: dict):
+        await self._aadd("meals", meal)
+
+    async def aget_meals(self, query: Optional[MealQuery] = None) -> List[MealPlan]:
+        await self._adrain("meals")
+        return await self.storage.aget_meals(query)
+
+    async def aadd_out_of_office(self, out_of_office: dict):
+        await self._aadd("out_of_office", out_of_office)
+
+    async def aget_out_of_office(
+        self, query: Optional[OutOfOfficeQuery] = None
+    ) -> List[CannotGoToOfficeIRL]:
+        await self._adrain("out_of_office")
+        return await self.storage.aget_out_of_office(query)
+
+
+def build_storage() -> StorageStrategy:
+    """
+    Builds the storage configured through environment variables.
+
+    Reads are cached for ``STORAGE_CACHE_TTL_SECONDS`` (default 60, 0 disables
+    the cache), keeping up to ``STORAGE_CACHE_MAX_ENTRIES`` results. Setting
+    ``STORAGE_WRITE_BEHIND_MS`` batches the inserts made within that many
+    milliseconds, and ``STORAGE_WRITE_CONFIRM=false`` stops callers from waiting
+    for their batch to be written. With ``WORKER_MODE=multi`` the cache is off
+    by default, since it would miss the writes made by other workers.
+    """
+    storage: StorageStrategy = MongoDBStorage()
+    write_behind_ms = float(os.getenv("STORAGE_WRITE_BEHIND_MS", "0"))
+    if write_behind_ms > 0:
+        storage = WriteBehindStorage(
+            storage,
+            flush_interval=write_behind_ms / 1000,
+            confirm=os.getenv("STORAGE_WRITE_CONFIRM", "true").lower() != "false",
+        )
+    ttl = float(os.getenv("STORAGE_CACHE_TTL_SECONDS", "0" if multi_worker() else "60"))
+    if ttl <= 0:
+        return storage
+    return CachedStorage(
+        storage,
+        max_entries=int(os.getenv("STORAGE_CACHE_MAX_ENTRIES", "256")),
+        ttl=ttl,
+    )
+
+
+# Storage used by every tool, backed by the shared MongoDB clients. Defined here
+# so the server can flush it without importing the tools.
+shared_storage: StorageStrategy = build_storage()
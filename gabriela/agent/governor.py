@@ -0,0 +1,368 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+T = TypeVar("T")
+
+# Replies used instead of the model's when it can't be reached
+BUSY_REPLY = (
+    "Sorry, I'm handling too many messages right now. "
+    "Please try again in a few minutes."
+)
+MODEL_ERROR_REPLY = "Sorry, I couldn't answer that. Please try again in a moment."
+
+# Statuses worth retrying besides 5xx: timeouts, conflicts and rate limits
+RETRYABLE_STATUSES = {408, 409, 429}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the model while the circuit breaker is open."""
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether a failed model call may succeed if it's tried again."""
+    import openai  # Already loaded by the models, kept out of the server imports
+
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status in RETRYABLE_STATUSES or status >= 500
+    return isinstance(error, (openai.APIConnectionError, TimeoutError))
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """Seconds the provider asked to wait before retrying, if it said so."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    Limits calls to ``rate`` per second with bursts of up to ``capacity``.
+
+    Every call reserves a token, possibly in the future, and waits until it is
+    due, so callers are served in order even when the bucket is empty.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        capacity: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._tokens = capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """Takes a token, returning how long to wait until it's available."""
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self) -> float:
+        if (delay := self._reserve()) > 0:
+            time.sleep(delay)
+        return delay
+
+    async def aacquire(self) -> float:
+        if (delay := self._reserve()) > 0:
+            await asyncio.sleep(delay)
+        return delay
+
+
+class CircuitBreaker:
+    """
+    Stops calling the model after ``failure_threshold`` failures in a row.
+
+    While open every call fails right away. After ``reset_timeout`` seconds a
+    single call is let through: if it succeeds the circuit closes again,
+    otherwise it stays open for another ``reset_timeout``.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self.opened = 0
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if self._clock() - self._opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == "half_open":
+                # Let this call probe the provider and keep the rest out until
+                # it reports back, or for another reset_timeout if it never does
+                self._opened_at = self._clock()
+            return state != "open"
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    self.opened += 1
+                self._opened_at = self._clock()
+
+
+class _SenderSlots:
+    """Calls a sender can have in flight, dropped once none is using them."""
+
+    def __init__(self, semaphore):
+        self.semaphore = semaphore
+        self.users = 0
+
+
+class ModelGovernor:
+    """
+    Admission control for the model calls of every turn.
+
+    A call waits for one of the ``per_sender`` slots of its sender and one of
+    the ``max_concurrency`` global ones, then for the ``rate`` limiter (calls
+    per second, if set). Timeouts, rate limits and 5xx errors are retried up to
+    ``max_retries`` times with full jitter backoff, or after the delay asked by
+    the provider. Calls failing that way feed the ``breaker``, which fails fast
+    while the provider is down. Sync and async calls have separate slots.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        per_sender: int = 1,
+        rate: Optional[float] = None,
+        burst: Optional[float] = None,
+        max_retries: int = 3,
+        base_delay: float = 0.5,
+        max_delay: float = 8.0,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.per_sender = per_sender
+        self.bucket = TokenBucket(rate, burst or max_concurrency) if rate else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker or CircuitBreaker()
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._aslots: Optional[asyncio.Semaphore] = None
+        self._sender_slots: Dict[str, _SenderSlots] = {}
+        self._asender_slots: Dict[str, _SenderSlots] = {}
+        self._lock = threading.Lock()
+        self._active = 0
+        self._waiting = 0
+        self._stats = {
+            "calls": 0,
+            "retries": 0,
+            "failures": 0,
+            "rejected": 0,
+            "throttled_seconds": 0.0,
+        }
+
+    def _backoff(self, attempt: int, error: BaseException) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        return min(self.max_delay, max(delay, retry_after(error) or 0))
+
+    def _reject(self):
+        self._stats["rejected"] += 1
+        raise CircuitOpenError("The model is unavailable, try again later")
+
+    def _admit(self):
+        if not self.breaker.allow():
+            self._reject()
+
+    def _settle(self, error: Optional[BaseException], attempt: int) -> bool:
+        """Records the outcome of an attempt, returning whether to retry it."""
+        if error is None:
+            self.breaker.record_success()
+            return False
+        if not is_retryable(error):
+            # The provider answered, it's the request that is wrong
+            self.breaker.record_success()
+            return False
+        if attempt < self.max_retries and self.breaker.state == "closed":
+            self._stats["retries"] += 1
+            return True
+        self.breaker.record_failure()
+        return False
+
+    def _take_sender(
+        self, slots: Dict[str, _SenderSlots], sender: Optional[str], factory
+    ) -> _SenderSlots:
+        with self._lock:
+            if (slot := slots.get(sender or "")) is None:
+                slot = slots[sender or ""] = _SenderSlots(factory(self.per_sender))
+            slot.users += 1
+            return slot
+
+    def _release_sender(
+        self, slots: Dict[str, _SenderSlots], sender: Optional[str], slot
+    ):
+        with self._lock:
+            slot.users -= 1
+            if not slot.users:
+                # Like the scheduler's locks, so idle senders don't pile up
+                del slots[sender or ""]
+
+    def _count(self, waiting: int = 0, active: int = 0):
+        # Sync calls run in worker threads, so the counters need the lock
+        with self._lock:
+            self._waiting += waiting
+            self._active += active
+
+    @contextmanager
+    def _slot(self, sender: Optional[str]):
+        slot = self._take_sender(self._sender_slots, sender, threading.BoundedSemaphore)
+        self._count(waiting=1)
+        entered = False
+        try:
+            with slot.semaphore, self._slots:
+                self._count(waiting=-1, active=1)
+                entered = True
+                try:
+                    yield
+                finally:
+                    self._count(active=-1)
+        finally:
+            if not entered:
+                self._count(waiting=-1)
+            self._release_sender(self._sender_slots, sender, slot)
+
+    @asynccontextmanager
+    async def _aslot(self, sender: Optional[str]):
+        if self._aslots is None:
+            self._aslots = asyncio.Semaphore(self.max_concurrency)
+        slot = self._take_sender(self._asender_slots, sender, asyncio.Semaphore)
+        self._count(waiting=1)
+        entered = False
+        try:
+            async with slot.semaphore, self._aslots:
+                self._count(waiting=-1, active=1)
+                entered = True
+                try:
+                    yield
+                finally:
+                    self._count(active=-1)
+        finally:
+            if not entered:
+                self._count(waiting=-1)
+            self._release_sender(self._asender_slots, sender, slot)
+
+    def call(self, sender: Optional[str], call: Callable[[], T]) -> T:
+        """Runs a model call for a sender under the limits, retrying it if needed."""
+        if self.breaker.state == "open":
+            self._reject()  # Fail fast instead of queueing for a slot
+        with self._slot(sender):
+            attempt = 0
+            while True:
+                self._admit()
+                if self.bucket:
+                    self._stats["throttled_seconds"] += self.bucket.acquire()
+                self._stats["calls"] += 1
+                try:
+                    result = call()
+                except Exception as e:
+                    if not self._settle(e, attempt):
+                        self._stats["failures"] += 1
+                        raise
+                    time.sleep(self._backoff(attempt, e))
+                    attempt += 1
+                    continue
+                self._settle(None, attempt)
+                return result
+
+    async def acall(self, sender: Optional[str], call: Callable[[], Awaitable[T]]) -> T:
+        if self.breaker.state == "open":
+            self._reject()  # Fail fast instead of queueing for a slot
+        async with self._aslot(sender):
+            attempt = 0
+            while True:
+                self._admit()
+                if self.bucket:
+                    self._stats["throttled_seconds"] += await self.bucket.aacquire()
+                self._stats["calls"] += 1
+                try:
+                    result = await call()
+                except Exception as e:
+                    if not self._settle(e, attempt):
+                        self._stats["failures"] += 1
+                        raise
+                    await asyncio.sleep(self._backoff(attempt, e))
+                    attempt += 1
+                    continue
+                self._settle(None, attempt)
+                return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            active, waiting = self._active, self._waiting
+            senders = len(self._sender_slots) + len(self._asender_slots)
+        return {
+            **self._stats,
+            "active": active,
+            "waiting": waiting,
+            "circuit": self.breaker.state,
+            "circuit_opened": self.breaker.opened,
+            "senders": senders,
+        }
+
+
+def build_governor() -> ModelGovernor:
+    """
+    Builds the model call governor configured through environment variables.
+
+    ``MODEL_MAX_CONCURRENCY`` and ``MODEL_MAX_CONCURRENCY_PER_SENDER`` cap the
+    calls in flight, ``MODEL_CALLS_PER_MINUTE`` (0 for no limit) and
+    ``MODEL_BURST`` rate limit them, ``MODEL_MAX_RETRIES`` bounds the retries of
+    a call and ``MODEL_BREAKER_FAILURES`` / ``MODEL_BREAKER_RESET_SECONDS`` tune
+    the circuit breaker.
+    """
+    calls_per_minute = float(os.getenv("MODEL_CALLS_PER_MINUTE", "0"))
+    return ModelGovernor(
+        max_concurrency=int(os.getenv("MODEL_MAX_CONCURRENCY", "8")),
+        per_sender=int(os.getenv("MODEL_MAX_CONCURRENCY_PER_SENDER", "1")),
+        rate=calls_per_minute / 60 if calls_per_minute > 0 else None,
+        burst=float(os.getenv("MODEL_BURST", "0")) or None,
+        max_retries=int(os.getenv("MODEL_MAX_RETRIES", "3")),
+        breaker=CircuitBreaker(
+            failure_threshold=int(os.getenv("MODEL_BREAKER_FAILURES", "5")),
+            reset_timeout=float(os.getenv("MODEL_BREAKER_RESET_SECONDS", "30")),
+        ),
+    )
@@ -0,0 +1,139 @@
+import base64
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import httpx
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Images are passed through untouched without Pillow
+    Image = None
+
+# Scheme of the lightweight references stored in the conversation history
+IMAGE_REF_PREFIX = "image://sha256:"
+
+# gpt-4o fits images in 2048x2048 and then scales the short side down to 768px,
+# anything bigger is just payload
+MAX_LONG_SIDE = 2048
+MAX_SHORT_SIDE = 768
+
+PROCESSED_IMAGE_TEXT = "[imagen enviada por el usuario, ya procesada]"
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+def image_part_url(part) -> Optional[str]:
+    """URL of an ``image_url`` message content part, None for other parts."""
+    if not isinstance(part, dict) or part.get("type") != "image_url":
+        return None
+    image_url = part["image_url"]
+    return image_url["url"] if isinstance(image_url, dict) else image_url
+
+
+async def fetch_image(
+    client: httpx.AsyncClient,
+    url: str,
+    max_bytes: int,
+    auth: Optional[Tuple[str, str]] = None,
+) -> Optional[bytes]:
+    """
+    Streams an image download, giving up as soon as it grows past ``max_bytes``.
+
+    :return: The image bytes, or None if the server didn't return it
+    """
+    async with client.stream("GET", url, auth=auth) as response:
+        if response.status_code != 200:
+            return None
+        length = response.headers.get("Content-Length")
+        if length and int(length) > max_bytes:
+            raise ImageTooLarge(f"Image is {length} bytes, limit is {max_bytes}")
+        buffer = bytearray()
+        async for chunk in response.aiter_bytes():
+            buffer.extend(chunk)
+            if len(buffer) > max_bytes:
+                raise ImageTooLarge(f"Image is larger than {max_bytes} bytes")
+        return bytes(buffer)
+
+
+def shrink_image(data: bytes, quality: int = 80) -> Tuple[bytes, str]:
+    """
+    Downscales an image to the resolution the vision model uses and recompresses it.
+
+    CPU bound, run it in a worker thread from async code.
+
+    :return: The new image bytes and their content type
+    """
+    if Image is None:
+        return data, "image/jpeg"
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)  # Phone pictures come rotated
+        width, height = image.size
+        scale = min(
+            1.0,
+            MAX_LONG_SIDE / max(width, height),
+            MAX_SHORT_SIDE / min(width, height),
+        )
+        if scale < 1.0:
+            image = image.resize(
+                (round(width * scale), round(height * scale)), Image.LANCZOS
+            )
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=quality, optimize=True)
+    return output.getvalue(), "image/jpeg"
+
+
+class ImageStore:
+    """
+    Content addressed image store bounded by total size.
+
+    Images are only needed while the turn that received them is running, so
+    the least recently used ones are dropped once ``max_bytes`` is exceeded.
+    """
+
+    def __init__(self, max_bytes: int = 50 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._images: OrderedDict[str, Tuple[bytes, str]] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def put(self, data: bytes, content_type: str = "image/jpeg") -> str:
+        """Stores an image and returns its reference."""
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            if digest in self._images:
+                self._images.move_to_end(digest)
+            else:
+                self._images[digest] = (data, content_type)
+                self._size += len(data)
+                while self._size > self.max_bytes and len(self._images) > 1:
+                    _, (evicted, _) = self._images.popitem(last=False)
+                    self._size -= len(evicted)
+        return f"{IMAGE_REF_PREFIX}{digest}"
+
+    def get(self, ref: str) -> Optional[Tuple[bytes, str]]:
+        with self._lock:
+            image = self._images.get(ref.removeprefix(IMAGE_REF_PREFIX))
+            if image:
+                self._images.move_to_end(ref.removeprefix(IMAGE_REF_PREFIX))
+            return image
+
+    def to_data_url(self, ref: str) -> Optional[str]:
+        """Resolves a reference into the data URL sent to the model."""
+        if not ref.startswith(IMAGE_REF_PREFIX):
+            return ref  # Already a regular or data URL
+        image = self.get(ref)
+        if not image:
+            return None
+        data, content_type = image
+        return f"data:{content_type};base64,{base64.b64encode(data).decode('utf-8')}"
+
+
+# Store shared by the webhook, which fills it, and the agent, which reads it
+image_store = ImageStore()
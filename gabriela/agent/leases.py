@@ -0,0 +1,144 @@
+import asyncio
+import os
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Optional
+
+from dotenv import load_dotenv
+
+from .mongo import multi_worker
+
+load_dotenv()
+
+
+class MongoSenderLeases:
+    """
+    Per-sender locks shared by every worker process, kept in MongoDB.
+
+    A lease is a document per sender with the worker holding it and when it
+    expires. Taking it is a single upsert that only matches expired leases, so
+    exactly one worker wins; the others poll with exponential backoff until it
+    is released. The holder extends the lease every third of ``ttl`` while its
+    turn runs, so a worker that dies only blocks the sender for up to ``ttl``
+    seconds. Unlike the in-process scheduler, waiters across workers are not
+    served in arrival order.
+    """
+
+    def __init__(
+        self,
+        db=None,
+        *,
+        collection: str = "sender_leases",
+        ttl: float = 60.0,
+        poll_interval: float = 0.05,
+        max_poll_interval: float = 1.0,
+    ):
+        self.db = db
+        self.collection_name = collection
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self._ready = False
+        self._stats = {"acquired": 0, "contended": 0, "lost": 0, "wait_seconds": 0.0}
+
+    async def _collection(self):
+        if self.db is None:
+            from .mongo import mongo
+
+            self.db = mongo.async_database()
+        collection = self.db[self.collection_name]
+        if not self._ready:
+            # Removes the leases of workers that died without releasing them
+            await collection.create_index(
+                "expires_at", expireAfterSeconds=0, name="lease_ttl"
+            )
+            self._ready = True
+        return collection
+
+    def _expiry(self) -> datetime:
+        return datetime.now(timezone.utc) + timedelta(seconds=self.ttl)
+
+    async def _try_acquire(self, sender: str, owner: str) -> bool:
+        from pymongo.errors import DuplicateKeyError
+
+        collection = await self._collection()
+        try:
+            await collection.update_one(
+                {"_id": sender, "expires_at": {"$lte": datetime.now(timezone.utc)}},
+                {"$set": {"owner": owner, "expires_at": self._expiry()}},
+                upsert=True,
+            )
+            return True
+        except DuplicateKeyError:
+            # The lease exists and hasn't expired, another worker holds it
+            return False
+
+    async def acquire(self, sender: str) -> str:
+        """Waits until the sender's lease is free and takes it, returning its owner."""
+        owner = uuid.uuid4().hex
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+        delay = self.poll_interval
+        if not await self._try_acquire(sender, owner):
+            self._stats["contended"] += 1
+            while not await self._try_acquire(sender, owner):
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_poll_interval)
+        self._stats["acquired"] += 1
+        self._stats["wait_seconds"] += loop.time() - started_at
+        return owner
+
+    async def renew(self, sender: str, owner: str) -> bool:
+        """Extends a lease, returning False if it was lost to another worker."""
+        collection = await self._collection()
+        result = await collection.update_one(
+            {"_id": sender, "owner": owner},
+            {"$set": {"expires_at": self._expiry()}},
+        )
+        return result.matched_count == 1
+
+    async def release(self, sender: str, owner: str):
+        collection = await self._collection()
+        await collection.delete_one({"_id": sender, "owner": owner})
+
+    async def _keep_alive(self, sender: str, owner: str):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                if not await self.renew(sender, owner):
+                    self._stats["lost"] += 1
+                    print(f"Lost the lease of {sender}, its turn may overlap")
+                    return
+            except Exception as e:
+                print(f"Error renewing the lease of {sender}: {e}")
+
+    @asynccontextmanager
+    async def hold(self, sender: str) -> AsyncIterator[None]:
+        """Holds the sender's lease while the block runs."""
+        owner = await self.acquire(sender)
+        keep_alive = asyncio.create_task(self._keep_alive(sender, owner))
+        try:
+            yield
+        finally:
+            keep_alive.cancel()
+            try:
+                await self.release(sender, owner)
+            except Exception as e:
+                # It expires on its own after the TTL
+                print(f"Error releasing the lease of {sender}: {e}")
+
+    def stats(self) -> dict:
+        return {**self._stats, "ttl": self.ttl}
+
+
+def build_sender_leases() -> Optional[MongoSenderLeases]:
+    """
+    Builds the cross-worker sender leases, only used with ``WORKER_MODE=multi``.
+
+    ``SENDER_LEASE_TTL_SECONDS`` bounds how long a sender stays blocked by a
+    worker that died in the middle of a turn.
+    """
+    if not multi_worker():
+        return None
+    return MongoSenderLeases(ttl=float(os.getenv("SENDER_LEASE_TTL_SECONDS", "60")))
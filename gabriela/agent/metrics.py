@@ -0,0 +1,205 @@
+import json
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Dict, Iterator, Optional, Tuple
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+# Name -> (type, help) of every metric, in the order they are exported
+METRICS = {
+    "gabriela_stage_seconds": ("histogram", "Time spent in each webhook stage."),
+    "gabriela_node_seconds": ("histogram", "Time spent in each graph node."),
+    "gabriela_model_seconds": ("histogram", "Latency of the model calls."),
+    "gabriela_tool_seconds": ("histogram", "Time spent running each tool."),
+    "gabriela_mongo_seconds": ("histogram", "Latency of the MongoDB operations."),
+    "gabriela_history_messages": (
+        "histogram",
+        "Messages in the conversation history sent to the model.",
+    ),
+    "gabriela_model_tokens_total": ("counter", "Tokens used by the model calls."),
+    "gabriela_errors_total": ("counter", "Errors by stage."),
+    "gabriela_storage_cache_lookups_total": (
+        "counter",
+        "Storage cache lookups by result.",
+    ),
+    "gabriela_storage_cache_evictions_total": (
+        "counter",
+        "Results evicted from the storage cache to make room.",
+    ),
+    "gabriela_storage_cache_entries": ("gauge", "Results in the storage cache."),
+    "gabriela_scheduler_turns": ("gauge", "Agent turns running and queued."),
+    "gabriela_model_calls_in_flight": ("gauge", "Model calls running and waiting."),
+    "gabriela_circuit_open": ("gauge", "Whether the model circuit breaker is open."),
+    "gabriela_agent_ready": ("gauge", "Whether the agent graph has been built."),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+# Id of the webhook request being served and the time of each of its stages
+request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+request_stages: ContextVar[Optional[Dict[str, float]]] = ContextVar(
+    "request_stages", default=None
+)
+
+
+class _Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _format_labels(labels: Labels, **extra: str) -> str:
+    pairs = [*labels, *extra.items()]
+    if not pairs:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in pairs
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class MetricsRegistry:
+    """
+    Counters, gauges and histograms of the process, exported in the Prometheus
+    text format. Labels are passed as keyword arguments and should have few
+    distinct values: never put a sender or a request id in them.
+    """
+
+    def __init__(self):
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._gauges: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, _Histogram]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _labels(labels: Dict[str, object]) -> Labels:
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._labels(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def value(self, name: str, **labels) -> float:
+        """Current value of a counter or gauge, 0 if it was never set."""
+        key = self._labels(labels)
+        with self._lock:
+            series = self._counters.get(name) or self._gauges.get(name) or {}
+            return series.get(key, 0)
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges.setdefault(name, {})[self._labels(labels)] = value
+
+    def observe(
+        self,
+        name: str,
+        value: float,
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+        **labels,
+    ):
+        key = self._labels(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = _Histogram(buckets)
+            series[key].observe(value)
+
+    @contextmanager
+    def span(self, metric: str, **labels) -> Iterator[None]:
+        """
+        Times a block into ``gabriela_<metric>_seconds`` and the breakdown of
+        the current request. Exceptions are counted as errors of the block.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc("gabriela_errors_total", stage=metric)
+            raise
+        finally:
+            self.record(metric, time.perf_counter() - start, **labels)
+
+    def record(self, metric: str, seconds: float, **labels):
+        """Adds a duration measured elsewhere, like ``span`` does."""
+        self.observe(f"gabriela_{metric}_seconds", seconds, **labels)
+        stages = request_stages.get()
+        if stages is not None:
+            key = ":".join([metric, *map(str, labels.values())])
+            stages[key] = stages.get(key, 0.0) + seconds
+
+    def render(self) -> str:
+        with self._lock:
+            lines = []
+            for name, (type_, help_) in METRICS.items():
+                if type_ == "histogram":
+                    series = self._histograms.get(name, {})
+                elif type_ == "counter":
+                    series = self._counters.get(name, {})
+                else:
+                    series = self._gauges.get(name, {})
+                if not series:
+                    continue
+                lines.append(f"# HELP {name} {help_}")
+                lines.append(f"# TYPE {name} {type_}")
+                for labels, value in sorted(series.items()):
+                    if type_ != "histogram":
+                        lines.append(f"{name}{_format_labels(labels)} {value}")
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(
+                        [*value.buckets, "+Inf"], value.counts, strict=True
+                    ):
+                        cumulative += count
+                        bucket_labels = _format_labels(labels, le=str(bound))
+                        lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {value.sum}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def request_context(id: Optional[str] = None) -> Iterator[Dict[str, float]]:
+    """Gives the code running in the block a request id and a stage breakdown."""
+    id_token = request_id.set(id or uuid.uuid4().hex)
+    stages_token = request_stages.set({})
+    try:
+        yield request_stages.get()
+    finally:
+        request_stages.reset(stages_token)
+        request_id.reset(id_token)
+
+
+def log_event(event: str, **fields):
+    """Prints a JSON log line tagged with the current request id."""
+    print(
+        json.dumps(
+            {
+                "ts": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+                "event": event,
+                "request_id": request_id.get(),
+                **fields,
+            },
+            default=str,
+            ensure_ascii=False,
+        )
+    )
+
+
+# Registry used by default everywhere in the app
+metrics = MetricsRegistry()
@@ -0,0 +1,79 @@
+from typing import List, Literal, Optional
+
+from pydantic import BaseModel, Field
+
+
+class Expense(BaseModel):
+    person: str
+    expense_type: str
+    date: str
+    total_value: float
+
+
+class ExpenseRecord(Expense):
+    """
+    An expense as stored, with the state the tracker keeps for it.
+    """
+
+    state: Literal["pending", "finished"] = "pending"
+
+
+class NoArguments(BaseModel):
+    """
+    Arguments of a tool that doesn't take any.
+    """
+
+
+class MealPlan(BaseModel):
+    """
+    Represents a meal plan for a specific date.
+    """
+
+    meal: str = Field(description="The name of the meal.")
+    date: str = Field(description="The date of the meal plan.")
+    toppings: Optional[List[str]] = Field(
+        default=None, description="Optional list of toppings for the meal."
+    )
+    team_member: str = Field(
+        description="The team member who set the meal plan. If not provided by the user, the agent needs to ask for it. 'Assistant' cannot be a team member."
+    )
+
+
+class CannotGoToOfficeIRL(BaseModel):
+    """
+    Represents a date when a team member cannot go to the office in real life (IRL).
+    """
+
+    team_member: str = Field(
+        description="The name of the team member who cannot go to the office IRL."
+    )
+    date: str = Field(
+        description="The date when the team member cannot go to the office IRL (format: YYYY-MM-DD)."
+    )
+    reason: Optional[str] = Field(
+        default=None,
+        description="Optional reason for not being able to go to the office IRL.",
+    )
+
+
+class ExpenseTotal(BaseModel):
+    """
+    Sum of the expenses of a group, grouped by any of person, type and month.
+    """
+
+    person: Optional[str] = None
+    expense_type: Optional[str] = None
+    month: Optional[str] = None
+    total_value: float
+    count: int
+
+
+class OutOfOfficeCount(BaseModel):
+    team_member: str
+    days: int
+
+
+class MealCount(BaseModel):
+    meal: str
+    count: int
+    last_date: str
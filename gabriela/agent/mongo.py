@@ -0,0 +1,154 @@
+import os
+import threading
+from typing import Optional
+
+from dotenv import load_dotenv
+from pymongo import AsyncMongoClient, MongoClient, monitoring
+from pymongo.server_api import ServerApi
+
+from .metrics import metrics
+
+load_dotenv()
+
+DATABASE = "gabriela"
+
+
+def multi_worker() -> bool:
+    """
+    Whether the app runs as several worker processes (``WORKER_MODE=multi``).
+
+    Workers only share what is in MongoDB, so in this mode conversations and
+    per-sender leases are kept there and the in-process caches are off by
+    default, since they can't see the writes made by other workers.
+    """
+    return os.getenv("WORKER_MODE", "single") == "multi"
+
+
+class CommandTimer(monitoring.CommandListener):
+    """Times every MongoDB command into the metrics, by collection and command."""
+
+    def __init__(self):
+        self._collections: dict = {}
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        collection = event.command.get(event.command_name)
+        self._collections[event.request_id] = (
+            collection if isinstance(collection, str) else ""
+        )
+
+    def _record(self, event):
+        metrics.record(
+            "mongo",
+            event.duration_micros / 1_000_000,
+            collection=self._collections.pop(event.request_id, ""),
+            operation=event.command_name,
+        )
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        self._record(event)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        self._record(event)
+        metrics.inc("gabriela_errors_total", stage="mongo")
+
+
+command_timer = CommandTimer()
+
+
+def client_options() -> dict:
+    """
+    Connection pool settings shared by the sync and async clients.
+
+    ``MONGO_MAX_POOL_SIZE`` and ``MONGO_MIN_POOL_SIZE`` size the pool of each
+    client, ``MONGO_TIMEOUT_MS`` bounds server selection and connecting, and
+    ``MONGO_SOCKET_TIMEOUT_MS`` bounds every operation (0 waits forever). Every
+    command is timed by ``command_timer``.
+    """
+    timeout = int(os.getenv("MONGO_TIMEOUT_MS", "5000"))
+    return {
+        "server_api": ServerApi("1"),
+        "maxPoolSize": int(os.getenv("MONGO_MAX_POOL_SIZE", "20")),
+        "minPoolSize": int(os.getenv("MONGO_MIN_POOL_SIZE", "2")),
+        "serverSelectionTimeoutMS": timeout,
+        "connectTimeoutMS": timeout,
+        "socketTimeoutMS": int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "0")) or None,
+        "event_listeners": [command_timer],
+    }
+
+
+class MongoRegistry:
+    """
+    The MongoDB clients of the process, shared by the storage and the checkpointer.
+
+    Clients are created on first use, but the server lifespan connects them at
+    startup so no user turn pays for the handshakes, and closes them at shutdown.
+    """
+
+    def __init__(self, uri: Optional[str] = None, **options):
+        self._uri = uri
+        self._options = options
+        self._client: Optional[MongoClient] = None
+        self._async_client: Optional[AsyncMongoClient] = None
+        self._lock = threading.Lock()
+
+    @property
+    def uri(self) -> str:
+        mongo_uri = self._uri or os.getenv("MONGO_URI")
+        if not mongo_uri:
+            raise ValueError("MONGO_URI environment variable is not set")
+        return mongo_uri
+
+    @property
+    def configured(self) -> bool:
+        return bool(self._uri or os.getenv("MONGO_URI"))
+
+    def client(self) -> MongoClient:
+        with self._lock:
+            if self._client is None:
+                self._client = MongoClient(
+                    self.uri, **{**client_options(), **self._options}
+                )
+            return self._client
+
+    def async_client(self) -> AsyncMongoClient:
+        with self._lock:
+            if self._async_client is None:
+                self._async_client = AsyncMongoClient(
+                    self.uri, **{**client_options(), **self._options}
+                )
+            return self._async_client
+
+    def database(self, name: str = DATABASE):
+        return self.client()[name]
+
+    def async_database(self, name: str = DATABASE):
+        return self.async_client()[name]
+
+    def connect(self):
+        """Connects the sync client, raising if the server can't be reached."""
+        self.client().admin.command("ping")
+
+    async def aconnect(self):
+        """Connects the async client, raising if the server can't be reached."""
+        await self.async_client().admin.command("ping")
+
+    async def ping(self) -> bool:
+        try:
+            await self.aconnect()
+            return True
+        except Exception as e:
+            print(f"MongoDB is not reachable: {e}")
+            return False
+
+    async def aclose(self):
+        with self._lock:
+            client, self._client = self._client, None
+            async_client, self._async_client = self._async_client, None
+        if client is not None:
+            client.close()
+        if async_client is not None:
+            await async_client.close()
+
+
+# Registry used by default everywhere in the app
+mongo = MongoRegistry()
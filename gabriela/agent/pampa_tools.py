@@ -1,20 +1,94 @@
-import json
 import logging
+from contextvars import ContextVar
 from datetime import date
 from typing import Any, Dict, List, Optional, Tuple, Union
 
 import requests
-from bson import json_util
 from langchain.schema.runnable import RunnableConfig
-from langchain_core.messages import FunctionMessage, ToolCall
+from langchain_core.messages import ToolCall
 from langchain_core.tools import BaseTool
-from pydantic import BaseModel, Field
 
-from .expenses_storage import MongoDBStorage, StorageStrategy
+from .encoding import encode_table
+from .expenses_storage import (
+    ExpenseQuery,
+    ExpenseTotalsQuery,
+    MealFrequencyQuery,
+    MealQuery,
+    OutOfOfficeCountQuery,
+    OutOfOfficeQuery,
+    StorageStrategy,
+    shared_storage,
+)
+from .metrics import metrics
+from .models import CannotGoToOfficeIRL, Expense, MealPlan, NoArguments
+
+# Tool instances in tools_list are shared by every concurrent turn, so request
+# data lives in a context variable instead of on the tool itself.
+current_person_id: ContextVar[Optional[str]] = ContextVar(
+    "current_person_id", default=None
+)
 
 
 class PampaBaseTool(BaseTool):
-    person_id: int = None
+    # Storage method the tool runs, its async version has an "a" in front
+    method: str = ""
+    # Start of the text returned to the model when the tool fails
+    error: str = "Error"
+    # Columns of the table a read tool answers with
+    fields: List[str] = []
+
+    @property
+    def person_id(self) -> Optional[str]:
+        """Identifier of the sender whose turn is running this tool."""
+        return current_person_id.get()
+
+    @staticmethod
+    def _count_error(result: Any) -> Any:
+        # Tools report failures as text for the model, count them here
+        content = getattr(result, "content", result)
+        if isinstance(content, str) and content.startswith("Error"):
+            metrics.inc("gabriela_errors_total", stage="tool")
+        return result
+
+    def _request(self, **kwargs) -> Any:
+        """Argument of the storage method for the tool arguments."""
+        return None
+
+    def _response(self, request: Any, result: Any) -> str:
+        """Text for the model with the result of the storage method."""
+        return encode_table(result, self.fields, getattr(request, "limit", None))
+
+    def _error(self, error: Exception) -> str:
+        return f"{self.error}: {str(error)}"
+
+    @staticmethod
+    def _argument(request: Any) -> Any:
+        # One record over the limit tells whether the listing was cut
+        if limit := getattr(request, "limit", None):
+            return request.model_copy(update={"limit": limit + 1})
+        return request
+
+    def _call(self, request: Any):
+        method = getattr(self.storage, self.method)
+        return method() if request is None else method(self._argument(request))
+
+    def _acall(self, request: Any):
+        method = getattr(self.storage, f"a{self.method}")
+        return method() if request is None else method(self._argument(request))
+
+    def _run(self, **kwargs):
+        try:
+            request = self._request(**kwargs)
+            return self._response(request, self._call(request))
+        except Exception as e:
+            return self._error(e)
+
+    async def _arun(self, **kwargs):
+        try:
+            request = self._request(**kwargs)
+            return self._response(request, await self._acall(request))
+        except Exception as e:
+            return self._error(e)
 
     def _prep_run_args(
         self,
@@ -45,27 +119,39 @@ class PampaBaseTool(BaseTool):
         **kwargs: Any,
     ) -> Any:
         tool_input, kwargs = self._prep_run_args(input, config, **kwargs)
-        self.person_id = config.get("metadata", {}).get("thread_id")
-        return self.run(tool_input, **kwargs)
-
+        token = current_person_id.set(config.get("metadata", {}).get("thread_id"))
+        try:
+            with metrics.span("tool", tool=self.name):
+                return self._count_error(self.run(tool_input, **kwargs))
+        finally:
+            current_person_id.reset(token)
 
-class Expense(BaseModel):
-    person: str
-    expense_type: str
-    date: str
-    total_value: float
+    async def ainvoke(
+        self,
+        input: Union[str, Dict, ToolCall],
+        config: Optional[RunnableConfig] = None,
+        **kwargs: Any,
+    ) -> Any:
+        tool_input, kwargs = self._prep_run_args(input, config, **kwargs)
+        token = current_person_id.set(config.get("metadata", {}).get("thread_id"))
+        try:
+            with metrics.span("tool", tool=self.name):
+                return self._count_error(await self.arun(tool_input, **kwargs))
+        finally:
+            current_person_id.reset(token)
 
 
 class ExpenseTrackerTool(PampaBaseTool):
     name: str = "expense_tracker"
     description: str = "Tracks expenses for team members."
     args_schema: type[Expense] = Expense
-    storage: StorageStrategy = MongoDBStorage()
+    storage: StorageStrategy = shared_storage
+    method: str = "add_expense"
+    error: str = "Error adding expense"
 
-    def _run(self, person: str, expense_type: str, date: str, total_value: float):
+    def _request(self, person: str, expense_type: str, date: str, total_value: float):
         """Adds a new expense to the tracker."""
-
-        expense = {
+        return {
             "id": person,
             "expense_type": expense_type,
             "date": date,
@@ -73,71 +159,41 @@ class ExpenseTrackerTool(PampaBaseTool):
             "state": "pending",
         }
 
-        try:
-            self.storage.add_expense(expense)
-            return FunctionMessage(
-                name=self.__class__.__name__, content="Expense added successfully"
-            )
-        except Exception as e:
-            return FunctionMessage(
-                name=self.__class__.__name__, content=f"Error adding expense: {str(e)}"
-            )
+    def _response(self, expense: dict, result) -> str:
+        return "Expense added successfully"
 
 
 class GETExpenseTrackerTool(PampaBaseTool):
     name: str = "get_expenses"
-    description: str = "Retrieves all pending expenses"
-    storage: StorageStrategy = MongoDBStorage()
+    description: str = (
+        "Retrieves expenses, only pending ones by default, optionally filtered by person and date range."
+    )
+    args_schema: type[ExpenseQuery] = ExpenseQuery
+    storage: StorageStrategy = shared_storage
+    fields: List[str] = ["date", "person", "expense_type", "total_value"]
+    method: str = "get_expenses"
+    error: str = "Error retrieving expenses"
 
-    def _run(self, query, config):
-        """Retrieves expenses based on the provided query."""
-        try:
-            expenses = self.storage.get_expenses(query)
-            expenses_json = json.loads(expenses)
-            return FunctionMessage(
-                name=self.__class__.__name__,
-                content=json.dumps(expenses_json, ensure_ascii=False),
-            )
-        except Exception as e:
-            return FunctionMessage(
-                name=self.__class__.__name__,
-                content=f"Error retrieving expenses: {str(e)}",
-            )
+    def _request(self, **filters):
+        """Retrieves expenses based on the provided filters."""
+        return ExpenseQuery(**filters)
 
+    def _response(self, query: ExpenseQuery, expenses) -> str:
+        # The state is only worth a column when expenses of any state are listed
+        fields = self.fields if query.state else [*self.fields, "state"]
+        return encode_table(expenses, fields, query.limit)
 
-class CancelPendingExpensesTool(BaseTool):
+
+class CancelPendingExpensesTool(PampaBaseTool):
     name: str = "cancel_pending_expenses"
     description: str = "Cancels all pending expenses."
-    storage: StorageStrategy = MongoDBStorage()
-
-    def _run(self):
-        """Cancels all pending expenses."""
-        try:
-            self.storage.cancel_pending_expenses()
-            return FunctionMessage(
-                name=self.__class__.__name__,
-                content="All pending expenses have been cancelled successfully.",
-            )
-        except Exception as e:
-            return FunctionMessage(
-                name=self.__class__.__name__,
-                content=f"Error cancelling pending expenses: {str(e)}",
-            )
+    args_schema: type[NoArguments] = NoArguments
+    storage: StorageStrategy = shared_storage
+    method: str = "cancel_pending_expenses"
+    error: str = "Error cancelling pending expenses"
 
-
-class MealPlan(BaseModel):
-    """
-    Represents a meal plan for a specific date.
-    """
-
-    meal: str = Field(description="The name of the meal.")
-    date: str = Field(description="The date of the meal plan.")
-    toppings: Optional[List[str]] = Field(
-        default=None, description="Optional list of toppings for the meal."
-    )
-    team_member: str = Field(
-        description="The team member who set the meal plan. If not provided by the user, the agent needs to ask for it. 'Assistant' cannot be a team member."
-    )
+    def _response(self, request, result) -> str:
+        return "All pending expenses have been cancelled successfully."
 
 
 class SetMealTool(PampaBaseTool):
@@ -146,9 +202,11 @@ class SetMealTool(PampaBaseTool):
         "Sets the meal plan for a specific date with optional toppings and the team member who set it."
     )
     args_schema: type[MealPlan] = MealPlan
-    storage: StorageStrategy = MongoDBStorage()
+    storage: StorageStrategy = shared_storage
+    method: str = "add_meal"
+    error: str = "Error setting meal plan"
 
-    def _run(
+    def _request(
         self,
         meal: str,
         date: str,
@@ -156,112 +214,131 @@ class SetMealTool(PampaBaseTool):
         toppings: Optional[List[str]] = None,
     ):
         """Sets the meal plan for a specific date."""
-        meal_plan = MealPlan(
+        return MealPlan(
             meal=meal, date=date, toppings=toppings, team_member=team_member
-        )
+        ).model_dump()
 
-        try:
-            self.storage.add_meal(meal_plan.model_dump())
-            return FunctionMessage(
-                name=self.__class__.__name__,
-                content=f"Meal plan for {date} set successfully by {team_member}",
-            )
-        except Exception as e:
-            return FunctionMessage(
-                name=self.__class__.__name__,
-                content=f"Error setting meal plan: {str(e)}",
-            )
+    def _response(self, meal_plan: dict, result) -> str:
+        return (
+            f"Meal plan for {meal_plan['date']} set successfully by "
+            f"{meal_plan['team_member']}"
+        )
 
 
 class GetMealsTool(PampaBaseTool):
     name: str = "get_meals"
-    description: str = "Retrieves meal plans based on a date query."
-    storage: StorageStrategy = MongoDBStorage()
-
-    def _run(self, date: Optional[str] = None):
-        """Retrieves meal plans based on the provided date query."""
-        try:
-            meals = self.storage.get_meals(date)
-            meals_json = json.loads(meals)
-            return FunctionMessage(
-                name=self.__class__.__name__,
-                content=json.dumps(meals_json, ensure_ascii=False),
-            )
-        except Exception as e:
-            return FunctionMessage(
-                name=self.__class__.__name__,
-                content=f"Error retrieving meal plans: {str(e)}",
-            )
-
-
-class CannotGoToOfficeIRL(BaseModel):
-    """
-    Represents a date when a team member cannot go to the office in real life (IRL).
-    """
-
-    team_member: str = Field(
-        description="The name of the team member who cannot go to the office IRL."
-    )
-    date: str = Field(
-        description="The date when the team member cannot go to the office IRL (format: YYYY-MM-DD)."
-    )
-    reason: Optional[str] = Field(
-        default=None,
-        description="Optional reason for not being able to go to the office IRL.",
+    description: str = (
+        "Retrieves meal plans, optionally filtered by date, date range or team member."
     )
+    args_schema: type[MealQuery] = MealQuery
+    storage: StorageStrategy = shared_storage
+    fields: List[str] = ["date", "meal", "toppings", "team_member"]
+    method: str = "get_meals"
+    error: str = "Error retrieving meal plans"
+
+    def _request(self, **filters):
+        """Retrieves meal plans based on the provided filters."""
+        return MealQuery(**filters)
 
 
 class SetCannotGoToOfficeIRLTool(PampaBaseTool):
     name: str = "set_cannot_go_to_office_irl"
     description: str = "Sets a date when a team member cannot go to the office IRL."
     args_schema: type[CannotGoToOfficeIRL] = CannotGoToOfficeIRL
-    storage: StorageStrategy = MongoDBStorage()
+    storage: StorageStrategy = shared_storage
+    method: str = "add_out_of_office"
+    error: str = "Error setting date for cannot go to office IRL"
 
-    def _run(self, team_member: str, date: str, reason: Optional[str] = None):
+    def _request(self, team_member: str, date: str, reason: Optional[str] = None):
         """Sets a date when a team member cannot go to the office IRL."""
-        cannot_go_to_office_irl = CannotGoToOfficeIRL(
+        return CannotGoToOfficeIRL(
             team_member=team_member, date=date, reason=reason
-        )
+        ).model_dump()
 
-        try:
-            self.storage.add_out_of_office(cannot_go_to_office_irl.model_dump())
-            return FunctionMessage(
-                name=self.__class__.__name__,
-                content=f"Date set for {team_member} who cannot go to the office IRL on {date}",
-            )
-        except Exception as e:
-            return FunctionMessage(
-                name=self.__class__.__name__,
-                content=f"Error setting date for cannot go to office IRL: {str(e)}",
-            )
+    def _response(self, cannot_go_to_office_irl: dict, result) -> str:
+        return (
+            f"Date set for {cannot_go_to_office_irl['team_member']} who cannot go "
+            f"to the office IRL on {cannot_go_to_office_irl['date']}"
+        )
 
 
 class GetCannotGoToOfficeIRLTool(PampaBaseTool):
     name: str = "get_cannot_go_to_office_irl"
-    description: str = "Retrieves dates when team members cannot go to the office IRL."
-    storage: StorageStrategy = MongoDBStorage()
+    description: str = (
+        "Retrieves dates when team members cannot go to the office IRL, optionally filtered by team member, date or date range."
+    )
+    args_schema: type[OutOfOfficeQuery] = OutOfOfficeQuery
+    storage: StorageStrategy = shared_storage
+    fields: List[str] = ["date", "team_member", "reason"]
+    method: str = "get_out_of_office"
+    error: str = "Error retrieving cannot go to office IRL dates"
+
+    def _request(self, **filters):
+        """Retrieves dates when team members cannot go to the office IRL based on the provided filters."""
+        logging.debug(f"Querying cannot go to office IRL with {filters}")
+        return OutOfOfficeQuery(**filters)
+
+    def _response(self, query: OutOfOfficeQuery, entries) -> str:
+        cannot_go_to_office_irl = super()._response(query, entries)
+        logging.debug(
+            f"Retrieved cannot go to office IRL entries: {cannot_go_to_office_irl}"
+        )
+        return cannot_go_to_office_irl
 
-    def _run(self, team_member: Optional[str] = None, date: Optional[str] = None):
-        """Retrieves dates when team members cannot go to the office IRL based on the provided query."""
-        try:
-            logging.debug(
-                f"Querying cannot go to office IRL with team_member: {team_member}, date: {date}"
-            )
-            cannot_go_to_office_irl = self.storage.get_out_of_office(team_member, date)
-            logging.debug(
-                f"Retrieved cannot go to office IRL entries: {cannot_go_to_office_irl}"
-            )
-            response_json = json.loads(cannot_go_to_office_irl)
-            return FunctionMessage(
-                name=self.__class__.__name__,
-                content=json.dumps(response_json, ensure_ascii=False),
-            )
-        except Exception as e:
-            logging.error(f"Error retrieving cannot go to office IRL dates: {str(e)}")
-            return FunctionMessage(
-                name=self.__class__.__name__,
-                content=f"Error retrieving cannot go to office IRL dates: {str(e)}",
-            )
+    def _error(self, error: Exception) -> str:
+        message = super()._error(error)
+        logging.error(message)
+        return message
+
+
+class GetExpenseTotalsTool(PampaBaseTool):
+    name: str = "get_expense_totals"
+    description: str = (
+        "Sums expenses grouped by person, expense type and/or month, optionally filtered by person, state and date range. Use it instead of get_expenses for totals."
+    )
+    args_schema: type[ExpenseTotalsQuery] = ExpenseTotalsQuery
+    storage: StorageStrategy = shared_storage
+    method: str = "get_expense_totals"
+    error: str = "Error summing expenses"
+
+    def _request(self, **filters):
+        """Sums expenses based on the provided filters."""
+        return ExpenseTotalsQuery(**filters)
+
+    def _response(self, query: ExpenseTotalsQuery, totals) -> str:
+        return encode_table(totals, [*query.group_by, "total_value", "count"])
+
+
+class CountOutOfOfficeDaysTool(PampaBaseTool):
+    name: str = "count_out_of_office_days"
+    description: str = (
+        "Counts the days each team member cannot go to the office IRL, optionally filtered by team member and date range."
+    )
+    args_schema: type[OutOfOfficeCountQuery] = OutOfOfficeCountQuery
+    storage: StorageStrategy = shared_storage
+    fields: List[str] = ["team_member", "days"]
+    method: str = "count_out_of_office"
+    error: str = "Error counting out of office days"
+
+    def _request(self, **filters):
+        """Counts out of office days based on the provided filters."""
+        return OutOfOfficeCountQuery(**filters)
+
+
+class GetMealFrequencyTool(PampaBaseTool):
+    name: str = "get_meal_frequency"
+    description: str = (
+        "Lists the most frequent meals with how many times and when they were last eaten, optionally filtered by team member and date range."
+    )
+    args_schema: type[MealFrequencyQuery] = MealFrequencyQuery
+    storage: StorageStrategy = shared_storage
+    fields: List[str] = ["meal", "count", "last_date"]
+    method: str = "get_meal_frequency"
+    error: str = "Error counting meals"
+
+    def _request(self, **filters):
+        """Counts meals based on the provided filters."""
+        return MealFrequencyQuery(**filters)
 
 
 # List of all tools in the file (excluding base tools)
@@ -273,4 +350,7 @@ tools_list = [
     GetMealsTool(),
     SetCannotGoToOfficeIRLTool(),
     GetCannotGoToOfficeIRLTool(),
+    GetExpenseTotalsTool(),
+    CountOutOfOfficeDaysTool(),
+    GetMealFrequencyTool(),
 ]
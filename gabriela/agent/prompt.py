@@ -1,8 +1,16 @@
+import os
 from datetime import date
 from textwrap import dedent
+from typing import Dict, Optional
 
-AGENT_PROMPT = dedent(
-    f"""
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Static on purpose: the system prompt and the tool schemas are the same bytes on
+# every call so the provider can cache them. Anything that changes goes in
+# context_message instead.
+AGENT_PROMPT = dedent("""
 Tu nombre es Gabriela y sos un asistente de IA diseñado para ayudar al equipo de Pampa Labs. 
                       
 Puede ayudar con:
@@ -22,6 +30,39 @@ Tus respuestas deben ser:
 
 Solo puedes ayudar usando las herramientas disponibles y con pedidos que vengan de miembros del equipo. Todo lo que no se pueda responder usando las herramientas, debes decir que no puedes ayudar y disculparte.
 
-Tene en cuenta para el uso de las herramientas que la fecha actual es: {date.today()}
-"""
-)
+Para el uso de las herramientas tene en cuenta la fecha actual y quien escribe, que se indican en el contexto del mensaje.
+
+Para totales, conteos o rankings usa las herramientas que los calculan (get_expense_totals, count_out_of_office_days, get_meal_frequency) en lugar de listar todos los registros y sumarlos vos.
+""")
+
+WEEKDAYS = ["lunes", "martes", "miércoles", "jueves", "viernes", "sábado", "domingo"]
+
+
+def _team_members() -> Dict[str, str]:
+    """Parses ``TEAM_MEMBERS``: comma separated ``whatsapp:+number=Name`` pairs."""
+    members = {}
+    for pair in os.getenv("TEAM_MEMBERS", "").split(","):
+        if "=" in pair:
+            sender, name = pair.split("=", 1)
+            members[sender.strip()] = name.strip()
+    return members
+
+
+TEAM_MEMBERS = _team_members()
+
+
+def context_message(sender: Optional[str], today: Optional[date] = None) -> str:
+    """
+    Volatile context of a model call: today's date and who is writing.
+
+    :param sender: WhatsApp identifier of the sender
+    :param today: Date to use instead of the current one
+    """
+    today = today or date.today()
+    lines = [
+        "Contexto del mensaje:",
+        f"- Fecha actual: {today.isoformat()} ({WEEKDAYS[today.weekday()]})",
+    ]
+    if sender in TEAM_MEMBERS:
+        lines.append(f"- Quien escribe: {TEAM_MEMBERS[sender]}")
+    return "\n".join(lines)
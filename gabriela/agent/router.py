@@ -0,0 +1,228 @@
+import csv
+import re
+import unicodedata
+import uuid
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+from typing import Callable, Dict, List, Optional, Sequence
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
+from langchain_core.runnables import RunnableConfig
+from langchain_core.tools import BaseTool
+
+from .encoding import NO_RESULTS, TRUNCATED
+
+RELATIVE_DAYS = {"hoy": 0, "manana": 1, "pasado manana": 2}
+DAY_NAMES = {"hoy": "hoy", "manana": "mañana", "pasado manana": "pasado mañana"}
+
+
+def normalize(text: str) -> str:
+    """Lowercase text without accents, punctuation or repeated spaces."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"[¿?¡!.,;:]", " ", text)
+    return " ".join(text.split())
+
+
+def relative_date(match: re.Match) -> str:
+    """The date named by the ``day`` group of a match (hoy, mañana...)."""
+    return (date.today() + timedelta(days=RELATIVE_DAYS[match["day"]])).isoformat()
+
+
+@dataclass
+class FastPathRule:
+    """
+    A command answered by calling a tool directly, without the model.
+
+    ``pattern`` must match the whole normalized message, so anything with more
+    details than the plain command goes to the model. ``row`` formats every
+    record of the tool output, ``empty`` is answered when there are none and
+    ``reply`` answers tools that don't return records. Templates can use the
+    named groups of the pattern.
+    """
+
+    name: str
+    pattern: str
+    tool: str
+    args: Callable[[re.Match], dict] = lambda match: {}
+    header: str = ""
+    row: Optional[Callable[[Dict[str, str]], str]] = None
+    empty: str = ""
+    reply: str = ""
+    _regex: re.Pattern = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self._regex = re.compile(self.pattern)
+
+    def match(self, text: str) -> Optional[re.Match]:
+        return self._regex.fullmatch(text)
+
+    def format(self, match: re.Match, output: str) -> str:
+        values = {
+            name: DAY_NAMES.get(value, value)
+            for name, value in match.groupdict().items()
+        }
+        if self.row is None:
+            return self.reply.format(**values)
+        if output == NO_RESULTS:
+            return self.empty.format(**values)
+        table = output.splitlines()
+        truncated = table[-1] == TRUNCATED
+        lines = [
+            self.row(record)
+            for record in csv.DictReader(table[:-1] if truncated else table)
+        ]
+        if truncated:
+            lines.append(MORE_ROWS.format(count=len(lines)))
+        return "\n".join([self.header.format(**values), *lines])
+
+
+DAY = r"(?P<day>hoy|manana|pasado manana)"
+# Last line of a reply whose tool output was cut at its limit
+MORE_ROWS = (
+    "… y hay más. Te mostré {count}, pedime un rango de fechas o una persona "
+    "para ver el resto."
+)
+
+
+def _expense_row(record: Dict[str, str]) -> str:
+    return (
+        f"• {record['date']} {record['person']}: "
+        f"{record['expense_type']} ${record['total_value']}"
+    )
+
+
+def _out_of_office_row(record: Dict[str, str]) -> str:
+    reason = f" ({record['reason']})" if record["reason"] else ""
+    return f"• {record['team_member']}{reason}"
+
+
+def _meal_row(record: Dict[str, str]) -> str:
+    toppings = record["toppings"].replace("|", ", ")
+    toppings = f" con {toppings}" if toppings else ""
+    return f"• {record['meal']}{toppings} (eligió {record['team_member']})"
+
+
+DEFAULT_RULES = [
+    FastPathRule(
+        name="pending_expenses",
+        pattern=r"(?:(?:que|cuales|cuales son los|mostrame los|ver|ver los|listar)\s+)?"
+        r"gastos pendientes(?:\s+hay)?",
+        tool="get_expenses",
+        header="Gastos pendientes:",
+        row=_expense_row,
+        empty="No hay gastos pendientes.",
+    ),
+    FastPathRule(
+        name="cancel_pending_expenses",
+        pattern=r"(?:cancela|cancelar|cerra|cerrar|liquidar)\s+"
+        r"(?:todos\s+)?(?:los\s+)?gastos pendientes",
+        tool="cancel_pending_expenses",
+        reply="Listo, cancelé todos los gastos pendientes.",
+    ),
+    FastPathRule(
+        name="out_of_office",
+        pattern=r"quien(?:es)?\s+(?:no\s+(?:viene|vienen|va|van)|falta|faltan)"
+        rf"(?:\s+a\s+la\s+oficina)?\s+{DAY}",
+        tool="get_cannot_go_to_office_irl",
+        args=lambda match: {"date": relative_date(match)},
+        header="No van a la oficina {day}:",
+        row=_out_of_office_row,
+        empty="Nadie avisó que no va a la oficina {day}.",
+    ),
+    FastPathRule(
+        name="meals",
+        pattern=r"(?:que\s+(?:comemos|se\s+come|hay\s+de\s+comer)|comida\s+de)"
+        rf"\s+{DAY}",
+        tool="get_meals",
+        args=lambda match: {"date": relative_date(match)},
+        header="Comida de {day}:",
+        row=_meal_row,
+        empty="Todavía no hay comida elegida para {day}.",
+    ),
+]
+
+
+class FastPathRouter:
+    """
+    Answers common commands by calling the tool directly and filling a template.
+
+    Runs before the model: when the message of the turn fully matches one of
+    the ``rules`` the tool call, its result and the reply are added to the
+    history as if the model had made them, saving both model round trips.
+    Messages with images, that don't match or whose tool fails go to the model.
+    """
+
+    def __init__(self, tools: Sequence[BaseTool], rules: List[FastPathRule] = None):
+        self.tools: Dict[str, BaseTool] = {tool.name: tool for tool in tools}
+        self.rules = [
+            rule
+            for rule in (DEFAULT_RULES if rules is None else rules)
+            if rule.tool in self.tools
+        ]
+        self._stats = {"messages": 0, "hits": 0, "fallbacks": 0}
+        self.rule_hits = {rule.name: 0 for rule in self.rules}
+
+    def match(self, messages: Sequence[BaseMessage]):
+        """The rule matching the last message and its match, if any."""
+        message = messages[-1] if messages else None
+        if not isinstance(message, HumanMessage):
+            return None, None
+        if isinstance(message.content, str):
+            text = message.content
+        elif all(part.get("type") == "text" for part in message.content):
+            text = " ".join(part["text"] for part in message.content)
+        else:
+            return None, None  # Images always need the model
+        self._stats["messages"] += 1
+        text = normalize(text)
+        for rule in self.rules:
+            if match := rule.match(text):
+                return rule, match
+        return None, None
+
+    def _tool_call(self, rule: FastPathRule, match: re.Match) -> dict:
+        return {
+            "name": rule.tool,
+            "args": rule.args(match),
+            "id": f"fast_{uuid.uuid4().hex[:12]}",
+            "type": "tool_call",
+        }
+
+    def _answer(self, rule, match, call, result: ToolMessage) -> List[BaseMessage]:
+        if result.content.startswith("Error"):
+            self._stats["fallbacks"] += 1
+            return []
+        self._stats["hits"] += 1
+        self.rule_hits[rule.name] += 1
+        return [
+            AIMessage(content="", tool_calls=[call]),
+            result,
+            AIMessage(content=rule.format(match, result.content)),
+        ]
+
+    def route(self, messages: Sequence[BaseMessage], config: RunnableConfig):
+        """Messages answering the turn, empty when the model has to answer it."""
+        rule, match = self.match(messages)
+        if not rule:
+            return []
+        call = self._tool_call(rule, match)
+        return self._answer(
+            rule, match, call, self.tools[rule.tool].invoke(call, config)
+        )
+
+    async def aroute(self, messages: Sequence[BaseMessage], config: RunnableConfig):
+        rule, match = self.match(messages)
+        if not rule:
+            return []
+        call = self._tool_call(rule, match)
+        result = await self.tools[rule.tool].ainvoke(call, config)
+        return self._answer(rule, match, call, result)
+
+    def stats(self) -> dict:
+        messages = self._stats["messages"]
+        return {
+            **self._stats,
+            "hit_ratio": self._stats["hits"] / messages if messages else None,
+            "rules": self.rule_hits,
+        }
@@ -0,0 +1,75 @@
+import asyncio
+from contextlib import nullcontext
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+from .leases import MongoSenderLeases
+
+T = TypeVar("T")
+
+
+class _SenderSlot:
+    def __init__(self):
+        # asyncio.Lock wakes up waiters in FIFO order
+        self.lock = asyncio.Lock()
+        self.waiters = 0
+
+
+class SenderScheduler:
+    """
+    Runs agent turns on a bounded worker pool, one turn at a time per sender.
+
+    Turns from the same sender are executed in arrival order so they never run
+    concurrently on the same conversation thread, while turns from different
+    senders run in parallel up to ``max_workers``. With ``leases`` a turn also
+    holds its sender's lease, so turns stay one at a time per sender across
+    worker processes.
+    """
+
+    def __init__(
+        self, max_workers: int = 4, leases: Optional[MongoSenderLeases] = None
+    ):
+        self.max_workers = max_workers
+        self.leases = leases
+        self._workers = asyncio.Semaphore(max_workers)
+        self._slots: Dict[str, _SenderSlot] = {}
+        self._active = 0
+
+    async def run(self, sender: str, turn: Callable[[], Awaitable[T]]) -> T:
+        """
+        Waits for the sender's previous turns and a free worker, then runs ``turn``.
+
+        :param sender: The sender's identifier, used as the ordering key
+        :param turn: Callable returning the coroutine to run
+        :return: Whatever the turn returns
+        """
+        slot = self._slots.setdefault(sender, _SenderSlot())
+        slot.waiters += 1
+        try:
+            async with slot.lock, self._lease(sender):
+                # The worker is taken only once it's this sender's turn, so queued
+                # messages from a busy sender don't starve other senders.
+                async with self._workers:
+                    self._active += 1
+                    try:
+                        return await turn()
+                    finally:
+                        self._active -= 1
+        finally:
+            slot.waiters -= 1
+            if not slot.waiters:
+                del self._slots[sender]
+
+    def _lease(self, sender: str):
+        return self.leases.hold(sender) if self.leases else nullcontext()
+
+    def stats(self) -> dict:
+        queued = sum(slot.waiters for slot in self._slots.values())
+        stats = {
+            "max_workers": self.max_workers,
+            "active": self._active,
+            "queued": queued - self._active,
+            "senders": len(self._slots),
+        }
+        if self.leases:
+            stats["leases"] = self.leases.stats()
+        return stats
@@ -6,3 +6,6 @@ from langchain_core.messages import BaseMessage
 
 class AgentState(TypedDict):
     messages: Annotated[List[BaseMessage], add]
+    # Rolling summary of the first `summarized` non-system messages
+    summary: str
+    summarized: int
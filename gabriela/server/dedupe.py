@@ -0,0 +1,165 @@
+import asyncio
+import os
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class ReplyStore(ABC):
+    """Durable tier of the deduplicator, shared by restarts and other workers."""
+
+    @abstractmethod
+    async def get(self, message_sid: str) -> Optional[str]:
+        pass
+
+    @abstractmethod
+    async def put(self, message_sid: str, reply: str) -> None:
+        pass
+
+
+class MongoReplyStore(ReplyStore):
+    """
+    Keeps the webhook replies in MongoDB, expired by a TTL index after ``ttl``
+    seconds.
+    """
+
+    def __init__(self, db=None, collection: str = "webhook_replies", ttl: int = 86400):
+        self.db = db
+        self.collection_name = collection
+        self.ttl = ttl
+        self._ready = False
+
+    async def _collection(self):
+        if self.db is None:
+            from gabriela.agent.mongo import mongo
+
+            self.db = mongo.async_database()
+        collection = self.db[self.collection_name]
+        if not self._ready:
+            await collection.create_index(
+                "created_at", expireAfterSeconds=self.ttl, name="reply_ttl"
+            )
+            self._ready = True
+        return collection
+
+    async def get(self, message_sid: str) -> Optional[str]:
+        collection = await self._collection()
+        document = await collection.find_one({"_id": message_sid}, {"reply": 1})
+        return document["reply"] if document else None
+
+    async def put(self, message_sid: str, reply: str) -> None:
+        collection = await self._collection()
+        await collection.replace_one(
+            {"_id": message_sid},
+            {"reply": reply, "created_at": datetime.now(timezone.utc)},
+            upsert=True,
+        )
+
+
+class MessageDeduplicator:
+    """
+    Answers every Twilio message once, keyed by its ``MessageSid``.
+
+    Twilio retries the webhook when it is slow to answer. A retry of a message
+    that was already answered gets the same reply from a bounded LRU of the last
+    ``max_entries`` replies (or from ``store``), and a retry arriving while the
+    first attempt is still running waits for its result instead of running the
+    agent again. Failed attempts are not remembered, so a retry can succeed.
+    """
+
+    def __init__(self, max_entries: int = 1000, store: Optional[ReplyStore] = None):
+        self.max_entries = max_entries
+        self.store = store
+        self._replies: OrderedDict[str, str] = OrderedDict()
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self._stats = {"processed": 0, "cached": 0, "coalesced": 0}
+
+    def _remember(self, message_sid: str, reply: str):
+        self._replies[message_sid] = reply
+        self._replies.move_to_end(message_sid)
+        while len(self._replies) > self.max_entries:
+            self._replies.popitem(last=False)
+
+    async def _stored(self, message_sid: str) -> Optional[str]:
+        if not self.store:
+            return None
+        try:
+            return await self.store.get(message_sid)
+        except Exception as e:
+            print(f"Error reading stored reply: {e}")
+            return None
+
+    async def run(
+        self, message_sid: Optional[str], produce: Callable[[], Awaitable[str]]
+    ) -> str:
+        """Returns the reply to a message, producing it only the first time."""
+        if not message_sid:
+            return await produce()
+        if message_sid in self._replies:
+            self._replies.move_to_end(message_sid)
+            self._stats["cached"] += 1
+            return self._replies[message_sid]
+        if message_sid in self._in_flight:
+            self._stats["coalesced"] += 1
+            return await asyncio.shield(self._in_flight[message_sid])
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[message_sid] = future
+        try:
+            reply = await self._stored(message_sid)
+            if reply is not None:
+                self._stats["cached"] += 1
+            else:
+                self._stats["processed"] += 1
+                reply = await produce()
+                if self.store:
+                    try:
+                        await self.store.put(message_sid, reply)
+                    except Exception as e:
+                        print(f"Error storing reply: {e}")
+            self._remember(message_sid, reply)
+            future.set_result(reply)
+            return reply
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Mark it retrieved, nobody may be waiting for it
+            raise
+        finally:
+            del self._in_flight[message_sid]
+
+    def stats(self) -> dict:
+        return {
+            **self._stats,
+            "in_flight": len(self._in_flight),
+            "remembered": len(self._replies),
+        }
+
+
+def build_deduplicator() -> MessageDeduplicator:
+    """
+    Builds the deduplicator configured through environment variables.
+
+    ``WEBHOOK_DEDUPE_MAX_ENTRIES`` bounds the replies kept in memory and
+    ``WEBHOOK_DEDUPE_STORE=mongo`` (the default with ``WORKER_MODE=multi``, so
+    a retry reaching another worker is answered too) also keeps them in MongoDB
+    for ``WEBHOOK_DEDUPE_TTL_SECONDS``.
+    """
+    from gabriela.agent.mongo import multi_worker
+
+    store = None
+    default = "mongo" if multi_worker() else "memory"
+    if os.getenv("WEBHOOK_DEDUPE_STORE", default) == "mongo":
+        store = MongoReplyStore(
+            ttl=int(os.getenv("WEBHOOK_DEDUPE_TTL_SECONDS", "86400"))
+        )
+    return MessageDeduplicator(
+        max_entries=int(os.getenv("WEBHOOK_DEDUPE_MAX_ENTRIES", "1000")), store=store
+    )
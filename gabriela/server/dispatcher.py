@@ -0,0 +1,102 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+from .replies import ReplySender
+
+ERROR_REPLY = "Sorry, an error occurred while processing your message."
+
+
+@dataclass
+class InboundMessage:
+    """A validated WhatsApp message waiting to be answered out-of-band."""
+
+    sender: str
+    to: Optional[str]
+    text: str
+    media_url: Optional[str] = None
+    message_sid: Optional[str] = None
+    received_at: float = field(default_factory=time.monotonic)
+
+
+class ReplyDispatcher:
+    """
+    Answers inbound messages in the background and delivers the replies.
+
+    Every accepted message becomes a task that turns it into a reply with
+    ``handler`` and sends it through ``reply_sender``, so the webhook only has
+    to enqueue and return. Concurrency and per-sender ordering are enforced by
+    the agent's scheduler, the dispatcher only bounds how many messages can be
+    waiting for an answer.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[InboundMessage], Awaitable[str]],
+        reply_sender: ReplySender,
+        max_pending: int = 0,
+    ):
+        self.handler = handler
+        self.reply_sender = reply_sender
+        self.max_pending = max_pending
+        self._tasks: Set[asyncio.Task] = set()
+        self._stats = {
+            "enqueued": 0,
+            "delivered": 0,
+            "failed": 0,
+            "errors": 0,
+            "max_depth": 0,
+            "total_latency_seconds": 0.0,
+        }
+
+    async def stop(self, timeout: float = 30.0):
+        """Gives pending messages a chance to be answered, then cancels the rest."""
+        if self._tasks:
+            _, pending = await asyncio.wait(self._tasks, timeout=timeout)
+            if pending:
+                print(f"Stopping with {len(pending)} unanswered messages")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        await self.reply_sender.aclose()
+
+    def enqueue(self, message: InboundMessage):
+        """Schedules a message to be answered. Raises ``asyncio.QueueFull`` when bounded and full."""
+        if self.max_pending and len(self._tasks) >= self.max_pending:
+            raise asyncio.QueueFull()
+        task = asyncio.create_task(self._process(message))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        self._stats["enqueued"] += 1
+        self._stats["max_depth"] = max(self._stats["max_depth"], len(self._tasks))
+
+    def depth(self) -> int:
+        return len(self._tasks)
+
+    def stats(self) -> Dict[str, float]:
+        processed = self._stats["delivered"] + self._stats["failed"]
+        return {
+            "depth": self.depth(),
+            **self._stats,
+            "avg_latency_seconds": (
+                self._stats["total_latency_seconds"] / processed if processed else 0.0
+            ),
+        }
+
+    async def _process(self, message: InboundMessage):
+        try:
+            body = await self.handler(message)
+        except Exception as e:
+            print(f"Error processing message: {e}")
+            self._stats["errors"] += 1
+            body = ERROR_REPLY
+        if not body:
+            return  # Answered along with a later message of the same sender
+        try:
+            await self.reply_sender.send(to=message.sender, from_=message.to, body=body)
+            self._stats["delivered"] += 1
+        except Exception as e:
+            print(f"Error sending reply to {message.sender}: {e}")
+            self._stats["failed"] += 1
+        self._stats["total_latency_seconds"] += time.monotonic() - message.received_at
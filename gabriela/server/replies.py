@@ -0,0 +1,71 @@
+import os
+from abc import ABC, abstractmethod
+from typing import Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class ReplySender(ABC):
+    """Delivers an agent reply to a WhatsApp user outside of the webhook response."""
+
+    @abstractmethod
+    async def send(self, to: str, from_: Optional[str], body: str) -> None:
+        pass
+
+    async def aclose(self) -> None:
+        pass
+
+
+class TwilioReplySender(ReplySender):
+    """Sends replies through the Twilio REST messages API."""
+
+    def __init__(
+        self,
+        account_sid: Optional[str] = None,
+        auth_token: Optional[str] = None,
+        from_number: Optional[str] = None,
+    ):
+        self.account_sid = account_sid or os.getenv("TWILIO_ACCOUNT_SID")
+        self.auth_token = auth_token or os.getenv("TWILIO_AUTH_TOKEN")
+        self.from_number = from_number or os.getenv("TWILIO_WHATSAPP_FROM")
+        self.client = None
+
+    def _connect(self):
+        # The aiohttp session behind the async client must be created inside the
+        # running event loop, so the client is built on first use.
+        if not self.client:
+            from twilio.http.async_http_client import AsyncTwilioHttpClient
+            from twilio.rest import Client
+
+            self.client = Client(
+                self.account_sid,
+                self.auth_token,
+                http_client=AsyncTwilioHttpClient(),
+            )
+
+    async def send(self, to: str, from_: Optional[str], body: str) -> None:
+        self._connect()
+        await self.client.messages.create_async(
+            to=to, from_=self.from_number or from_, body=body
+        )
+
+    async def aclose(self) -> None:
+        if self.client:
+            await self.client.http_client.close()
+            self.client = None
+
+
+class ConsoleReplySender(ReplySender):
+    """Local stand-in that prints replies instead of calling Twilio."""
+
+    async def send(self, to: str, from_: Optional[str], body: str) -> None:
+        print(f"[reply] {from_} -> {to}: {body}")
+
+
+def get_reply_sender() -> ReplySender:
+    """Returns the Twilio sender when credentials are configured, the console stub otherwise."""
+    if os.getenv("TWILIO_ACCOUNT_SID") and os.getenv("TWILIO_AUTH_TOKEN"):
+        return TwilioReplySender()
+    return ConsoleReplySender()
@@ -0,0 +1,98 @@
+import asyncio
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Generic, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class LazyAgent(Generic[T]):
+    """
+    Builds the agent after the server is up instead of while it's imported.
+
+    Importing LangChain, LangGraph and the OpenAI client, creating the models
+    and compiling the graph takes seconds, which a host waking the service up
+    adds to the first webhook. ``mode`` picks when ``factory`` runs:
+    ``background`` starts it in a worker thread as soon as the server starts,
+    ``lazy`` waits for the first message and ``eager`` builds it
+    before the server accepts connections. Callers waiting for it share a
+    single build.
+
+    Timings are seconds since ``started_at``, which should be taken as early as
+    possible in the process.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[], T],
+        mode: str = "background",
+        started_at: Optional[float] = None,
+    ):
+        self.factory = factory
+        self.mode = mode
+        self.started_at = time.monotonic() if started_at is None else started_at
+        self.timings: Dict[str, float] = {}
+        self._value: Optional[T] = None
+        self._lock = threading.Lock()
+        self._build: Optional[asyncio.Future] = None
+
+    @property
+    def ready(self) -> bool:
+        return self._value is not None
+
+    def mark(self, event: str):
+        """Records when ``event`` first happened."""
+        self.timings.setdefault(event, round(time.monotonic() - self.started_at, 4))
+
+    @contextmanager
+    def timed(self, step: str) -> Iterator[None]:
+        """Records how long ``step`` took."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.timings[f"{step}_seconds"] = round(time.monotonic() - start, 4)
+
+    def get(self) -> T:
+        """The agent, built in the calling thread if nobody built it yet."""
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    with self.timed("build"):
+                        self._value = self.factory()
+                    self.mark("ready")
+        return self._value
+
+    async def aget(self) -> T:
+        """The agent, built in a worker thread so the event loop keeps serving."""
+        if self._value is not None:
+            return self._value
+        if self._build is None or (
+            self._build.done() and self._build.exception() is not None
+        ):
+            self._build = asyncio.ensure_future(asyncio.to_thread(self.get))
+        return await asyncio.shield(self._build)
+
+    async def start(self):
+        """Called at server startup, builds the agent as ``mode`` asks."""
+        self.mark("server_started")
+        if self.mode == "eager":
+            await self.aget()
+        elif self.mode == "background":
+            self._build = asyncio.ensure_future(asyncio.to_thread(self.get))
+            self._build.add_done_callback(self._report)
+
+    @staticmethod
+    def _report(build: asyncio.Future):
+        if not build.cancelled() and build.exception() is not None:
+            print(f"Error preparing the agent: {build.exception()}")
+
+    def stats(self) -> dict:
+        return {"mode": self.mode, "ready": self.ready, **self.timings}
+
+
+def startup_mode() -> str:
+    """``STARTUP_MODE``: ``background`` (default), ``lazy`` or ``eager``."""
+    return os.getenv("STARTUP_MODE", "background")
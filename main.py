@@ -1,21 +1,180 @@
-import base64
+import asyncio
 import os
+import time
+from contextlib import asynccontextmanager
 from typing import Any, Dict
 
-import requests
+# Taken before the other imports so the startup breakdown includes them
+STARTED_AT = time.monotonic()
+
+import httpx
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse
 from twilio.twiml.messaging_response import MessagingResponse
 
-from gabriela.agent.core import WhatsAppAgent
+from gabriela.agent.expenses_storage import CachedStorage, shared_storage
+from gabriela.agent.governor import BUSY_REPLY
+from gabriela.agent.images import ImageTooLarge, fetch_image, image_store, shrink_image
+from gabriela.agent.metrics import log_event, metrics, request_context
+from gabriela.agent.mongo import mongo
+from gabriela.server.dedupe import build_deduplicator
+from gabriela.server.dispatcher import ERROR_REPLY, InboundMessage, ReplyDispatcher
+from gabriela.server.replies import get_reply_sender
+from gabriela.server.startup import LazyAgent, startup_mode
 
 # Load environment variables from .env file
 load_dotenv()
 
-app = FastAPI()
+# "sync" answers inside the webhook response, "deferred" acknowledges right away
+# and delivers the answer through the Twilio REST API
+REPLY_MODE = os.getenv("WHATSAPP_REPLY_MODE", "sync")
+
+# Pooled HTTP client used to download media attached to incoming messages
+http_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(float(os.getenv("MEDIA_DOWNLOAD_TIMEOUT", "15"))),
+    limits=httpx.Limits(max_connections=int(os.getenv("MEDIA_MAX_CONNECTIONS", "20"))),
+    follow_redirects=True,  # Twilio media URLs redirect to the actual file
+)
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", str(10 * 1024 * 1024)))
+# Twilio media URLs require basic auth when "HTTP Basic Authentication for media"
+# is enabled in the account
+MEDIA_AUTH = (
+    (os.getenv("TWILIO_ACCOUNT_SID"), os.getenv("TWILIO_AUTH_TOKEN"))
+    if os.getenv("TWILIO_ACCOUNT_SID") and os.getenv("TWILIO_AUTH_TOKEN")
+    else None
+)
+
+dispatcher: ReplyDispatcher | None = None
+deduplicator = build_deduplicator()
+
+
+def build_agent():
+    """Imports LangChain and compiles the agent graph, which takes a few seconds."""
+    with agent_loader.timed("agent_imports"):
+        from gabriela.agent.core import WhatsAppAgent
+    with agent_loader.timed("agent_build"):
+        return WhatsAppAgent()
+
+
+# The agent is built once the server is up, see STARTUP_MODE in the README
+agent_loader = LazyAgent(build_agent, mode=startup_mode(), started_at=STARTED_AT)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global dispatcher
+    # First, so the graph is built while the MongoDB handshakes are running
+    await agent_loader.start()
+    if mongo.configured:
+        # Open the pools now so the first message doesn't pay for the handshakes
+        try:
+            await asyncio.to_thread(mongo.connect)
+            await mongo.aconnect()
+            print("Successfully connected to MongoDB!")
+            # Idempotent, makes sure the read tools never scan whole collections
+            await shared_storage.aensure_indexes()
+        except Exception as e:
+            print(f"Error preparing MongoDB: {e}")
+    if REPLY_MODE == "deferred":
+        dispatcher = ReplyDispatcher(
+            handler=deferred_reply,
+            reply_sender=get_reply_sender(),
+            max_pending=int(os.getenv("REPLY_QUEUE_MAX_SIZE", "0")),
+        )
+    yield
+    if dispatcher:
+        await dispatcher.stop()
+    await http_client.aclose()
+    try:
+        await shared_storage.aflush()  # Inserts waiting in the write-behind buffer
+    except Exception as e:
+        print(f"Error flushing pending writes: {e}")
+    await mongo.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+async def fetch_media(media_url: str) -> str | None:
+    """
+    Downloads the image attached to a message, shrinks it and stores it.
+
+    :return: A reference to the stored image, or None if it couldn't be read
+    """
+    try:
+        with metrics.span("stage", stage="media_download"):
+            data = await fetch_image(
+                http_client, media_url, MEDIA_MAX_BYTES, MEDIA_AUTH
+            )
+        if not data:
+            return None
+        # Resizing is CPU bound, keep it off the event loop
+        with metrics.span("stage", stage="image_resize"):
+            data, content_type = await asyncio.to_thread(shrink_image, data)
+    except ImageTooLarge as e:
+        print(f"Ignoring media: {e}")
+        return None
+    except OSError as e:  # Not an image Pillow can read
+        print(f"Ignoring media: {e}")
+        return None
+    return image_store.put(data, content_type)
+
+
+async def generate_reply(sender: str, text: str, media_url: str | None) -> str:
+    """Runs the agent for an incoming message and returns the text to answer with."""
+    image_ref = await fetch_media(media_url) if media_url else None
+
+    wa = await agent_loader.aget()
+    # Call the handle_message method of WhatsAppAgent
+    with metrics.span("stage", stage="agent"):
+        agent_response: Dict[str, Any] | None = await wa.ahandle_message(
+            {"from": sender, "text": text, "image_url": image_ref}
+        )
+    agent_loader.mark("first_response")
+    if agent_response is None:
+        return ""  # Coalesced, answered along with a later message
+    return agent_response["messages"][-1].content
+
 
-# Initialize WhatsApp agent
-wa = WhatsAppAgent()
+class Overloaded(Exception):
+    """Raised to shed a message while the agent is overloaded."""
+
+
+def log_request(
+    event: str, message: InboundMessage, stages: Dict[str, float], start: float
+):
+    """Logs how long a message took to answer and where the time went."""
+    log_event(
+        event,
+        sender=message.sender,
+        media=bool(message.media_url),
+        seconds=round(time.perf_counter() - start, 3),
+        stages={stage: round(seconds, 4) for stage, seconds in stages.items()},
+    )
+
+
+async def deferred_reply(message: InboundMessage) -> str:
+    """Reply of a message answered in the background, traced like the webhook."""
+    with request_context(message.message_sid) as stages:
+        start = time.perf_counter()
+        try:
+            return await generate_reply(message.sender, message.text, message.media_url)
+        finally:
+            log_request("deferred_reply", message, stages, start)
+
+
+async def answer(message: InboundMessage) -> str:
+    """The reply for the webhook response, empty when it's sent in the background."""
+    # Before the agent is built nothing can be queued for it, and waiting for
+    # the build here would hold the webhook in deferred mode
+    if agent_loader.ready and agent_loader.get().overloaded():
+        # Not remembered by the deduplicator, so a retry can be answered later
+        raise Overloaded()
+    if dispatcher:
+        dispatcher.enqueue(message)
+        return ""
+    return await generate_reply(message.sender, message.text, message.media_url)
 
 
 @app.post("/whatsapp")
@@ -25,38 +184,101 @@ async def whatsapp_reply(request: Request):
     sender = form_data.get("From", "").strip()  # Sender's number
     media_url = form_data.get("MediaUrl0")  # Get the image URL if present
     resp = MessagingResponse()
-    msg = resp.message()
 
-    if incoming_msg or media_url:
-        try:
-            # Transform MediaUrl0 into a base64 encoded string
-            base64_image = None
-            if media_url:
-                response = requests.get(media_url)
-                if response.status_code == 200:
-                    image_content = response.content
-                    base64_image = base64.b64encode(image_content).decode("utf-8")
-
-            # Call the handle_message method of WhatsAppAgent
-            agent_response: Dict[str, Any] = wa.handle_message(
-                {
-                    "from": sender,
-                    "text": incoming_msg,
-                    "image_url": (
-                        f"data:image/jpeg;base64,{base64_image}"
-                        if base64_image
-                        else None
-                    ),
-                }
-            )
-            response_content = agent_response["messages"][-1].content
-            msg.body(response_content)  # Send the response generated by the agent
-        except Exception as e:
-            print(
-                f"Error processing message: {e}"
-            )  # Use print for logging in this example
-            msg.body("Sorry, an error occurred while processing your message.")
+    if not (incoming_msg or media_url):
+        resp.message("I didn't receive any message or image. Can you please try again?")
     else:
-        msg.body("I didn't receive any message or image. Can you please try again?")
+        message = InboundMessage(
+            sender=sender,
+            to=form_data.get("To"),
+            text=incoming_msg,
+            media_url=media_url,
+            message_sid=form_data.get("MessageSid"),
+        )
+        with request_context(message.message_sid) as stages:
+            start = time.perf_counter()
+            try:
+                # Twilio retries slow webhooks, answer each MessageSid only once
+                reply = await deduplicator.run(
+                    message.message_sid, lambda: answer(message)
+                )
+            except Overloaded:
+                metrics.inc("gabriela_errors_total", stage="overloaded")
+                reply = BUSY_REPLY
+            except asyncio.QueueFull:
+                metrics.inc("gabriela_errors_total", stage="queue_full")
+                reply = ERROR_REPLY
+            except Exception as e:
+                metrics.inc("gabriela_errors_total", stage="webhook")
+                log_event("webhook_error", error=str(e))
+                reply = ERROR_REPLY
+            metrics.record("stage", time.perf_counter() - start, stage="webhook")
+            log_request("webhook", message, stages, start)
+        if reply:
+            resp.message(reply)
 
     return Response(content=str(resp), media_type="application/xml")
+
+
+@app.get("/ready")
+async def readiness():
+    """Readiness probe, fails while MongoDB can't be reached."""
+    if mongo.configured and not await mongo.ping():
+        return JSONResponse({"status": "unavailable"}, status_code=503)
+    return {"status": "ready"}
+
+
+@app.get("/startup")
+async def startup_stats():
+    """When the server started, imported and built the agent, in seconds."""
+    return agent_loader.stats()
+
+
+@app.get("/queue")
+async def queue_stats():
+    """Depth and throughput of the agent scheduler and the deferred reply queue."""
+    stats = {"mode": REPLY_MODE, "dedupe": deduplicator.stats()}
+    if dispatcher:
+        stats["replies"] = dispatcher.stats()
+    if isinstance(shared_storage, CachedStorage):
+        stats["storage_cache"] = shared_storage.stats()
+    if not agent_loader.ready:
+        return stats  # Nothing queued for an agent that isn't built yet
+    wa = agent_loader.get()
+    stats["scheduler"] = wa.scheduler.stats()
+    stats["governor"] = wa.agent.governor.stats()
+    if wa.coalescer:
+        stats["coalescer"] = wa.coalescer.stats()
+    if wa.agent.router:
+        stats["fast_path"] = wa.agent.router.stats()
+    if wa.agent.answers:
+        stats["answers"] = wa.agent.answers.stats()
+    stats["models"] = wa.agent.usage
+    return stats
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus metrics: latency per stage, node, tool and MongoDB collection."""
+    metrics.set("gabriela_agent_ready", int(agent_loader.ready))
+    if isinstance(shared_storage, CachedStorage):
+        metrics.set("gabriela_storage_cache_entries", shared_storage.stats()["entries"])
+    if agent_loader.ready:
+        wa = agent_loader.get()
+        scheduler = wa.scheduler.stats()
+        metrics.set("gabriela_scheduler_turns", scheduler["active"], state="active")
+        metrics.set("gabriela_scheduler_turns", scheduler["queued"], state="queued")
+        governor = wa.agent.governor.stats()
+        metrics.set(
+            "gabriela_model_calls_in_flight", governor["active"], state="active"
+        )
+        metrics.set(
+            "gabriela_model_calls_in_flight", governor["waiting"], state="waiting"
+        )
+        metrics.set("gabriela_circuit_open", int(governor["circuit"] == "open"))
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+agent_loader.mark("imports_done")
@@ -0,0 +1,5 @@
+import os
+
+# Keep the app offline while the modules under test are imported
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ["MONGO_URI"] = ""
@@ -0,0 +1,135 @@
+import pytest
+from langchain_core.messages import AIMessage, ToolMessage
+
+from benchmarks.fakes import FakeChatModel, MemoryStorage
+from gabriela.agent import answer_cache
+from gabriela.agent.agent import Agent
+from gabriela.agent.answer_cache import AnswerCache
+from gabriela.agent.checkpointer import BoundedMemorySaver
+from gabriela.agent.governor import MODEL_ERROR_REPLY
+from gabriela.agent.pampa_tools import tools_list
+
+QUESTION = "¿Cuánto gastamos este mes?"
+
+
+def read_turn(reply="Llevan 1500", content="person,total_value\nFran,1500"):
+    call = {"id": "call_1", "name": "get_expense_totals", "args": {}}
+    return [
+        AIMessage("", tool_calls=[call]),
+        ToolMessage(content, tool_call_id="call_1"),
+        AIMessage(reply),
+    ]
+
+
+def write_turn():
+    call = {"id": "call_2", "name": "expense_tracker", "args": {}}
+    return [
+        AIMessage("", tool_calls=[call]),
+        ToolMessage("Expense added successfully", tool_call_id="call_2"),
+        AIMessage("Anotado"),
+    ]
+
+
+def test_same_question_is_shared_by_the_team():
+    cache = AnswerCache()
+    key = cache.key(QUESTION, "whatsapp:+1")
+    cache.record(key, cache.versions(), read_turn())
+    assert cache.key("cuanto gastamos este mes", "whatsapp:+2") == key
+    assert cache.get(key) == "Llevan 1500"
+
+
+def test_personal_questions_are_kept_per_member(monkeypatch):
+    monkeypatch.setattr(
+        answer_cache, "TEAM_MEMBERS", {"whatsapp:+1": "Fran", "whatsapp:+2": "Fran"}
+    )
+    assert AnswerCache.key("¿Cuánto gasté este mes?", "whatsapp:+1") == (
+        AnswerCache.key("cuanto gaste este mes", "whatsapp:+2")
+    )
+    assert AnswerCache.key("¿Cuánto gasté este mes?", "whatsapp:+1") != (
+        AnswerCache.key("¿Cuánto gasté este mes?", "whatsapp:+3")
+    )
+    assert AnswerCache.key("¿Cuánto gasté este mes?", None) is None
+
+
+@pytest.mark.parametrize(
+    "message", ["sí", "¿Y ayer?", "¿Cuánto suman esos?", "lo mismo para Petra"]
+)
+def test_follow_ups_are_not_cached(message):
+    assert AnswerCache.key(message, "whatsapp:+1") is None
+
+
+def test_write_tool_invalidates_answers():
+    cache = AnswerCache()
+    key = cache.key(QUESTION, "whatsapp:+1")
+    cache.record(key, cache.versions(), read_turn())
+    cache.record(None, cache.versions(), write_turn())
+    assert cache.get(key) is None
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_answer_read_before_a_write_is_not_kept():
+    cache = AnswerCache()
+    key = cache.key(QUESTION, "whatsapp:+1")
+    versions = cache.versions()
+    cache.record(None, cache.versions(), write_turn())  # Finished in between
+    cache.record(key, versions, read_turn())
+    assert cache.get(key) is None
+
+
+@pytest.mark.parametrize(
+    "messages",
+    [
+        read_turn(content="Error summing expenses: timeout"),
+        read_turn(reply=MODEL_ERROR_REPLY),
+        read_turn()[:2]
+        + [ToolMessage("", tool_call_id="x", status="error")]
+        + [AIMessage("Llevan 1500")],
+        write_turn(),
+    ],
+    ids=["tool error", "model error", "error status", "write"],
+)
+def test_failed_or_writing_turns_are_not_cached(messages):
+    cache = AnswerCache()
+    key = cache.key(QUESTION, "whatsapp:+1")
+    cache.record(key, cache.versions(), messages)
+    assert cache.get(key) is None
+    assert cache.stats()["stored"] == 0
+
+
+def test_expired_answers_miss():
+    now = [0.0]
+    cache = AnswerCache(ttl=10, clock=lambda: now[0])
+    key = cache.key(QUESTION, "whatsapp:+1")
+    cache.record(key, cache.versions(), read_turn())
+    now[0] = 11
+    assert cache.get(key) is None
+
+
+@pytest.fixture
+def agent():
+    storage = MemoryStorage()
+    for tool in tools_list:
+        tool.storage = storage
+    model = FakeChatModel()
+    agent = Agent(checkpointer=BoundedMemorySaver(), answers=AnswerCache())
+    agent._models = {"vision": model, "text": model}
+    agent._context_policy.summarizer = None
+    agent.router = None
+    agent._build_graph()
+    return agent, model
+
+
+def test_agent_answers_repeated_question_without_the_model(agent):
+    agent, model = agent
+    agent.invoke("whatsapp:+1", QUESTION)
+    calls = model.calls
+    for sender in ("whatsapp:+1", "whatsapp:+2"):
+        result = agent.invoke(sender, QUESTION)
+        assert result["messages"][-1].content.startswith("Listo")
+    assert model.calls == calls
+    assert agent.answers.stats()["hits"] == 2
+
+    agent.invoke("whatsapp:+2", "Gasté 1500 en uber")
+    calls = model.calls
+    agent.invoke("whatsapp:+1", QUESTION)
+    assert model.calls > calls
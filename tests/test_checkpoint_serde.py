@@ -0,0 +1,119 @@
+from datetime import datetime, timezone
+
+import pytest
+from langchain_core.messages import (
+    AIMessage,
+    ChatMessage,
+    FunctionMessage,
+    HumanMessage,
+    SystemMessage,
+    ToolMessage,
+)
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+
+from gabriela.agent.checkpoint_serde import CompactSerializer
+
+PROMPT = "Sos Gabriela, una asistente que anota los gastos del equipo."
+
+TOOL_CALL = {
+    "id": "call_1",
+    "name": "add_expense",
+    "args": {"amount": 1500, "category": "transporte"},
+    "type": "tool_call",
+}
+
+TOOL_CALL_MESSAGE = AIMessage(
+    "",
+    tool_calls=[TOOL_CALL],
+    additional_kwargs={
+        "tool_calls": [
+            {
+                "id": "call_1",
+                "type": "function",
+                "function": {"name": "add_expense", "arguments": "{}"},
+            }
+        ]
+    },
+    response_metadata={"model_name": "gpt-4o-mini", "finish_reason": "tool_calls"},
+    usage_metadata={"input_tokens": 10, "output_tokens": 5, "total_tokens": 15},
+)
+
+MESSAGES = [
+    SystemMessage(PROMPT),
+    SystemMessage("Otro mensaje de sistema"),
+    HumanMessage("Gasté 1500 en uber", id="h1"),
+    HumanMessage(
+        [
+            {"type": "text", "text": "Este ticket"},
+            {"type": "image_url", "image_url": {"url": "image://abc123"}},
+        ]
+    ),
+    TOOL_CALL_MESSAGE,
+    ToolMessage("Gasto agregado", tool_call_id="call_1", name="add_expense"),
+    ToolMessage("Error: falta el monto", tool_call_id="call_2", status="error"),
+    AIMessage("Listo, anoté 1500 en transporte"),
+    FunctionMessage("42", name="total"),
+    ChatMessage("Hola", role="assistant"),
+]
+
+
+@pytest.fixture
+def serde():
+    return CompactSerializer(static_texts=[PROMPT])
+
+
+@pytest.mark.parametrize("message", MESSAGES, ids=lambda m: m.type)
+def test_message_round_trip(serde, message):
+    loaded = serde.loads_typed(serde.dumps_typed(message))
+    assert type(loaded) is type(message)
+    assert loaded.content == message.content
+    if isinstance(message, AIMessage):
+        assert loaded.tool_calls == message.tool_calls
+        assert loaded.usage_metadata == message.usage_metadata
+        assert loaded.response_metadata == message.response_metadata
+    if isinstance(message, ToolMessage):
+        assert (loaded.tool_call_id, loaded.status) == (
+            message.tool_call_id,
+            message.status,
+        )
+    assert loaded.model_dump(exclude={"additional_kwargs"}) == message.model_dump(
+        exclude={"additional_kwargs"}
+    )
+
+
+def test_tool_call_copy_is_dropped(serde):
+    loaded = serde.loads_typed(serde.dumps_typed(TOOL_CALL_MESSAGE))
+    assert "tool_calls" not in loaded.additional_kwargs
+    assert loaded.tool_calls == [TOOL_CALL]
+
+
+def test_prompt_stored_as_reference(serde):
+    _, data = serde.dumps_typed(SystemMessage(PROMPT))
+    assert PROMPT.encode() not in data
+    # Read back empty once the prompt is no longer known
+    assert CompactSerializer().loads_typed(("compact", data)).content == ""
+
+
+def test_large_values_are_compressed(serde):
+    messages = [HumanMessage(f"Gasté {n} en uber") for n in range(100)]
+    type_, data = serde.dumps_typed(messages)
+    assert type_ == "compact+zlib"
+    assert serde.loads_typed((type_, data)) == messages
+    assert serde.dumps_typed(messages[:1])[0] == "compact"
+
+
+def test_other_values_go_through_fallback(serde):
+    value = {
+        "messages": [m for m in MESSAGES if m is not TOOL_CALL_MESSAGE],
+        "date": datetime(2024, 5, 1, 12, 30, tzinfo=timezone.utc),
+        "tags": {"uber", "taxi"},
+        "count": 3,
+    }
+    assert serde.loads_typed(serde.dumps_typed(value)) == value
+
+
+def test_reads_checkpoints_of_the_default_format(serde):
+    value = {"messages": [*MESSAGES[2:4], TOOL_CALL_MESSAGE], "step": 1}
+    typed = JsonPlusSerializer().dumps_typed(value)
+    assert typed[0] != "compact"
+    assert serde.loads_typed(typed) == value
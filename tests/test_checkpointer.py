@@ -0,0 +1,115 @@
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.checkpoint.base import empty_checkpoint
+
+from gabriela.agent.checkpoint_serde import CompactSerializer
+from gabriela.agent.checkpointer import BoundedMemorySaver, MongoDBSaver
+
+mongomock = pytest.importorskip("mongomock")
+
+
+class RecordingCollection:
+    """A mongomock collection that remembers the delta updates it was sent."""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.pushes = []
+
+    def update_one(self, filter, update, **kwargs):
+        result = self.collection.update_one(filter, update, **kwargs)
+        if "$push" in update:
+            self.pushes.append((update["$push"]["items"]["$each"], result))
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+class RecordingDatabase:
+    def __init__(self):
+        self.db = mongomock.MongoClient().db
+        self.checkpoints = RecordingCollection(self.db.checkpoints)
+
+    def __getitem__(self, name):
+        return self.checkpoints
+
+    def command(self, *args, **kwargs):
+        return self.db.command(*args, **kwargs)
+
+
+def saver(db, cache=True):
+    return MongoDBSaver(
+        db,
+        serde=CompactSerializer(),
+        append_channel="messages",
+        cache=BoundedMemorySaver(append_channel="messages") if cache else None,
+    )
+
+
+def put(saver, parent_id, messages):
+    checkpoint = empty_checkpoint()
+    checkpoint["channel_values"] = {"messages": messages}
+    config = {"configurable": {"thread_id": "t", "checkpoint_ns": ""}}
+    if parent_id:
+        config["configurable"]["checkpoint_id"] = parent_id
+    saver.put(config, checkpoint, {"step": len(messages)}, {})
+    return checkpoint["id"]
+
+
+def stored_messages(db):
+    """The messages of the thread as a fresh process would read them."""
+    config = {"configurable": {"thread_id": "t", "checkpoint_ns": ""}}
+    checkpoint = saver(db, cache=False).get_tuple(config).checkpoint
+    return checkpoint["channel_values"]["messages"]
+
+
+def conversation(turns):
+    messages = []
+    for turn in range(turns):
+        messages += [
+            HumanMessage(f"Gasté {turn} en uber"),
+            AIMessage(f"Anotado {turn}"),
+        ]
+    return messages
+
+
+def test_step_only_pushes_new_messages():
+    db = RecordingDatabase()
+    checkpoints = saver(db)
+    first = put(checkpoints, None, conversation(1))
+    put(checkpoints, first, conversation(2))
+
+    [(pushed, result)] = db.checkpoints.pushes
+    assert len(pushed) == 2
+    assert result.matched_count == 1
+    assert stored_messages(db) == conversation(2)
+
+
+def test_push_rejected_when_parent_was_replaced():
+    db = RecordingDatabase()
+    checkpoints = saver(db)
+    first = put(checkpoints, None, conversation(1))
+    # Another process saved a newer step of the thread, this one's cache is stale
+    other = saver(db, cache=False)
+    put(other, first, conversation(1) + [HumanMessage("Y en taxi?")])
+
+    put(checkpoints, first, conversation(2))
+
+    [(_, result)] = db.checkpoints.pushes[1:]
+    assert result.matched_count == 0
+    assert stored_messages(db) == conversation(2)
+
+
+@pytest.mark.parametrize("change", [{"$pop": {"items": 1}}, {"$push": {"items": {}}}])
+def test_push_rejected_when_item_count_differs(change):
+    db = RecordingDatabase()
+    checkpoints = saver(db)
+    first = put(checkpoints, None, conversation(1))
+    db.db.checkpoints.update_one({"thread_id": "t"}, change)
+
+    put(checkpoints, first, conversation(2))
+
+    [(_, result)] = db.checkpoints.pushes
+    assert result.matched_count == 0
+    assert stored_messages(db) == conversation(2)
+    assert len(db.db.checkpoints.find_one()["items"]) == 4
@@ -0,0 +1,54 @@
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
+
+from gabriela.agent.agent import Agent
+from gabriela.agent.checkpointer import BoundedMemorySaver
+from gabriela.agent.context import ContextPolicy
+
+
+def turn(n: int):
+    """A turn with a tool call, 4 messages."""
+    return [
+        HumanMessage(f"Gasté {n} en uber"),
+        AIMessage(
+            "",
+            tool_calls=[
+                {"id": f"call_{n}", "name": "expense_tracker", "args": {"n": n}}
+            ],
+        ),
+        ToolMessage("Expense added successfully", tool_call_id=f"call_{n}"),
+        AIMessage(f"Anotado {n}"),
+    ]
+
+
+def count(messages):
+    return 10 * len(messages)
+
+
+def test_window_starts_at_a_user_message():
+    history = turn(1) + turn(2) + turn(3)
+    # Room for 6 messages, the last turn and half of the previous one
+    policy = ContextPolicy(max_tokens=60, token_counter=count)
+    assert policy.window(history, 0) == turn(3)
+
+
+def test_window_keeps_the_latest_message_over_budget():
+    history = turn(1) + [HumanMessage("Y cuánto llevo?")]
+    policy = ContextPolicy(max_tokens=5, token_counter=count)
+    assert policy.window(history, 0) == history[-1:]
+
+
+def test_fold_ends_on_a_turn_boundary():
+    history = turn(1) + turn(2) + turn(3)
+    policy = ContextPolicy(max_tokens=100, token_counter=count, fold_ratio=0.5)
+    fold = policy.plan(history, 0)
+    assert isinstance(history[fold], HumanMessage)
+    assert policy.window(history, fold) == history[fold:]
+
+
+def test_summary_comes_before_the_context():
+    agent = Agent(checkpointer=BoundedMemorySaver())
+    messages = agent._model_input(turn(1), "Ya anotó 100", 0, "whatsapp:+1")
+    prompt, summary, context = messages[:3]
+    assert all(isinstance(m, SystemMessage) for m in (prompt, summary, context))
+    assert "Ya anotó 100" in summary.content
+    assert messages[3:] == turn(1)
@@ -0,0 +1,270 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from gabriela.agent import governor as governor_module
+from gabriela.agent.governor import CircuitBreaker, CircuitOpenError, ModelGovernor
+
+
+class ProviderError(Exception):
+    """Error of the model provider with an HTTP status, like the openai ones."""
+
+    def __init__(self, status_code: int, retry_after: str = None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        headers = {"retry-after": retry_after} if retry_after else {}
+        self.response = type("Response", (), {"headers": headers})()
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def failing(errors, result="ok"):
+    """A model call raising ``errors`` in order, then returning ``result``."""
+    errors = list(errors)
+    calls = []
+
+    def call():
+        calls.append(1)
+        if errors:
+            raise errors.pop(0)
+        return result
+
+    call.calls = calls
+    return call
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Delays the governor waited for between retries, without waiting."""
+    delays = []
+    monkeypatch.setattr(governor_module.time, "sleep", delays.append)
+    return delays
+
+
+def test_retries_with_growing_backoff(sleeps):
+    governor = ModelGovernor(max_retries=3, base_delay=1.0, max_delay=8.0)
+    call = failing([ProviderError(503), ProviderError(429), ProviderError(500)])
+
+    assert governor.call("Fran", call) == "ok"
+
+    assert len(call.calls) == 4
+    assert len(sleeps) == 3
+    for attempt, delay in enumerate(sleeps):
+        assert 0 <= delay <= 2**attempt
+    stats = governor.stats()
+    assert stats["calls"] == 4
+    assert stats["retries"] == 3
+    assert stats["failures"] == 0
+    assert stats["circuit"] == "closed"
+
+
+def test_retry_waits_what_the_provider_asked(sleeps):
+    governor = ModelGovernor(max_retries=1, base_delay=0.01, max_delay=8.0)
+
+    governor.call("Fran", failing([ProviderError(429, retry_after="5")]))
+
+    assert sleeps == [5.0]
+
+
+def test_gives_up_after_max_retries(sleeps):
+    governor = ModelGovernor(max_retries=2, base_delay=0.01)
+    call = failing([ProviderError(503)] * 5)
+
+    with pytest.raises(ProviderError):
+        governor.call("Fran", call)
+
+    assert len(call.calls) == 3
+    assert governor.stats()["failures"] == 1
+
+
+def test_bad_requests_are_not_retried(sleeps):
+    governor = ModelGovernor(max_retries=3)
+    call = failing([ProviderError(400)])
+
+    with pytest.raises(ProviderError):
+        governor.call("Fran", call)
+
+    assert len(call.calls) == 1
+    assert sleeps == []
+    assert governor.breaker.state == "closed"
+
+
+def test_async_retries_with_backoff(monkeypatch):
+    delays = []
+
+    async def sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(governor_module.asyncio, "sleep", sleep)
+    governor = ModelGovernor(max_retries=2, base_delay=1.0)
+    errors = [ProviderError(503), ProviderError(503)]
+
+    async def call():
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+
+    assert asyncio.run(governor.acall("Fran", call)) == "ok"
+    assert len(delays) == 2
+    assert governor.stats()["retries"] == 2
+
+
+def test_circuit_opens_half_opens_and_closes(sleeps):
+    clock = Clock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=clock)
+    governor = ModelGovernor(max_retries=0, breaker=breaker)
+
+    for _ in range(2):
+        with pytest.raises(ProviderError):
+            governor.call("Fran", failing([ProviderError(503)]))
+    assert breaker.state == "open"
+    assert governor.stats()["circuit_opened"] == 1
+
+    # Open: fails fast without calling the model
+    call = failing([])
+    with pytest.raises(CircuitOpenError):
+        governor.call("Fran", call)
+    assert call.calls == []
+    assert governor.stats()["rejected"] == 1
+
+    clock.now = 30
+    assert breaker.state == "half_open"
+    # Only one call probes the provider, the rest wait for its outcome
+    assert breaker.allow()
+    assert not breaker.allow()
+    assert breaker.state == "open"
+
+    clock.now = 60
+    assert governor.call("Fran", call) == "ok"
+    assert breaker.state == "closed"
+    assert governor.call("Fran", call) == "ok"
+
+
+def test_failed_probe_opens_the_circuit_again(sleeps):
+    clock = Clock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30, clock=clock)
+    governor = ModelGovernor(max_retries=3, breaker=breaker)
+
+    with pytest.raises(ProviderError):
+        governor.call("Fran", failing([ProviderError(503)] * 4))
+    assert breaker.state == "open"
+
+    clock.now = 30
+    assert breaker.state == "half_open"
+    # The probe isn't retried, a half open circuit doesn't hammer the provider
+    call = failing([ProviderError(503)])
+    with pytest.raises(ProviderError):
+        governor.call("Fran", call)
+    assert len(call.calls) == 1
+    assert breaker.state == "open"
+
+    clock.now = 59
+    with pytest.raises(CircuitOpenError):
+        governor.call("Fran", failing([]))
+    clock.now = 60
+    assert governor.call("Fran", failing([])) == "ok"
+    assert breaker.state == "closed"
+
+
+def test_sender_slots_are_dropped_when_idle():
+    governor = ModelGovernor(max_concurrency=4, per_sender=1)
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return "ok"
+
+    threads = [
+        threading.Thread(target=governor.call, args=("Fran", slow)),
+        threading.Thread(target=governor.call, args=("Fran", lambda: "ok")),
+    ]
+    threads[0].start()
+    assert started.wait(5)
+    threads[1].start()
+    deadline = time.monotonic() + 5
+    while governor.stats()["waiting"] != 1 and time.monotonic() < deadline:
+        time.sleep(0.001)
+
+    stats = governor.stats()
+    assert stats["active"] == 1
+    assert stats["senders"] == 1
+
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    stats = governor.stats()
+    assert (stats["active"], stats["waiting"], stats["senders"]) == (0, 0, 0)
+
+
+def test_sender_slots_are_dropped_after_failures(sleeps):
+    governor = ModelGovernor(max_retries=0)
+
+    with pytest.raises(ProviderError):
+        governor.call("Fran", failing([ProviderError(400)]))
+
+    assert governor.stats()["senders"] == 0
+
+
+def test_async_sender_slots_are_dropped_when_idle():
+    governor = ModelGovernor(max_concurrency=4, per_sender=1)
+
+    async def main():
+        release = asyncio.Event()
+
+        async def slow():
+            await release.wait()
+            return "ok"
+
+        async def fast():
+            return "ok"
+
+        tasks = [
+            asyncio.create_task(governor.acall("Fran", slow)),
+            asyncio.create_task(governor.acall("Fran", fast)),
+            asyncio.create_task(governor.acall("Petra", slow)),
+        ]
+        await asyncio.sleep(0.01)
+        stats = governor.stats()
+        assert (stats["active"], stats["waiting"], stats["senders"]) == (2, 1, 2)
+        release.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+    stats = governor.stats()
+    assert (stats["active"], stats["waiting"], stats["senders"]) == (0, 0, 0)
+
+
+def test_counters_stay_consistent_under_threads():
+    governor = ModelGovernor(max_concurrency=3, per_sender=2)
+    peak = []
+
+    def call():
+        peak.append(governor.stats()["active"])
+        return "ok"
+
+    threads = [
+        threading.Thread(
+            target=lambda n=n: [
+                governor.call(f"sender{n % 5}", call) for _ in range(50)
+            ]
+        )
+        for n in range(20)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    stats = governor.stats()
+    assert (stats["active"], stats["waiting"], stats["senders"]) == (0, 0, 0)
+    assert max(peak) <= 3
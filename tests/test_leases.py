@@ -0,0 +1,104 @@
+import asyncio
+import time
+
+import pytest
+
+from gabriela.agent.leases import MongoSenderLeases
+
+mongomock = pytest.importorskip("mongomock")
+
+
+class AsyncCollection:
+    """The async pymongo collection methods the leases use, over mongomock."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def create_index(self, *args, **kwargs):
+        return self.collection.create_index(*args, **kwargs)
+
+    async def update_one(self, *args, **kwargs):
+        return self.collection.update_one(*args, **kwargs)
+
+    async def delete_one(self, *args, **kwargs):
+        return self.collection.delete_one(*args, **kwargs)
+
+
+class AsyncDatabase:
+    def __init__(self):
+        self.db = mongomock.MongoClient(tz_aware=True).db
+
+    def __getitem__(self, name):
+        return AsyncCollection(self.db[name])
+
+
+def leases(db, ttl=60.0):
+    return MongoSenderLeases(db, ttl=ttl, poll_interval=0.01, max_poll_interval=0.02)
+
+
+def test_busy_lease_is_not_taken():
+    async def run():
+        db = AsyncDatabase()
+        first, second = leases(db), leases(db)
+        owner = await first.acquire("whatsapp:+1")
+        busy = await second._try_acquire("whatsapp:+1", "other")
+        other_sender = await second._try_acquire("whatsapp:+2", "other")
+        return owner, busy, other_sender, db.db.sender_leases.find_one()
+
+    owner, busy, other_sender, lease = asyncio.run(run())
+    assert busy is False
+    assert other_sender is True
+    assert lease["owner"] == owner
+
+
+def test_expired_lease_is_taken_over():
+    async def run():
+        db = AsyncDatabase()
+        dead, alive = leases(db, ttl=0.05), leases(db, ttl=0.05)
+        lost = await dead.acquire("whatsapp:+1")
+        await asyncio.sleep(0.1)  # The holder died without releasing it
+        owner = await alive.acquire("whatsapp:+1")
+        return lost, owner, await dead.renew("whatsapp:+1", lost), db
+
+    lost, owner, renewed, db = asyncio.run(run())
+    assert owner != lost
+    assert renewed is False
+    assert db.db.sender_leases.find_one({"_id": "whatsapp:+1"})["owner"] == owner
+
+
+def test_waiter_gets_the_lease_once_released():
+    async def run():
+        db = AsyncDatabase()
+        first, second = leases(db), leases(db)
+        order = []
+
+        async def turn(lease, name, seconds):
+            async with lease.hold("whatsapp:+1"):
+                order.append(f"{name} start")
+                await asyncio.sleep(seconds)
+                order.append(f"{name} end")
+
+        task = asyncio.create_task(turn(first, "first", 0.05))
+        await asyncio.sleep(0.01)
+        started = time.monotonic()
+        await turn(second, "second", 0)
+        await task
+        return order, time.monotonic() - started, second.stats()
+
+    order, waited, stats = asyncio.run(run())
+    assert order == ["first start", "first end", "second start", "second end"]
+    assert waited >= 0.03
+    assert stats["contended"] == 1
+
+
+def test_release_only_drops_own_lease():
+    async def run():
+        db = AsyncDatabase()
+        lease = leases(db)
+        owner = await lease.acquire("whatsapp:+1")
+        await lease.release("whatsapp:+1", "someone else")
+        held = db.db.sender_leases.count_documents({})
+        await lease.release("whatsapp:+1", owner)
+        return held, db.db.sender_leases.count_documents({})
+
+    assert asyncio.run(run()) == (1, 0)
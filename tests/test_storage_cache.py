@@ -0,0 +1,119 @@
+import asyncio
+
+from benchmarks.fakes import MemoryStorage
+from gabriela.agent.expenses_storage import CachedStorage, ExpenseQuery, MealQuery
+from gabriela.agent.metrics import metrics
+
+EXPENSE = {
+    "id": "Fran",
+    "expense_type": "uber",
+    "date": "2024-05-01",
+    "total_value": 1500,
+    "state": "pending",
+}
+
+
+class CountingStorage(MemoryStorage):
+    """Memory storage that counts the reads reaching it."""
+
+    def __init__(self):
+        super().__init__()
+        self.reads = 0
+
+    def _find(self, collection, query):
+        self.reads += 1
+        return super()._find(collection, query)
+
+
+def cache(**kwargs):
+    storage = CountingStorage()
+    storage.add_expense(EXPENSE)
+    return storage, CachedStorage(storage, **kwargs)
+
+
+def test_repeated_query_is_a_hit():
+    storage, cached = cache()
+    hits = metrics.value("gabriela_storage_cache_lookups_total", result="hit")
+    first = list(cached.get_expenses(ExpenseQuery(person="Fran")))
+    second = list(cached.get_expenses(ExpenseQuery(person="Fran")))
+    assert first == second and len(first) == 1
+    assert storage.reads == 1
+    assert cached.stats()["hits"] == 1 and cached.stats()["misses"] == 1
+    assert metrics.value("gabriela_storage_cache_lookups_total", result="hit") == (
+        hits + 1
+    )
+
+
+def test_async_reads_share_the_cache():
+    storage, cached = cache()
+    list(cached.get_expenses(ExpenseQuery()))
+    assert len(asyncio.run(cached.aget_expenses(ExpenseQuery()))) == 1
+    assert storage.reads == 1
+
+
+def test_write_invalidates_only_its_collection():
+    storage, cached = cache()
+    list(cached.get_expenses(ExpenseQuery()))
+    list(cached.get_meals(MealQuery()))
+    cached.add_expense({**EXPENSE, "total_value": 300})
+    assert len(list(cached.get_expenses(ExpenseQuery()))) == 2
+    list(cached.get_meals(MealQuery()))
+    assert storage.reads == 3
+
+
+def test_cancel_invalidates_expenses():
+    storage, cached = cache()
+    assert len(list(cached.get_expenses(ExpenseQuery()))) == 1
+    cached.cancel_pending_expenses()
+    assert list(cached.get_expenses(ExpenseQuery())) == []
+
+
+def test_result_read_during_a_write_is_not_kept():
+    storage, cached = cache()
+    key = cached._key("expenses", ExpenseQuery())
+    records = list(storage.get_expenses(ExpenseQuery()))
+    cached.add_expense(EXPENSE)  # Lands before the read is stored
+    cached._store(key, records)
+    assert len(list(cached.get_expenses(ExpenseQuery()))) == 2
+
+
+def test_least_recently_used_is_evicted():
+    storage, cached = cache(max_entries=2)
+    evictions = metrics.value("gabriela_storage_cache_evictions_total")
+    queries = [ExpenseQuery(person=name) for name in ("Fran", "Petra", "Lauta")]
+    list(cached.get_expenses(queries[0]))
+    list(cached.get_expenses(queries[1]))
+    list(cached.get_expenses(queries[0]))  # Now the most recently used
+    list(cached.get_expenses(queries[2]))
+    assert cached.stats()["evictions"] == 1
+    assert metrics.value("gabriela_storage_cache_evictions_total") == evictions + 1
+    reads = storage.reads
+    list(cached.get_expenses(queries[0]))
+    assert storage.reads == reads
+    list(cached.get_expenses(queries[1]))
+    assert storage.reads == reads + 1
+
+
+def test_expired_results_are_read_again():
+    now = [0.0]
+    storage, cached = cache(ttl=10, clock=lambda: now[0])
+    list(cached.get_expenses(ExpenseQuery()))
+    now[0] = 11
+    list(cached.get_expenses(ExpenseQuery()))
+    assert storage.reads == 2
+    assert cached.stats()["entries"] == 1
+
+
+def test_stats_are_exposed(monkeypatch):
+    from fastapi.testclient import TestClient
+
+    import main
+
+    storage, cached = cache()
+    monkeypatch.setattr(main, "shared_storage", cached)
+    list(cached.get_expenses(ExpenseQuery()))
+    client = TestClient(main.app)
+    assert client.get("/queue").json()["storage_cache"]["misses"] == 1
+    text = client.get("/metrics").text
+    assert "gabriela_storage_cache_entries 1" in text
+    assert 'gabriela_storage_cache_lookups_total{result="miss"}' in text
@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+from langchain_core.messages import HumanMessage
+
+from benchmarks.fakes import MemoryStorage
+from gabriela.agent.encoding import TRUNCATED
+from gabriela.agent.pampa_tools import GETExpenseTrackerTool, GetMealFrequencyTool
+from gabriela.agent.router import FastPathRouter
+
+
+def storage_with_expenses(count: int) -> MemoryStorage:
+    storage = MemoryStorage()
+    for day in range(count):
+        storage.add_expense(
+            {
+                "id": "Fran",
+                "expense_type": "uber",
+                "date": f"2024-{day // 28 + 1:02d}-{day % 28 + 1:02d}",
+                "total_value": 100 + day,
+                "state": "pending",
+            }
+        )
+    return storage
+
+
+@pytest.mark.parametrize("run", ["sync", "async"])
+def test_listing_over_the_limit_says_so(run):
+    tool = GETExpenseTrackerTool(storage=storage_with_expenses(60))
+    if run == "sync":
+        output = tool._run(limit=20)
+    else:
+        output = asyncio.run(tool._arun(limit=20))
+    lines = output.splitlines()
+    assert lines[-1] == TRUNCATED
+    assert len(lines) == 1 + 20 + 1
+
+
+def test_listing_at_the_limit_is_complete():
+    tool = GETExpenseTrackerTool(storage=storage_with_expenses(50))
+    lines = tool._run().splitlines()
+    assert TRUNCATED not in lines
+    assert len(lines) == 51
+
+
+def test_listing_without_limit_has_every_row():
+    tool = GETExpenseTrackerTool(storage=storage_with_expenses(60))
+    assert len(tool._run(limit=None).splitlines()) == 61
+
+
+def test_meal_ranking_over_the_limit_says_so():
+    storage = MemoryStorage()
+    for n in range(5):
+        storage.add_meal(
+            {"meal": f"comida {n}", "date": "2024-05-01", "team_member": "Petra"}
+        )
+    tool = GetMealFrequencyTool(storage=storage)
+    assert tool._run(limit=3).splitlines()[-1] == TRUNCATED
+    assert TRUNCATED not in tool._run(limit=5)
+
+
+def test_fast_path_tells_the_list_was_cut():
+    tool = GETExpenseTrackerTool(storage=storage_with_expenses(60))
+    router = FastPathRouter([tool])
+    messages = router.route([HumanMessage("gastos pendientes")], {"metadata": {}})
+    reply = messages[-1].content.splitlines()
+    assert reply[0] == "Gastos pendientes:"
+    assert len(reply) == 1 + 50 + 1
+    assert reply[-1].startswith("… y hay más. Te mostré 50")
@@ -0,0 +1,141 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from benchmarks.fakes import MemoryStorage
+from gabriela.agent.expenses_storage import ExpenseQuery, WriteBehindStorage
+
+
+def expense(n: int) -> dict:
+    return {
+        "id": "Fran",
+        "expense_type": "uber",
+        "date": f"2024-05-{n + 1:02d}",
+        "total_value": 100 * n,
+        "state": "pending",
+    }
+
+
+class BatchStorage(MemoryStorage):
+    """Memory storage recording every insert_many, which fails ``failures`` times."""
+
+    def __init__(self, failures: int = 0, delay: float = 0.0):
+        super().__init__()
+        self.failures = failures
+        self.delay = delay
+        self.batches = []
+
+    def _insert(self, collection, documents):
+        self.batches.append(len(documents))
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("MongoDB down")
+        for document in documents:
+            self._add(collection, document)
+
+    def insert_many(self, collection, documents):
+        time.sleep(self.delay)
+        self._insert(collection, documents)
+
+    async def ainsert_many(self, collection, documents):
+        await asyncio.sleep(self.delay)
+        self._insert(collection, documents)
+
+
+def test_full_batch_is_written_right_away():
+    async def run():
+        storage = BatchStorage()
+        writer = WriteBehindStorage(storage, flush_interval=10, max_batch=3)
+        start = time.monotonic()
+        await asyncio.gather(*(writer.aadd_expense(expense(n)) for n in range(3)))
+        return storage.batches, time.monotonic() - start
+
+    batches, seconds = asyncio.run(run())
+    assert batches == [3]
+    assert seconds < 1
+
+
+def test_inserts_within_the_interval_share_a_batch():
+    async def run():
+        storage = BatchStorage()
+        writer = WriteBehindStorage(storage, flush_interval=0.05)
+        first = asyncio.create_task(writer.aadd_expense(expense(0)))
+        await asyncio.sleep(0.01)
+        await asyncio.gather(first, writer.aadd_expense(expense(1)))
+        await writer.aadd_expense(expense(2))
+        return storage.batches
+
+    assert asyncio.run(run()) == [2, 1]
+
+
+def test_errors_reach_the_confirmed_writers():
+    async def run():
+        storage = BatchStorage(failures=1)
+        writer = WriteBehindStorage(storage, flush_interval=0.01)
+        results = await asyncio.gather(
+            writer.aadd_expense(expense(0)),
+            writer.aadd_expense(expense(1)),
+            return_exceptions=True,
+        )
+        await writer.aadd_expense(expense(2))
+        return results, storage
+
+    results, storage = asyncio.run(run())
+    assert [str(r) for r in results] == ["MongoDB down", "MongoDB down"]
+    # Confirmed writers got the error, so their documents aren't retried
+    assert storage.batches == [2, 1]
+    assert len(storage.collections["expenses"]) == 1
+
+
+def test_unconfirmed_batch_is_retried_without_new_traffic():
+    async def run():
+        storage = BatchStorage(failures=2)
+        writer = WriteBehindStorage(
+            storage, flush_interval=0.01, confirm=False, retry_interval=0.05
+        )
+        await writer.aadd_expense(expense(0))
+        await writer.aadd_expense(expense(1))
+        await asyncio.sleep(0.3)
+        return storage
+
+    storage = asyncio.run(run())
+    assert storage.batches == [2, 2, 2]
+    assert len(storage.collections["expenses"]) == 2
+
+
+def test_failed_sync_insert_is_reported_once():
+    storage = BatchStorage(failures=1)
+    writer = WriteBehindStorage(storage, retry_interval=0.05)
+    with pytest.raises(RuntimeError):
+        writer.add_expense(expense(0))
+    writer.add_expense(expense(1))
+    time.sleep(0.1)
+    assert storage.batches == [1, 1]
+    assert len(storage.collections["expenses"]) == 1
+
+
+def test_read_sees_buffered_inserts():
+    async def run():
+        storage = BatchStorage()
+        writer = WriteBehindStorage(storage, flush_interval=10, confirm=False)
+        await writer.aadd_expense(expense(0))
+        return await writer.aget_expenses(ExpenseQuery())
+
+    assert len(asyncio.run(run())) == 1
+
+
+def test_read_waits_for_the_batch_being_written():
+    storage = BatchStorage(delay=0.1)
+    writer = WriteBehindStorage(storage, flush_interval=10, confirm=False)
+
+    async def write():
+        await writer.aadd_expense(expense(0))
+        await writer.aflush()
+
+    thread = threading.Thread(target=asyncio.run, args=(write(),))
+    thread.start()
+    time.sleep(0.03)  # The batch is being written
+    assert len(list(writer.get_expenses(ExpenseQuery()))) == 1
+    thread.join()